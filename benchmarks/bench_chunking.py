@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import io
+import os
+import sys
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import chunkstore
+
+
+def run(data, avg_size):
+    start = time.time()
+    sizes = [len(chunk) for chunk in chunkstore.split_chunks(io.BytesIO(data), avg_size)]
+    return time.time() - start, sizes
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--size", dest="size", type="int", default=32, help="size of the chunked data in MB")
+    parser.add_option("-c", "--chunk-size", dest="chunk_size", type="int", default=1024,
+                      help="average chunk size in KiB")
+    (options, args) = parser.parse_args()
+
+    data = os.urandom(options.size * 1024 * 1024)
+    numpy = chunkstore.numpy
+    cases = [("vectorized", numpy)] if numpy is not None else []
+    cases += [("python", None)]
+    print("%-16s %10s %10s %8s" % ("gear hash", "seconds", "MB/s", "chunks"))
+    results = []
+    for label, module in cases:
+        chunkstore.numpy = module
+        elapsed, sizes = run(data, options.chunk_size * 1024)
+        results.append(sizes)
+        print("%-16s %10.2f %10.1f %8d" % (label, elapsed, options.size / elapsed, len(sizes)))
+    chunkstore.numpy = numpy
+    if len(results) > 1:
+        print("boundaries match: " + str(results[0] == results[1]))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import sys
+import time
+import random
+import shutil
+import tarfile
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import fileutils
+
+
+def generate_source(dir_path, total_mb, file_mb=8):
+    """
+    Fills dir_path with files of mixed compressibility (log-like text and random bytes) of total_mb megabytes.
+    """
+    rnd = random.Random(42)
+    words = [("word%d" % i).encode("ascii") for i in range(2000)]
+    for i in range(max(1, total_mb // file_mb)):
+        with open(os.path.join(dir_path, "file%04d.dat" % i), "wb") as f:
+            if i % 4 == 3:
+                f.write(os.urandom(file_mb * 1024 * 1024))
+            else:
+                written = 0
+                while written < file_mb * 1024 * 1024:
+                    line = b" ".join(rnd.choice(words) for j in range(12)) + b"\n"
+                    f.write(line)
+                    written += len(line)
+
+
+def get_dir_size(dir_path):
+    return sum(os.path.getsize(os.path.join(dp, f)) for dp, dn, fn in os.walk(dir_path) for f in fn)
+
+
+def run(source, target, compression, workers=None, block_size=None):
+    start = time.time()
+    archive = fileutils.stream_archive_dir(source, target, compression, workers, block_size)
+    elapsed = time.time() - start
+    with tarfile.open(archive, "r:gz") as tar:
+        members = len(tar.getmembers())
+    size = os.path.getsize(archive)
+    os.remove(archive)
+    return elapsed, size, members
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-s", "--size", dest="size", type="int", default=256, help="size of the source tree in MB")
+    parser.add_option("-w", "--workers", dest="workers", default="1,2,4,8", help="comma separated pgzip worker counts")
+    parser.add_option("-b", "--block-size", dest="block_size", type="int", default=128, help="pgzip block size in KiB")
+    (options, args) = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="rex-bench-")
+    try:
+        source = os.path.join(work_dir, "source")
+        target = os.path.join(work_dir, "target")
+        os.makedirs(source)
+        generate_source(source, options.size)
+        source_mb = get_dir_size(source) / 1024.0 / 1024.0
+
+        print("%-16s %10s %10s %8s" % ("mode", "seconds", "MB/s", "ratio"))
+        cases = [("gzip", fileutils.COMPRESSION_GZIP, None)]
+        cases += [("pgzip x" + w, fileutils.COMPRESSION_PARALLEL_GZIP, int(w)) for w in options.workers.split(",")]
+        for label, compression, workers in cases:
+            elapsed, size, members = run(source, target, compression, workers, options.block_size * 1024)
+            print("%-16s %10.2f %10.1f %8.3f" % (label, elapsed, source_mb / elapsed, size / 1024.0 / 1024.0 / source_mb))
+    finally:
+        shutil.rmtree(work_dir)
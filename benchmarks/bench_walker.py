@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import walker
+
+
+def generate_tree(dir_path, files, files_per_dir=1000, fanout=10):
+    """
+    Creates a tree of empty files, files_per_dir files per directory, directories nested fanout wide.
+    """
+    for i in range(0, files, files_per_dir):
+        d = i // files_per_dir
+        parts = []
+        while True:
+            parts.append("d%d" % (d % fanout))
+            d //= fanout
+            if not d:
+                break
+        sub_dir = os.path.join(dir_path, *parts)
+        os.makedirs(sub_dir, exist_ok=True)
+        for j in range(min(files_per_dir, files - i)):
+            open(os.path.join(sub_dir, "f%d.log" % j), "w").close()
+
+
+def scan_legacy(source_dir_path, exclude_regexp):
+    """
+    The scan archive checks used to perform: os.walk, islink and getmtime per entry, uncompiled regexp.
+    """
+    count = 0
+    src_members = dict()
+    for dirpath, dirnames, filenames in os.walk(source_dir_path):
+        for name in filenames + dirnames:
+            file_absolute_path = os.path.join(dirpath, name)
+            if not os.path.islink(file_absolute_path):
+                src_members[file_absolute_path] = os.path.getmtime(file_absolute_path)
+    for src_key in src_members:
+        if not re.search(exclude_regexp, src_key.replace(source_dir_path, ".")):
+            count += 1
+    return count
+
+
+def scan_walker(source_dir_path, exclude_regexp, threads):
+    count = 0
+    exclude = walker.compile_pattern(exclude_regexp)
+    for entry in walker.walk(source_dir_path, threads=threads):
+        if not entry.is_link and not exclude.search(entry.key) and entry.stat.st_mtime:
+            count += 1
+    return count
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("-n", "--files", dest="files", type="int", default=1000000, help="number of files in the tree")
+    parser.add_option("-t", "--threads", dest="threads", default="1,4,16", help="comma separated walker thread counts")
+    parser.add_option("-d", "--dir", dest="dir", default=None, help="existing tree to scan instead of a synthetic one")
+    (options, args) = parser.parse_args()
+
+    work_dir = None if options.dir else tempfile.mkdtemp(prefix="rex-bench-")
+    try:
+        source = options.dir
+        if not source:
+            source = os.path.join(work_dir, "source")
+            start = time.time()
+            generate_tree(source, options.files)
+            print("Generated %d files in %.1f s" % (options.files, time.time() - start))
+
+        print("%-16s %10s %12s %10s" % ("scanner", "seconds", "entries/s", "entries"))
+        cases = [("legacy os.walk", lambda: scan_legacy(source, "(\\.tmp$)"))]
+        cases += [("scandir x" + t, (lambda t: lambda: scan_walker(source, "(\\.tmp$)", int(t)))(t))
+                  for t in options.threads.split(",")]
+        for label, scan in cases:
+            start = time.time()
+            count = scan()
+            elapsed = time.time() - start
+            print("%-16s %10.2f %12.0f %10d" % (label, elapsed, count / elapsed, count))
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir)
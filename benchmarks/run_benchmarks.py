@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import datetime
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import fileutils
+import config
+import catalog
+import rex_backup
+import synthetic
+
+
+def run_phase(name, fn, files, size):
+    """
+    Runs fn in a forked process so that the peak RSS reported is the one of this phase only. Returns phase metrics.
+    """
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+
+    def child():
+        start = time.time()
+        cpu_start = time.process_time()
+        error = None
+        try:
+            fn()
+        except Exception as ex:
+            error = ex.__str__()
+        queue.put({"wall": time.time() - start, "cpu": time.process_time() - cpu_start, "error": error,
+                   "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0})
+
+    process = ctx.Process(target=child, name=name)
+    process.start()
+    result = queue.get()
+    process.join()
+    wall = max(result["wall"], 1e-9)
+    result.update({"files": files, "bytes": size, "files_per_s": files / wall, "mb_per_s": size / wall / 1024.0 / 1024.0})
+    print("%-14s %9.2f %9.2f %12.0f %9.1f %10.1f %s" % (name, result["wall"], result["cpu"], result["files_per_s"],
+                                                        result["mb_per_s"], result["peak_rss_mb"], result["error"] or ""))
+    return result
+
+
+def make_history(archive_path, count):
+    """
+    Hard links the archive and its sidecars under the names of count daily archives made before it. Returns the total
+    size of the linked archives.
+    """
+    date = rex_backup.parse_archive_date(archive_path)
+    stamp = date.strftime("%Y%m%d%H%M")
+    dir_path = os.path.dirname(archive_path)
+    sidecars = [n for n in os.listdir(dir_path) if n.startswith(os.path.basename(archive_path) + ".")]
+    for i in range(1, count + 1):
+        old_stamp = (date - datetime.timedelta(days=i)).strftime("%Y%m%d%H%M")
+        os.link(archive_path, archive_path.replace(stamp, old_stamp))
+        for sidecar in sidecars:
+            os.link(os.path.join(dir_path, sidecar), os.path.join(dir_path, sidecar.replace(stamp, old_stamp)))
+    return os.path.getsize(archive_path) * count
+
+
+def write_config(work_dir, backup):
+    """
+    Writes resources/config.xml of the working directory with the backup in its backup downtime, so that a run of the
+    script has nothing to do.
+    """
+    resources_dir = os.path.join(work_dir, "resources")
+    os.makedirs(resources_dir, exist_ok=True)
+    with open(os.path.join(resources_dir, "config.xml"), "w") as f:
+        f.write('<config perform-checks="true" perform-reporting="">\n    <backups>\n'
+                '        <backup backup-downtime="1" rotation-period="%d">\n'
+                '            <source>%s</source>\n            <target>%s</target>\n        </backup>\n'
+                '    </backups>\n</config>\n' % (backup.rotationPeriod, backup.source, backup.target))
+
+
+def run_script(runs, args):
+    """
+    Starts the script runs times one after another the way cron does.
+    """
+    for i in range(runs):
+        subprocess.check_call([sys.executable] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints wall time changes against a baseline run and returns the names of phases which got slower than tolerance.
+    """
+    regressions = []
+    print("\n%-14s %10s %10s %8s" % ("phase", "baseline", "current", "change"))
+    for name, phase in results["phases"].items():
+        if name in baseline.get("phases", {}):
+            before = baseline["phases"][name]["wall"]
+            change = (phase["wall"] - before) / before * 100.0 if before else 0.0
+            print("%-14s %10.2f %10.2f %+7.1f%%" % (name, before, phase["wall"], change))
+            if change > tolerance:
+                regressions.append(name)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = OptionParser("usage: %prog [options]")
+    parser.add_option("--tiny-files", dest="tiny_files", type="int", default=100000, help="number of tiny files")
+    parser.add_option("--huge-files", dest="huge_files", type="int", default=2, help="number of huge files")
+    parser.add_option("--huge-size", dest="huge_size", type="int", default=256, help="size of huge files in MB")
+    parser.add_option("--depth", dest="depth", type="int", default=32, help="depth of the nested directory chain")
+    parser.add_option("--symlinks", dest="symlinks", type="int", default=100, help="number of symbolic links")
+    parser.add_option("--incompressible", dest="incompressible", type="int", default=25,
+                      help="percentage of incompressible data in huge files")
+    parser.add_option("--compression", dest="compression", default="gzip", help="gzip or pgzip")
+    parser.add_option("--check-mode", dest="check_mode", default="index", help="index, digest or deep")
+    parser.add_option("--history", dest="history", type="int", default=100,
+                      help="number of old archives in the target for the rotation and catalog phases")
+    parser.add_option("--startup-runs", dest="startup_runs", type="int", default=10,
+                      help="number of script runs with all backups in downtime for the startup phases")
+    parser.add_option("-o", "--output", dest="output", default=None, help="file to save JSON results to")
+    parser.add_option("-b", "--baseline", dest="baseline", default=None, help="JSON results of a previous run")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=10.0,
+                      help="wall time increase in percent reported as a regression")
+    parser.add_option("--dir", dest="dir", default=None, help="directory to generate data in (default: temporary)")
+    (options, args) = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="rex-bench-", dir=options.dir)
+    os.environ[fileutils.WORKING_DIR_ENV] = work_dir
+    try:
+        profile = synthetic.TreeProfile(options.tiny_files, hugeFiles=options.huge_files,
+                                        hugeSize=options.huge_size * synthetic.BLOCK_SIZE, depth=options.depth,
+                                        symlinks=options.symlinks, incompressible=options.incompressible)
+        source = os.path.join(work_dir, "source")
+        target = os.path.join(work_dir, "target")
+        start = time.time()
+        tree = synthetic.generate_tree(source, profile)
+        print("Generated %d files, %d dirs, %d links, %.1f MB in %.1f s" % (tree.files, tree.dirs, tree.links,
+              tree.bytes / 1024.0 / 1024.0, time.time() - start))
+
+        backup = config.BackupConfig(source, target, rotationPeriod=options.history // 2,
+                                     compression=options.compression, checkMode=options.check_mode)
+        entries = tree.files + tree.dirs + tree.links
+        phases = dict()
+
+        print("%-14s %9s %9s %12s %9s %10s" % ("phase", "wall s", "cpu s", "files/s", "MB/s", "peak MB"))
+        phases["backup"] = run_phase("backup", lambda: rex_backup.perform_backup(backup), entries, tree.bytes)
+        phases["check"] = run_phase("check", lambda: rex_backup.perform_backup_check(backup), entries, tree.bytes)
+
+        #a run with every backup in its downtime, files/s of these phases are runs per second
+        write_config(work_dir, backup)
+        script_path = os.path.join(os.path.dirname(os.path.abspath(rex_backup.__file__)), "rex_backup.py")
+        run_script(1, [script_path])
+        phases["interpreter"] = run_phase("interpreter", lambda: run_script(options.startup_runs, ["-c", "pass"]),
+                                          options.startup_runs, 0)
+        phases["startup"] = run_phase("startup", lambda: run_script(options.startup_runs, [script_path]),
+                                      options.startup_runs, 0)
+
+        archives = fileutils.get_files(target, rex_backup.ARCHIVE_NAME_PATTERN)
+        history_size = make_history(archives[0], options.history) if archives else 0
+        catalog_db = os.path.join(work_dir, "bench-catalog.sqlite")
+        phases["catalog-scan"] = run_phase("catalog-scan",
+                                           lambda: catalog.Catalog(catalog_db, rex_backup.scan_archives).sync(target),
+                                           options.history + 1, history_size)
+        phases["rotation"] = run_phase("rotation",
+                                       lambda: rex_backup.perform_backup_cleanup(config.RexConfig(backups=[backup])),
+                                       options.history + 1, history_size)
+
+        results = {"timestamp": datetime.datetime.now().isoformat(), "host": socket.gethostname(),
+                   "python": platform.python_version(), "cpus": os.cpu_count(), "options": vars(options),
+                   "tree": tree.to_dict(), "phases": phases}
+        if options.output:
+            with open(options.output, "w") as f:
+                json.dump(results, f, indent=2)
+            print("Results saved to " + options.output)
+        if options.baseline:
+            with open(options.baseline) as f:
+                regressions = compare(results, json.load(f), options.tolerance)
+            if regressions:
+                print("Regressions detected in: " + ", ".join(regressions))
+                sys.exit(1)
+    finally:
+        shutil.rmtree(work_dir)
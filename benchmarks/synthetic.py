@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import random
+
+BLOCK_SIZE = 1024 * 1024
+
+
+class TreeProfile:
+    """
+    Shape of a synthetic source tree.
+    """
+    def __init__(self, tinyFiles=100000, tinySize=256, filesPerDir=1000, hugeFiles=2, hugeSize=256 * BLOCK_SIZE,
+                 depth=32, symlinks=100, incompressible=25, seed=42):
+        self.tinyFiles = tinyFiles
+        self.tinySize = tinySize
+        self.filesPerDir = filesPerDir
+        self.hugeFiles = hugeFiles
+        self.hugeSize = hugeSize
+        self.depth = depth
+        self.symlinks = symlinks
+        self.incompressible = incompressible
+        self.seed = seed
+
+
+class TreeStats:
+    """
+    What was generated.
+    """
+    def __init__(self):
+        self.files = 0
+        self.dirs = 0
+        self.links = 0
+        self.bytes = 0
+
+    def to_dict(self):
+        return {"files": self.files, "dirs": self.dirs, "links": self.links, "bytes": self.bytes}
+
+
+def make_text_block(rnd, size=BLOCK_SIZE):
+    """
+    Returns a block of log-like text compressing roughly the way real logs and sources do.
+    """
+    words = [("w%x" % rnd.getrandbits(24)).encode("ascii") for i in range(4096)]
+    lines = []
+    length = 0
+    while length < size:
+        line = b" ".join(rnd.choice(words) for j in range(10)) + b"\n"
+        lines.append(line)
+        length += len(line)
+    return b"".join(lines)[:size]
+
+
+def generate_tree(root, profile):
+    """
+    Generates a source tree under root: lots of tiny files spread over directories, a few huge files with a share of
+    incompressible blocks, a deeply nested directory chain and symbolic links. Returns TreeStats.
+    """
+    rnd = random.Random(profile.seed)
+    stats = TreeStats()
+    text_block = make_text_block(rnd)
+    os.makedirs(root, exist_ok=True)
+
+    tiny_files = []
+    for i in range(profile.tinyFiles):
+        if i % profile.filesPerDir == 0:
+            tiny_dir = os.path.join(root, "tiny", "d%03d" % (i // profile.filesPerDir // 100),
+                                    "d%05d" % (i // profile.filesPerDir))
+            os.makedirs(tiny_dir, exist_ok=True)
+            stats.dirs += 1
+        path = os.path.join(tiny_dir, "f%06d.txt" % i)
+        offset = rnd.randrange(0, len(text_block) - profile.tinySize)
+        with open(path, "wb") as f:
+            f.write(text_block[offset:offset + profile.tinySize])
+        tiny_files.append(path)
+        stats.files += 1
+        stats.bytes += profile.tinySize
+
+    huge_dir = os.path.join(root, "huge")
+    os.makedirs(huge_dir, exist_ok=True)
+    for i in range(profile.hugeFiles):
+        with open(os.path.join(huge_dir, "huge%02d.bin" % i), "wb") as f:
+            written = 0
+            while written < profile.hugeSize:
+                size = min(BLOCK_SIZE, profile.hugeSize - written)
+                if rnd.randrange(100) < profile.incompressible:
+                    f.write(os.urandom(size))
+                else:
+                    f.write(text_block[:size])
+                written += size
+        stats.files += 1
+        stats.bytes += profile.hugeSize
+
+    deep_dir = os.path.join(root, "deep")
+    for i in range(profile.depth):
+        deep_dir = os.path.join(deep_dir, "level%03d" % i)
+        os.makedirs(deep_dir, exist_ok=True)
+        with open(os.path.join(deep_dir, "file.txt"), "wb") as f:
+            f.write(text_block[:profile.tinySize])
+        stats.dirs += 1
+        stats.files += 1
+        stats.bytes += profile.tinySize
+
+    links_dir = os.path.join(root, "links")
+    os.makedirs(links_dir, exist_ok=True)
+    for i in range(profile.symlinks):
+        target = rnd.choice(tiny_files) if tiny_files and i % 4 else huge_dir
+        os.symlink(os.path.relpath(target, links_dir), os.path.join(links_dir, "link%05d" % i))
+        stats.links += 1
+    return stats
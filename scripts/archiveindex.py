@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import gzip
+import json
+import zlib
+import bisect
+import struct
+import tarfile
+
+import throttle
+import compressors
+
+#Member index of an archive is stored next to it as <archive>.idx (gzipped json lines)
+INDEX_SUFFIX = ".idx"
+INDEX_VERSION = 1
+#Seek points of an archive are stored next to it as <archive>.seek: a header followed by (offset, compressed offset,
+#window length) records, each with its zlib compressed window
+SEEK_SUFFIX = ".seek"
+SEEK_HEADER = b"REXSEEK1"
+SEEK_RECORD = struct.Struct("<QQI")
+
+
+class ArchiveIndexError(Exception):
+     """
+     Abstract archive index error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class IndexEntry:
+    """
+    Metadata of a single archive member. offset is the position of the member header in the uncompressed tar stream.
+    """
+    __slots__ = ("name", "size", "mtime", "mode", "offset")
+
+    def __init__(self, name, size, mtime, mode, offset):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.mode = mode
+        self.offset = offset
+
+
+class IndexWriter:
+    """
+    Writes the member index of an archive while the archive is being created. The index is written into a partial file
+    which is renamed next to the archive by #commit().
+    """
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.part_path = index_path + ".part"
+        self.file = gzip.open(self.part_path, "wt", encoding="utf-8")
+        self.file.write(json.dumps({"version": INDEX_VERSION}) + "\n")
+        self.count = 0
+
+    def add(self, tarinfo, offset):
+        self.file.write(json.dumps([tarinfo.name, tarinfo.size, tarinfo.mtime, tarinfo.mode, offset]) + "\n")
+        self.count += 1
+
+    def commit(self, archive_size):
+        """
+        Completes the index with a trailer (its presence tells that the index is complete) and moves it into place.
+        """
+        self.file.write(json.dumps({"members": self.count, "archive_size": archive_size}) + "\n")
+        self.file.close()
+        os.replace(self.part_path, self.index_path)
+        return self.index_path
+
+    def abort(self):
+        self.file.close()
+        if os.path.isfile(self.part_path):
+            os.remove(self.part_path)
+
+
+class IndexingTarFile(tarfile.TarFile):
+    """
+    TarFile which reports every added member together with its offset to an IndexWriter. Added members are not kept
+    in memory as there is no need to look them up later. Reads of member content are charged to the read_throttle. If
+    a compressor (a writer of #compressors.open_writer()) is set, content which is compressed already is stored.
+    """
+    index = None
+    read_throttle = None
+    compressor = None
+
+    def addfile(self, tarinfo, fileobj=None):
+        offset = self.offset
+        if self.compressor is not None:
+            self.compressor.set_store(fileobj is not None and tarinfo.size >= compressors.MIN_STORE_SIZE and
+                                      compressors.is_incompressible(fileobj, tarinfo.name))
+        if fileobj is not None and self.read_throttle is not None:
+            fileobj = throttle.ThrottledReader(fileobj, self.read_throttle)
+        tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        if self.index is not None:
+            self.index.add(tarinfo, offset)
+            self.members = []
+
+
+class SeekPoint:
+    """
+    Position decompression of an archive can start at: offset in the uncompressed tar stream, compressed_offset in the
+    archive and the position of its window in the seek index.
+    """
+    __slots__ = ("offset", "compressed_offset", "window_position", "window_size")
+
+    def __init__(self, offset, compressed_offset, window_position, window_size):
+        self.offset = offset
+        self.compressed_offset = compressed_offset
+        self.window_position = window_position
+        self.window_size = window_size
+
+
+class SeekIndexWriter:
+    """
+    Writes the seek points reported by the compressor (see #compressors.open_writer()) while the archive is being
+    created. Like the member index it is written into a partial file which is renamed by #commit().
+    """
+    def __init__(self, seek_index_path):
+        self.seek_index_path = seek_index_path
+        self.part_path = seek_index_path + ".part"
+        self.file = open(self.part_path, "wb")
+        self.file.write(SEEK_HEADER)
+        self.count = 0
+
+    def add(self, offset, compressed_offset, window):
+        window = zlib.compress(window) if window else b""
+        self.file.write(SEEK_RECORD.pack(offset, compressed_offset, len(window)) + window)
+        self.count += 1
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.part_path, self.seek_index_path)
+        return self.seek_index_path
+
+    def abort(self):
+        self.file.close()
+        if os.path.isfile(self.part_path):
+            os.remove(self.part_path)
+
+
+class SeekIndex:
+    """
+    Seek points of an archive. Only the positions are read up front, windows are read when needed.
+    """
+    def __init__(self, seek_index_path):
+        self.seek_index_path = seek_index_path
+        self.points = []
+        with open(seek_index_path, "rb") as f:
+            if f.read(len(SEEK_HEADER)) != SEEK_HEADER:
+                raise ArchiveIndexError("Not a seek index: " + seek_index_path)
+            while True:
+                record = f.read(SEEK_RECORD.size)
+                if len(record) < SEEK_RECORD.size:
+                    break
+                offset, compressed_offset, window_size = SEEK_RECORD.unpack(record)
+                self.points.append(SeekPoint(offset, compressed_offset, f.tell(), window_size))
+                f.seek(window_size, os.SEEK_CUR)
+        self.offsets = [p.offset for p in self.points]
+
+    def find(self, offset):
+        """
+        Returns the last seek point at or before the offset of the tar stream (None if there is none).
+        """
+        i = bisect.bisect_right(self.offsets, offset)
+        return self.points[i - 1] if i else None
+
+    def get_window(self, point):
+        if not point.window_size:
+            return b""
+        with open(self.seek_index_path, "rb") as f:
+            f.seek(point.window_position)
+            return zlib.decompress(f.read(point.window_size))
+
+    def __len__(self):
+        return len(self.points)
+
+
+def get_seek_index_path(archive_path):
+    """
+    Returns path of the seek index sidecar of an archive.
+    """
+    return archive_path + SEEK_SUFFIX
+
+
+def get_index_path(archive_path):
+    """
+    Returns path of the index sidecar of an archive.
+    """
+    return archive_path + INDEX_SUFFIX
+
+
+def iter_index(index_path, trailer=None):
+    """
+    Lazily yields the entries of an index, the trailer is copied into the trailer dict if given. Raises
+    ArchiveIndexError after the last entry if the index is incomplete.
+    """
+    count = 0
+    found = None
+    with gzip.open(index_path, "rt", encoding="utf-8") as f:
+        for line in f:
+            record = json.loads(line)
+            if isinstance(record, list):
+                count += 1
+                yield IndexEntry(*record)
+            elif "members" in record:
+                found = record
+    if found is None or found["members"] != count:
+        raise ArchiveIndexError("Archive index is incomplete: " + index_path)
+    if trailer is not None:
+        trailer.update(found)
+
+
+def read_index(index_path):
+    """
+    Reads an index and returns a tuple (entries, trailer). Raises ArchiveIndexError if the index is incomplete.
+    """
+    trailer = dict()
+    entries = list(iter_index(index_path, trailer))
+    return entries, trailer
+
+
+def get_index_members(archive_path, archive_size=None):
+    """
+    Lazily yields (name, mtime) pairs of archive members read from the index instead of the archive itself. The size
+    of the archive (archive_size if given, e.g. the total of a volume set) is checked against the one recorded in the
+    index once all members are read.
+    """
+    archive_size = archive_size if archive_size is not None else os.path.getsize(archive_path)
+    trailer = dict()
+    for entry in iter_index(get_index_path(archive_path), trailer):
+        yield entry.name, entry.mtime
+    if archive_size != trailer["archive_size"]:
+        raise ArchiveIndexError("Archive size " + str(archive_size) + " doesn't match the indexed size " + \
+                         str(trailer["archive_size"]) + ": " + archive_path)
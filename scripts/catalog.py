@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import time
+import sqlite3
+import datetime
+import logging
+import threading
+
+import fileutils
+
+DATE_FORMAT = "%Y-%m-%d %H:%M"
+#snapshots of a chunk store target (#chunkstore.SNAPSHOTS_DIR), not imported to keep the catalog light at start-up
+SNAPSHOTS_DIR = "snapshots"
+SCHEMA = [
+    "CREATE TABLE IF NOT EXISTS archives (path TEXT PRIMARY KEY, target TEXT NOT NULL, created TEXT NOT NULL, "
+    "kind TEXT, size INTEGER, digest TEXT, base TEXT)",
+    "CREATE INDEX IF NOT EXISTS archives_target_created ON archives (target, created)",
+    "CREATE TABLE IF NOT EXISTS targets (target TEXT PRIMARY KEY, signature TEXT, synced REAL)",
+]
+
+
+class Catalog:
+    """
+    Persistent SQLite catalog of archives in target directories. Lookups are answered from the catalog, a target is
+    only re-scanned (with the scanner function returning a list of (path, datetime, kind) tuples) when its directory
+    changed behind the catalog's back. Safe to use from several threads.
+    """
+    def __init__(self, db_path, scanner):
+        self.db_path = db_path
+        self.scanner = scanner
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        with self.connection:
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_archives(self, target):
+        """
+        Returns a dict with archive paths in the target as keys and their creation dates as values.
+        """
+        target = os.path.abspath(target)
+        with self.lock:
+            self.sync_if_needed(target)
+            rows = self.connection.execute("SELECT path, created FROM archives WHERE target = ?", (target,)).fetchall()
+            if not all(fileutils.archive_exists(path) for path, created in rows):
+                #an archive was removed behind the catalog's back
+                self.sync(target)
+                rows = self.connection.execute("SELECT path, created FROM archives WHERE target = ?",
+                                               (target,)).fetchall()
+        return dict((path, datetime.datetime.strptime(created, DATE_FORMAT)) for path, created in rows)
+
+    def get_newest_archive(self, target, sync=True):
+        """
+        Returns path of the newest archive in the target or None. Without sync the newest archive recorded in the
+        catalog is returned as long as it still exists, even if newer ones were added behind the catalog's back.
+        """
+        target = os.path.abspath(target)
+        with self.lock:
+            if sync:
+                self.sync_if_needed(target)
+            row = self.connection.execute("SELECT path FROM archives WHERE target = ? ORDER BY created DESC LIMIT 1",
+                                          (target,)).fetchone()
+            if row and not fileutils.archive_exists(row[0]):
+                #archive was removed behind the catalog's back
+                self.sync(target)
+                row = self.connection.execute("SELECT path FROM archives WHERE target = ? ORDER BY created DESC "
+                                              "LIMIT 1", (target,)).fetchone()
+        return row[0] if row else None
+
+    def add_archive(self, path, target, created, kind=None, base=None):
+        """
+        Records a newly written archive.
+        """
+        path = os.path.abspath(path)
+        target = os.path.abspath(target)
+        with self.lock:
+            #a known target is trusted, an unknown one is scanned first so that its older archives aren't missed
+            if self.connection.execute("SELECT 1 FROM targets WHERE target = ?", (target,)).fetchone() is None:
+                self.sync(target)
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                    (path, target, created.strftime(DATE_FORMAT), kind) + describe_archive(path) + (base,))
+            self.update_signature(target)
+
+    def remove_archive(self, path):
+        """
+        Forgets a removed archive.
+        """
+        path = os.path.abspath(path)
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT target FROM archives WHERE path = ?", (path,)).fetchone()
+            if row:
+                self.connection.execute("DELETE FROM archives WHERE path = ?", (path,))
+                self.update_signature(row[0])
+
+    def sync_if_needed(self, target):
+        row = self.connection.execute("SELECT signature FROM targets WHERE target = ?", (target,)).fetchone()
+        if row is None or row[0] != get_signature(target):
+            self.sync(target)
+
+    def sync(self, target):
+        """
+        Re-scans the target and replaces its catalog records with what is found on the filesystem.
+        """
+        logging.info("Synchronizing archive catalog with target: " + target)
+        archives = self.scanner(target) if os.path.isdir(target) else []
+        with self.lock, self.connection:
+            known = dict(self.connection.execute("SELECT path, base FROM archives WHERE target = ?", (target,)).fetchall())
+            self.connection.execute("DELETE FROM archives WHERE target = ?", (target,))
+            for path, created, kind in archives:
+                path = os.path.abspath(path)
+                self.connection.execute("INSERT OR REPLACE INTO archives VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                        (path, target, created.strftime(DATE_FORMAT), kind) + describe_archive(path) + \
+                                        (known.get(path),))
+            self.update_signature(target)
+
+    def update_signature(self, target):
+        self.connection.execute("INSERT OR REPLACE INTO targets VALUES (?, ?, ?)", (target, get_signature(target), time.time()))
+
+
+def describe_archive(path):
+    """
+    Returns a tuple (size, digest) of an archive, digest is read from its sidecar if there is one.
+    """
+    size = fileutils.get_archive_size(path) if fileutils.archive_exists(path) else None
+    digest = fileutils.find_digest_file(path)
+    return size, (digest[0] + ":" + digest[1]) if digest else None
+
+
+def get_archive_dirs(target):
+    """
+    Returns the directories of a target archives are kept in: the target itself and the snapshots directory if the
+    target is a chunk store. Chunks (and any other subdirectories) are never looked into.
+    """
+    archive_dirs = [target]
+    snapshots_dir = os.path.join(target, SNAPSHOTS_DIR)
+    if os.path.isdir(snapshots_dir):
+        archive_dirs.append(snapshots_dir)
+    return archive_dirs
+
+
+def get_signature(target):
+    """
+    Cheap fingerprint of a target: inodes and modification times of its archive directories (see #get_archive_dirs()),
+    which change whenever an archive is added, renamed or removed.
+    """
+    if not os.path.isdir(target):
+        return None
+    parts = []
+    for dir_path in get_archive_dirs(target):
+        st = os.stat(dir_path)
+        parts.append(os.path.basename(dir_path) + "=" + str(st.st_ino) + ":" + str(st.st_mtime_ns))
+    return ",".join(parts)
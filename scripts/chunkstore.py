@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import re
+import stat
+import gzip
+import json
+import zlib
+import fcntl
+import random
+import contextlib
+import hashlib
+import datetime
+import logging
+import importlib.util
+
+import walker
+from lazyimport import LazyModule
+
+#numpy is optional, chunk boundaries are found with a vectorized gear hash if it's installed
+numpy = LazyModule("numpy") if importlib.util.find_spec("numpy") else None
+
+#Layout of a chunk store: <root>/chunks/<2 first hex chars>/<sha256 of chunk> and <root>/snapshots/<name>-<date>.snapshot
+CHUNKS_DIR = "chunks"
+SNAPSHOTS_DIR = "snapshots"
+SNAPSHOT_SUFFIX = ".snapshot"
+#Backups hold a shared lock on <root>/lock while writing chunks and their snapshot, garbage collection an exclusive one
+LOCK_FILE = "lock"
+SNAPSHOT_VERSION = 1
+DEFAULT_CHUNK_SIZE = 1024 * 1024
+COMPRESSION_LEVEL = 6
+
+#Chunk files start with a marker telling if the payload is zlib compressed or stored as is (incompressible data)
+CHUNK_COMPRESSED = b"z"
+CHUNK_STORED = b"s"
+
+#Gear hash table, it must never change or chunk boundaries (and thus deduplication) of existing stores would shift
+_gear_random = random.Random(0x5245584244)
+GEAR = [_gear_random.getrandbits(64) for i in range(256)]
+HASH_MASK = 0xFFFFFFFFFFFFFFFF
+#Bytes hashed at once by the vectorized gear hash at most (and at least), boundaries are looked for stride by stride
+GEAR_STRIDE = 256 * 1024
+MIN_GEAR_STRIDE = 4 * 1024
+_gear_array = None
+
+
+class ChunkStoreError(Exception):
+     """
+     Abstract chunk store error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+def find_chunk_boundary(data, start, end, min_size, mask):
+    """
+    Returns the position of a content defined chunk boundary in data[start:end] using a gear rolling hash. A boundary
+    is found where the top bits of the hash selected by the mask are all zero, but never closer than min_size to start.
+    end is returned if there is no such position. Vectorized with numpy if it's installed, both ways find the same
+    boundaries.
+    """
+    if numpy is not None:
+        return find_chunk_boundary_vectorized(data, start, end, min_size, mask)
+    #gear hash only depends on the last 64 bytes, so hashing can start right before the minimal chunk size
+    pos = start + max(0, min_size - 64)
+    if pos >= end:
+        return end
+    cut = start + min_size
+    h = 0
+    gear = GEAR
+    for b in data[pos:end]:
+        h = ((h << 1) + gear[b]) & HASH_MASK
+        pos += 1
+        if not h & mask and pos >= cut:
+            return pos
+    return end
+
+
+def find_chunk_boundary_vectorized(data, start, end, min_size, mask):
+    """
+    #find_chunk_boundary() computing the hashes of GEAR_STRIDE bytes at once with numpy. The hash after byte i is the
+    sum of GEAR[data[i - k]] << k over the last 64 bytes (k < 64), which is summed up in six doubling steps: hashes over
+    the last 2m bytes are the ones over the last m bytes plus the ones m bytes before shifted by m.
+    """
+    global _gear_array
+    if _gear_array is None:
+        _gear_array = numpy.array(GEAR, dtype=numpy.uint64)
+    cut = start + min_size
+    if cut >= end:
+        return end
+    hash_mask = numpy.uint64(mask)
+    #a boundary is expected every 2^bits bytes past the minimal chunk size, strides hash about twice as much
+    bits = 64 - (mask & -mask).bit_length() + 1
+    stride = max(MIN_GEAR_STRIDE, min(GEAR_STRIDE, 2 << bits))
+    #index of the byte whose hash is looked at first, the 63 bytes before it are hashed along
+    pos = max(start, cut - 1)
+    while pos < end:
+        stride_end = min(end, pos + stride)
+        window_start = max(start, pos - 63)
+        h = _gear_array[numpy.frombuffer(data, numpy.uint8, stride_end - window_start, window_start)]
+        for shift in (1, 2, 4, 8, 16, 32):
+            h[shift:] += h[:-shift] << numpy.uint64(shift)
+        found = numpy.flatnonzero((h[pos - window_start:] & hash_mask) == 0)
+        if found.size:
+            return pos + int(found[0]) + 1
+        pos = stride_end
+    return end
+
+
+def split_chunks(fileobj, avg_size=DEFAULT_CHUNK_SIZE):
+    """
+    Reads fileobj and yields its content in content defined chunks of avg_size bytes on average (between a quarter and
+    four times of it). Inserting or removing data only changes the chunks around the modification.
+    """
+    min_size = max(64, avg_size // 4)
+    max_size = avg_size * 4
+    bits = max(1, int(avg_size - min_size).bit_length() - 1)
+    mask = ((1 << bits) - 1) << (64 - bits)
+
+    buf = b""
+    eof = False
+    while True:
+        if not eof and len(buf) < max_size:
+            data = fileobj.read(max_size * 2)
+            eof = not data
+            buf += data
+            continue
+        if not buf:
+            return
+        boundary = find_chunk_boundary(buf, 0, min(len(buf), max_size), min_size, mask)
+        yield buf[:boundary]
+        buf = buf[boundary:]
+
+
+class ChunkStore:
+    """
+    Content addressed store of compressed chunks. Every unique chunk is stored only once.
+    """
+    def __init__(self, root, avg_chunk_size=DEFAULT_CHUNK_SIZE, throttle=None):
+        self.root = root
+        self.throttle = throttle
+        self.avg_chunk_size = int(avg_chunk_size) if avg_chunk_size else DEFAULT_CHUNK_SIZE
+        self.chunks_dir = os.path.join(root, CHUNKS_DIR)
+        self.snapshots_dir = os.path.join(root, SNAPSHOTS_DIR)
+        self.known_chunks = set()
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.files = 0
+        self.reused_files = 0
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False, blocking=True):
+        """
+        Context manager locking the store: backups share it, garbage collection needs it exclusively so that it never
+        removes chunks written by a backup whose snapshot isn't saved yet. Yields False if the lock isn't free and
+        blocking is off.
+        """
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, LOCK_FILE), "a") as f:
+            try:
+                mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+                fcntl.flock(f.fileno(), mode if blocking else mode | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def get_chunk_path(self, chunk_id):
+        return os.path.join(self.chunks_dir, chunk_id[:2], chunk_id)
+
+    def put_chunk(self, data):
+        """
+        Stores a chunk unless it is already in the store. Returns its id.
+        """
+        chunk_id = hashlib.sha256(data).hexdigest()
+        if chunk_id in self.known_chunks:
+            return chunk_id
+        chunk_path = self.get_chunk_path(chunk_id)
+        if not os.path.exists(chunk_path):
+            compressed = zlib.compress(data, COMPRESSION_LEVEL)
+            payload = CHUNK_COMPRESSED + compressed if len(compressed) < len(data) else CHUNK_STORED + data
+            if not os.path.isdir(os.path.dirname(chunk_path)):
+                os.makedirs(os.path.dirname(chunk_path), exist_ok=True)
+            part_path = chunk_path + ".part"
+            if self.throttle:
+                self.throttle.write(len(payload))
+            with open(part_path, "wb") as f:
+                f.write(payload)
+            os.replace(part_path, chunk_path)
+            self.bytes_written += len(payload)
+        self.known_chunks.add(chunk_id)
+        return chunk_id
+
+    def get_chunk(self, chunk_id):
+        """
+        Reads a chunk and verifies its content against its id.
+        """
+        with open(self.get_chunk_path(chunk_id), "rb") as f:
+            payload = f.read()
+        data = zlib.decompress(payload[1:]) if payload[:1] == CHUNK_COMPRESSED else payload[1:]
+        if hashlib.sha256(data).hexdigest() != chunk_id:
+            raise ChunkStoreError("Chunk is corrupted: " + chunk_id)
+        return data
+
+    def store_file(self, file_path):
+        """
+        Splits a file into chunks, stores them and returns the list of chunk ids.
+        """
+        chunks = []
+        with open(file_path, "rb") as f:
+            for data in split_chunks(f, self.avg_chunk_size):
+                self.bytes_read += len(data)
+                if self.throttle:
+                    self.throttle.read(len(data))
+                chunks.append(self.put_chunk(data))
+        return chunks
+
+    def backup_dir(self, dir_path, file_filter=None):
+        """
+        Stores all files of dir_path which aren't excluded by the file_filter and records them in a new snapshot.
+        Files whose size, mtime and inode match the newest snapshot of the source aren't read again, their chunk lists
+        are taken over from that snapshot. Returns the snapshot path.
+        """
+        with self.lock():
+            previous = dict()
+            previous_path = self.find_newest_snapshot(os.path.basename(dir_path))
+            if previous_path:
+                previous = dict((entry["name"], entry) for entry in read_snapshot(previous_path) if "chunks" in entry)
+            entries = []
+            for walk_entry in walker.walk(dir_path, sort=True, file_filter=file_filter):
+                st = walk_entry.stat
+                entry = {"name": walk_entry.key, "mode": st.st_mode, "mtime": st.st_mtime, "size": st.st_size}
+                try:
+                    if walk_entry.is_link:
+                        entry["link"] = os.readlink(walk_entry.path)
+                    elif stat.S_ISREG(st.st_mode):
+                        entry["ino"] = st.st_ino
+                        old_entry = previous.get(walk_entry.key)
+                        if old_entry and (old_entry["size"], old_entry["mtime"], old_entry.get("ino")) == \
+                                (st.st_size, st.st_mtime, st.st_ino):
+                            entry["chunks"] = old_entry["chunks"]
+                            self.reused_files += 1
+                        else:
+                            entry["chunks"] = self.store_file(walk_entry.path)
+                except FileNotFoundError:
+                    logging.warning("File disappeared before it could be stored: " + walk_entry.key)
+                    continue
+                entries.append(entry)
+                self.files += 1
+
+            if not os.path.isdir(self.snapshots_dir):
+                os.makedirs(self.snapshots_dir)
+            snapshot_name = os.path.basename(dir_path) + "-" + datetime.datetime.now().strftime("%Y%m%d%H%M") + \
+                            SNAPSHOT_SUFFIX
+            snapshot_path = os.path.join(self.snapshots_dir, snapshot_name)
+            part_path = snapshot_path + ".part"
+            with gzip.open(part_path, "wt", encoding="utf-8") as f:
+                json.dump({"version": SNAPSHOT_VERSION, "source": dir_path, "entries": entries}, f)
+            os.replace(part_path, snapshot_path)
+        return snapshot_path
+
+    def find_newest_snapshot(self, name):
+        """
+        Returns path of the newest snapshot of the source with the given name (None if there is none).
+        """
+        if not os.path.isdir(self.snapshots_dir):
+            return None
+        pattern = re.compile("^" + re.escape(name) + "-(\\d+)" + re.escape(SNAPSHOT_SUFFIX) + "$")
+        snapshots = [n for n in os.listdir(self.snapshots_dir) if pattern.match(n)]
+        if not snapshots:
+            return None
+        return os.path.join(self.snapshots_dir, max(snapshots, key=lambda n: pattern.match(n).group(1)))
+
+    def restore_snapshot(self, snapshot_path, dir_path):
+        """
+        Recreates the files recorded in a snapshot under dir_path.
+        """
+        for entry in read_snapshot(snapshot_path):
+            target = os.path.join(dir_path, entry["name"][2:])
+            if stat.S_ISDIR(entry["mode"]):
+                os.makedirs(target, exist_ok=True)
+            elif "link" in entry:
+                os.symlink(entry["link"], target)
+            elif "chunks" in entry:
+                with open(target, "wb") as f:
+                    for chunk_id in entry["chunks"]:
+                        f.write(self.get_chunk(chunk_id))
+                os.chmod(target, stat.S_IMODE(entry["mode"]))
+                os.utime(target, (entry["mtime"], entry["mtime"]))
+
+    def get_missing_chunks(self, snapshot_path):
+        """
+        Returns ids of chunks which are referenced by a snapshot but can't be found in the store.
+        """
+        missing = []
+        for entry in read_snapshot(snapshot_path):
+            for chunk_id in entry.get("chunks", []):
+                if chunk_id not in self.known_chunks and not os.path.isfile(self.get_chunk_path(chunk_id)):
+                    missing.append(chunk_id)
+        return missing
+
+    def collect_garbage(self):
+        """
+        Removes chunks which aren't referenced by any snapshot left in the store. Returns the number of removed chunks.
+        Nothing is removed while a backup is writing into the store, the next rotation collects the garbage then.
+        """
+        with self.lock(exclusive=True, blocking=False) as locked:
+            if not locked:
+                logging.info("Chunk store " + self.root + " is being backed up to, skipping garbage collection")
+                return 0
+            return self.remove_unreferenced_chunks()
+
+    def remove_unreferenced_chunks(self):
+        referenced = set()
+        if os.path.isdir(self.snapshots_dir):
+            for name in os.listdir(self.snapshots_dir):
+                if name.endswith(SNAPSHOT_SUFFIX):
+                    for entry in read_snapshot(os.path.join(self.snapshots_dir, name)):
+                        referenced.update(entry.get("chunks", []))
+
+        removed = 0
+        if os.path.isdir(self.chunks_dir):
+            for entry in walker.walk(self.chunks_dir, with_stat=False):
+                if not entry.is_dir and entry.name not in referenced:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+
+def read_snapshot(snapshot_path):
+    """
+    Returns the list of entries recorded in a snapshot.
+    """
+    with gzip.open(snapshot_path, "rt", encoding="utf-8") as f:
+        return json.load(f)["entries"]
+
+
+def get_snapshot_members(snapshot_path):
+    """
+    Returns (name, mtime) pairs of the snapshot entries, like the ones read from a tar archive.
+    """
+    return [(entry["name"], entry["mtime"]) for entry in read_snapshot(snapshot_path)]
@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+
+import os
+import zlib
+import importlib.util
+
+from lazyimport import LazyModule
+
+#codec modules are imported on first use
+gzip = LazyModule("gzip")
+lzma = LazyModule("lzma")
+pgzip = LazyModule("pgzip")
+
+#zstd and lz4 are optional, the codecs are only available if the packages are installed
+zstandard = LazyModule("zstandard") if importlib.util.find_spec("zstandard") else None
+lz4frame = LazyModule("lz4.frame") if importlib.util.find_spec("lz4") else None
+
+CODEC_GZIP = "gzip"
+CODEC_PARALLEL_GZIP = "pgzip"
+CODEC_XZ = "xz"
+CODEC_ZSTD = "zstd"
+CODEC_LZ4 = "lz4"
+
+#Archive extensions (<name>-<date>.tar<extension>) and default levels of the codecs
+EXTENSIONS = {CODEC_GZIP: ".gz", CODEC_PARALLEL_GZIP: ".gz", CODEC_XZ: ".xz", CODEC_ZSTD: ".zst", CODEC_LZ4: ".lz4"}
+DEFAULT_LEVELS = {CODEC_GZIP: 9, CODEC_PARALLEL_GZIP: 9, CODEC_XZ: 6, CODEC_ZSTD: 3, CODEC_LZ4: 0}
+#Stored frames of xz, zstd and lz4 put incompressible content into the uncompressed blocks of the codec: LZMA2
+#uncompressed chunks (one xz block, CRC32 check), raw zstd blocks, lz4 blocks with the uncompressed flag
+STORED_BLOCK_SIZES = {CODEC_XZ: 64 * 1024, CODEC_ZSTD: 128 * 1024, CODEC_LZ4: 64 * 1024}
+XZ_STREAM_FLAGS = b"\x00\x01"
+XZ_STREAM_HEADER = b"\xfd7zXZ\x00" + XZ_STREAM_FLAGS + zlib.crc32(XZ_STREAM_FLAGS).to_bytes(4, "little")
+#block header of 12 bytes: a single LZMA2 filter with a 64 KiB dictionary, no sizes, padding
+XZ_BLOCK_HEADER_BODY = b"\x02\x00\x21\x01\x08\x00\x00\x00"
+XZ_BLOCK_HEADER = XZ_BLOCK_HEADER_BODY + zlib.crc32(XZ_BLOCK_HEADER_BODY).to_bytes(4, "little")
+#frame header without content size, the window (128 KiB) holds a whole raw block
+ZSTD_FRAME_HEADER = b"\x28\xb5\x2f\xfd\x00\x38"
+#frame header of independent 64 KiB blocks without checksums, the last byte is the header checksum
+LZ4_FRAME_HEADER = b"\x04\x22\x4d\x18\x60\x40\x82"
+MAGIC_NUMBERS = [(b"\x1f\x8b", CODEC_GZIP), (b"\xfd7zXZ\x00", CODEC_XZ), (b"\x28\xb5\x2f\xfd", CODEC_ZSTD),
+                 (b"\x04\x22\x4d\x18", CODEC_LZ4)]
+
+#Files with these extensions are compressed already and stored as they are, others are sampled
+INCOMPRESSIBLE_EXTENSIONS = set([".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".avi", ".mov",
+                                 ".zip", ".gz", ".tgz", ".bz2", ".xz", ".zst", ".lz4", ".7z", ".rar", ".jar", ".docx",
+                                 ".xlsx", ".pptx", ".pdf"])
+SAMPLE_SIZE = 64 * 1024
+#Files whose sample doesn't compress below this ratio are stored
+STORE_RATIO = 0.95
+#Smaller files aren't worth a codec switch
+MIN_STORE_SIZE = 256 * 1024
+
+
+class CompressorError(Exception):
+     """
+     Abstract compression codec error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+def encode_xz_integer(value):
+    data = bytearray()
+    while value >= 0x80:
+        data.append(value & 0x7f | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+class StoredFrame:
+    """
+    Frame of xz, zstd or lz4 holding data as is in the uncompressed blocks of the codec, so stored content costs no
+    compression at all and is still read by the usual decoders. Used like the compressors of the codecs: begin()
+    returns the frame header, compress(data) complete blocks and flush() the rest and the end of the frame.
+    """
+    def __init__(self, codec):
+        self.codec = codec
+        self.block_size = STORED_BLOCK_SIZES[codec]
+        self.pending = bytearray()
+        self.size = 0
+        self.data_size = 0
+        self.crc = 0
+
+    def begin(self):
+        if self.codec == CODEC_XZ:
+            return XZ_STREAM_HEADER + XZ_BLOCK_HEADER
+        return ZSTD_FRAME_HEADER if self.codec == CODEC_ZSTD else LZ4_FRAME_HEADER
+
+    def compress(self, data):
+        self.pending += data
+        return self.encode_blocks(len(self.pending) - len(self.pending) % self.block_size)
+
+    def encode_blocks(self, size):
+        blocks = []
+        for offset in range(0, size, self.block_size):
+            block = bytes(self.pending[offset:min(size, offset + self.block_size)])
+            if self.codec == CODEC_XZ:
+                #the first chunk resets the dictionary
+                blocks.append((b"\x01" if self.size == 0 else b"\x02") + (len(block) - 1).to_bytes(2, "big"))
+                self.crc = zlib.crc32(block, self.crc)
+                self.data_size += 3 + len(block)
+            elif self.codec == CODEC_ZSTD:
+                blocks.append((len(block) << 3).to_bytes(3, "little"))
+            else:
+                blocks.append((len(block) | 0x80000000).to_bytes(4, "little"))
+            blocks.append(block)
+            self.size += len(block)
+        del self.pending[:size]
+        return b"".join(blocks)
+
+    def flush(self):
+        data = self.encode_blocks(len(self.pending))
+        if self.codec == CODEC_ZSTD:
+            #empty last raw block
+            return data + b"\x01\x00\x00"
+        if self.codec == CODEC_LZ4:
+            return data + b"\x00\x00\x00\x00"
+        #end of the LZMA2 data, block padding and check, index and stream footer
+        self.data_size += 1
+        block_size = len(XZ_BLOCK_HEADER) + self.data_size
+        data += b"\x00" + b"\x00" * (-block_size % 4) + self.crc.to_bytes(4, "little")
+        index = b"\x00" + encode_xz_integer(1) + encode_xz_integer(block_size + 4) + encode_xz_integer(self.size)
+        index += b"\x00" * (-len(index) % 4)
+        index += zlib.crc32(index).to_bytes(4, "little")
+        footer = (len(index) // 4 - 1).to_bytes(4, "little") + XZ_STREAM_FLAGS
+        return data + index + zlib.crc32(footer).to_bytes(4, "little") + footer + b"YZ"
+
+
+class FrameWriter:
+    """
+    Write-only file object compressing into fileobj with codecs whose frames can simply be concatenated (xz, zstd,
+    lz4). Storing incompressible content ends the current frame and continues with a StoredFrame.
+    If seek_interval is given a new frame is started every seek_interval bytes and on_seek_point(offset,
+    compressed_offset, b"") is called for it, decompression can start at any frame. Closing the writer doesn't close the
+    underlying fileobj.
+    """
+    def __init__(self, fileobj, codec, level, workers=None, seek_interval=None, on_seek_point=None):
+        self.fileobj = fileobj
+        self.codec = codec
+        self.level = level
+        self.workers = workers
+        self.store = False
+        self.size = 0
+        self.compressed_size = 0
+        self.seek_interval = seek_interval if on_seek_point else None
+        self.on_seek_point = on_seek_point
+        self.next_seek_point = seek_interval
+        self.compressor = None
+        self.begin_frame()
+        if self.seek_interval:
+            on_seek_point(0, 0, b"")
+
+    def begin_frame(self):
+        if self.store:
+            compressor = StoredFrame(self.codec)
+            self.write_compressed(compressor.begin())
+            self.compressor = (compressor.compress, compressor.flush)
+        elif self.codec == CODEC_XZ:
+            compressor = lzma.LZMACompressor(preset=self.level)
+            self.compressor = (compressor.compress, compressor.flush)
+        elif self.codec == CODEC_ZSTD:
+            compressor = zstandard.ZstdCompressor(level=self.level, threads=self.workers or 0).compressobj()
+            self.compressor = (compressor.compress, compressor.flush)
+        elif self.codec == CODEC_LZ4:
+            compressor = lz4frame.LZ4FrameCompressor(compression_level=self.level)
+            self.write_compressed(compressor.begin())
+            self.compressor = (compressor.compress, compressor.flush)
+
+    def end_frame(self):
+        self.write_compressed(self.compressor[1]())
+
+    def write_compressed(self, data):
+        self.fileobj.write(data)
+        self.compressed_size += len(data)
+
+    def set_store(self, store):
+        if store != self.store:
+            self.end_frame()
+            self.store = store
+            self.begin_frame()
+
+    def write(self, data):
+        written = len(data)
+        while self.seek_interval and self.size + len(data) >= self.next_seek_point:
+            #the frame is cut exactly at the seek point
+            head = self.next_seek_point - self.size
+            self.size += head
+            self.write_compressed(self.compressor[0](data[:head]))
+            data = data[head:]
+            self.end_frame()
+            compressed_offset = self.compressed_size
+            self.begin_frame()
+            self.on_seek_point(self.size, compressed_offset, b"")
+            self.next_seek_point = self.size + self.seek_interval
+        self.size += len(data)
+        self.write_compressed(self.compressor[0](data))
+        return written
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def close(self):
+        if self.compressor:
+            self.end_frame()
+            self.compressor = None
+            self.fileobj.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+
+
+def is_available(codec):
+    if codec == CODEC_ZSTD:
+        return zstandard is not None
+    if codec == CODEC_LZ4:
+        return lz4frame is not None
+    return codec in EXTENSIONS
+
+
+def get_extension(codec):
+    if codec not in EXTENSIONS:
+        raise CompressorError("Unsupported compression mode: " + str(codec))
+    return EXTENSIONS[codec]
+
+
+def open_writer(fileobj, codec, level=None, name="", workers=None, block_size=None, seek_interval=None,
+                on_seek_point=None):
+    """
+    Returns a write-only file object compressing into fileobj with the codec. All writers support set_store(bool) which
+    switches between the configured level and storing incompressible content. If seek_interval is given,
+    on_seek_point(offset, compressed_offset, window) is called every seek_interval bytes or so with a position
+    decompression can start at using #open_seek_reader().
+    """
+    if not is_available(codec):
+        raise CompressorError("Compression mode is not supported or its package isn't installed: " + str(codec))
+    level = level if level is not None else DEFAULT_LEVELS[codec]
+    if codec in (CODEC_GZIP, CODEC_PARALLEL_GZIP):
+        #plain gzip is the same block writer with a single worker, it still produces a standard gzip stream
+        return pgzip.ParallelGzipWriter(fileobj, name, level, block_size or pgzip.DEFAULT_BLOCK_SIZE,
+                                        workers if codec == CODEC_PARALLEL_GZIP else 1, seek_interval, on_seek_point)
+    return FrameWriter(fileobj, codec, level, workers, seek_interval, on_seek_point)
+
+
+def detect_codec(header):
+    for magic, codec in MAGIC_NUMBERS:
+        if header.startswith(magic):
+            return codec
+    return None
+
+
+class PeekReader:
+    """
+    Read-only file object which lets the first bytes of a stream be inspected without consuming them.
+    """
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.peeked = b""
+
+    def peek(self, size):
+        while len(self.peeked) < size:
+            data = self.fileobj.read(size - len(self.peeked))
+            if not data:
+                break
+            self.peeked += data
+        return self.peeked
+
+    def read(self, size=-1):
+        if self.peeked:
+            data = self.peeked if size is None or size < 0 else self.peeked[:size]
+            self.peeked = self.peeked[len(data):]
+            if size is None or size < 0:
+                return data + self.fileobj.read()
+            return data
+        return self.fileobj.read(size)
+
+
+def open_reader(fileobj):
+    """
+    Returns a read-only file object decompressing fileobj, the codec is detected from its magic number. Concatenated
+    frames are read as one stream.
+    """
+    reader = PeekReader(fileobj)
+    codec = detect_codec(reader.peek(6))
+    if codec == CODEC_GZIP:
+        return gzip.GzipFile(fileobj=reader, mode="rb")
+    if codec == CODEC_XZ:
+        return lzma.LZMAFile(reader, "rb")
+    if codec == CODEC_ZSTD and zstandard is not None:
+        return zstandard.ZstdDecompressor().stream_reader(reader, read_across_frames=True)
+    if codec == CODEC_LZ4 and lz4frame is not None:
+        return lz4frame.LZ4FrameFile(reader, "rb")
+    raise CompressorError("Unknown or unsupported archive compression")
+
+
+def open_seek_reader(fileobj, codec, compressed_offset, window=b""):
+    """
+    Returns a read-only file object decompressing a seekable fileobj from a seek point reported by a writer of
+    #open_writer() onwards. codec is the one detected from the start of the archive.
+    """
+    fileobj.seek(compressed_offset)
+    if codec in (CODEC_GZIP, CODEC_PARALLEL_GZIP):
+        return pgzip.InflateReader(fileobj, window)
+    #frames of the other codecs start with their magic number
+    return open_reader(fileobj)
+
+
+def is_incompressible(fileobj, name):
+    """
+    Decides if a file is compressed already by its extension or by how well a sample of it compresses. The file
+    position is restored.
+    """
+    if os.path.splitext(name)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    position = fileobj.tell()
+    sample = fileobj.read(SAMPLE_SIZE)
+    fileobj.seek(position)
+    return len(sample) > 0 and len(zlib.compress(sample, 1)) >= len(sample) * STORE_RATIO
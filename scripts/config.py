@@ -17,58 +17,128 @@
 __author__ = "Denys Sobchyshak"
 __email__ = "denys.sobchyshak@gmail.com"
 
-from xml.dom.minidom import parse
+import os
+import pickle
+import logging
 
 class RexConfig:
     """
     Contains script configuration parameters.
     """
-    def __init__(self, reporterConfig=None, backups=None, performChecks=True, performReporting=False):
+    def __init__(self, reporterConfig=None, backups=None, performChecks=True, performReporting=False, maxWorkers=1,
+                 maxJobsPerTarget=1, metricsFile=None, metricsHistory=100, prometheusFile=None, readLimit=None,
+                 writeLimit=None, bandwidthProfile=None, niceness=None, ioClass=None, ioPriority=None,
+                 daemonInterval=60, pollInterval=300, jobOrder='longest-first', backupWindow=0, windowAction='warn'):
         self.backups=backups
         self.performChecks = performChecks
         self.performReporting = performReporting
         self.reporterConfig = reporterConfig
+        self.maxWorkers = maxWorkers
+        self.maxJobsPerTarget = maxJobsPerTarget
+        self.metricsFile = metricsFile
+        self.metricsHistory = metricsHistory
+        self.prometheusFile = prometheusFile
+        self.readLimit = readLimit
+        self.writeLimit = writeLimit
+        self.bandwidthProfile = bandwidthProfile
+        self.niceness = niceness
+        self.ioClass = ioClass
+        self.ioPriority = ioPriority
+        self.daemonInterval = daemonInterval
+        self.pollInterval = pollInterval
+        self.jobOrder = jobOrder
+        self.backupWindow = backupWindow
+        self.windowAction = windowAction
 
 class BackupConfig:
     """
     Contains backup configuration parameters.
     """
-    def __init__(self, source=None, target=None, backupDowntime='0', excludeRegexp = '', rotationPeriod=None):
+    def __init__(self, source=None, target=None, backupDowntime='0', excludeRegexp = '', rotationPeriod=None,
+                 compression='gzip', compressionWorkers=None, compressionBlockSize=None, backupMode='full',
+                 fullBackupPeriod=0, targetFormat='archive', chunkSize=None, digestAlgorithm='sha256',
+                 checkMode='index', scanThreads=1, verifyContent=False, verifyWorkers=4, verifyMaxFileSize=None,
+                 verifySample=100, verifyFullWeekday=None, staging='stream', copyChunkSize=None, copyRetries=5,
+                 copyFsync='end', readLimit=None, writeLimit=None, bandwidthProfile=None, checkMemoryLimit=None,
+                 volumeSize=None, transferWorkers=4, compressionLevel=None, storeIncompressible=True,
+                 seekPointInterval=32 * 1024 * 1024, filterRules=None, excludeFrom=None, maxFileSize=None,
+                 oneFileSystem=False, targets=None):
         self.source = source
         self.target = target
         self.excludeRegexp= excludeRegexp
         self.backupDowntime = backupDowntime
         self.rotationPeriod = rotationPeriod
+        self.compression = compression
+        self.compressionWorkers = compressionWorkers
+        self.compressionBlockSize = compressionBlockSize
+        self.backupMode = backupMode
+        self.fullBackupPeriod = fullBackupPeriod
+        self.targetFormat = targetFormat
+        self.chunkSize = chunkSize
+        self.digestAlgorithm = digestAlgorithm
+        self.checkMode = checkMode
+        self.scanThreads = scanThreads
+        self.verifyContent = verifyContent
+        self.verifyWorkers = verifyWorkers
+        self.verifyMaxFileSize = verifyMaxFileSize
+        self.verifySample = verifySample
+        self.verifyFullWeekday = verifyFullWeekday
+        self.staging = staging
+        self.copyChunkSize = copyChunkSize
+        self.copyRetries = copyRetries
+        self.copyFsync = copyFsync
+        self.readLimit = readLimit
+        self.writeLimit = writeLimit
+        self.bandwidthProfile = bandwidthProfile
+        self.checkMemoryLimit = checkMemoryLimit
+        self.volumeSize = volumeSize
+        self.transferWorkers = transferWorkers
+        self.compressionLevel = compressionLevel
+        self.storeIncompressible = storeIncompressible
+        self.seekPointInterval = seekPointInterval
+        self.filterRules = filterRules
+        self.excludeFrom = excludeFrom
+        self.maxFileSize = maxFileSize
+        self.oneFileSystem = oneFileSystem
+        self.targets = targets
 
     def __str__(self):
-        return self.__class__.__name__+"[source="+str(self.source)+",target="+str(self.target)+",downtime="+\
-               str(self.backupDowntime)+",rotationPeriod="+str(self.rotationPeriod)+"]"
+        return self.__class__.__name__+"[source="+str(self.source)+",target="+\
+               (",".join(self.targets) if self.targets else str(self.target))+",downtime="+\
+               str(self.backupDowntime)+",rotationPeriod="+str(self.rotationPeriod)+",mode="+\
+               str(self.backupMode)+"]"
 
 class ReporterConfig:
     """
     Contains reporter configuration parameters.
     """
-    def __init__(self, fromAddress=None, toAddress=None, subjectPrefix='', smtpConfig=None):
+    def __init__(self, fromAddress=None, toAddress=None, subjectPrefix='', smtpConfig=None, sendTimeout=60,
+                 sendRetries=3):
         self.fromAddress = fromAddress
         self.toAddress = toAddress
         self.subjectPrefix = subjectPrefix
         self.smtpConfig = smtpConfig
+        self.sendTimeout = sendTimeout
+        self.sendRetries = sendRetries
 
 class SmtpConfig:
     """
     Contains smtp configuration parameters.
     """
-    def __init__(self, host=None, port=None, username=None, password=None):
+    def __init__(self, host=None, port=None, username=None, password=None, timeout=30, tls=True):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.timeout = timeout
+        self.tls = tls
 
 
 def readConfig(configFilePath):
     """
     Parses provided config file and returns RexConfig object read from file.
     """
+    from xml.dom.minidom import parse
     dom = parse(configFilePath)
 
     #Filling in config values from xml ET
@@ -79,6 +149,22 @@ def readConfig(configFilePath):
         config = dom.getElementsByTagName("config")[0]
         if config.hasAttribute("perform-checks"): rexConfig.performChecks = bool(config.getAttribute("perform-checks"))
         if config.hasAttribute("perform-reporting"): rexConfig.performReporting = bool(config.getAttribute("perform-reporting"))
+        if config.hasAttribute("max-workers"): rexConfig.maxWorkers = int(config.getAttribute("max-workers"))
+        if config.hasAttribute("max-jobs-per-target"): rexConfig.maxJobsPerTarget = int(config.getAttribute("max-jobs-per-target"))
+        if config.hasAttribute("metrics-file"): rexConfig.metricsFile = str(config.getAttribute("metrics-file"))
+        if config.hasAttribute("metrics-history"): rexConfig.metricsHistory = int(config.getAttribute("metrics-history"))
+        if config.hasAttribute("prometheus-file"): rexConfig.prometheusFile = str(config.getAttribute("prometheus-file"))
+        if config.hasAttribute("read-limit"): rexConfig.readLimit = int(config.getAttribute("read-limit")) * 1024
+        if config.hasAttribute("write-limit"): rexConfig.writeLimit = int(config.getAttribute("write-limit")) * 1024
+        if config.hasAttribute("bandwidth-profile"): rexConfig.bandwidthProfile = str(config.getAttribute("bandwidth-profile"))
+        if config.hasAttribute("nice"): rexConfig.niceness = int(config.getAttribute("nice"))
+        if config.hasAttribute("io-class"): rexConfig.ioClass = str(config.getAttribute("io-class"))
+        if config.hasAttribute("io-priority"): rexConfig.ioPriority = int(config.getAttribute("io-priority"))
+        if config.hasAttribute("daemon-interval"): rexConfig.daemonInterval = int(config.getAttribute("daemon-interval"))
+        if config.hasAttribute("poll-interval"): rexConfig.pollInterval = int(config.getAttribute("poll-interval"))
+        if config.hasAttribute("job-order"): rexConfig.jobOrder = str(config.getAttribute("job-order"))
+        if config.hasAttribute("backup-window"): rexConfig.backupWindow = int(config.getAttribute("backup-window"))
+        if config.hasAttribute("window-action"): rexConfig.windowAction = str(config.getAttribute("window-action"))
 
         #Parsing configuration of backups
         rexConfig.backups = []
@@ -88,8 +174,44 @@ def readConfig(configFilePath):
             if backup.hasAttribute("backup-downtime"): backupCfg.backupDowntime = int(backup.getAttribute("backup-downtime"))
             if backup.hasAttribute("exclude-regexp"): backupCfg.excludeRegexp = str(backup.getAttribute("exclude-regexp"))
             if backup.hasAttribute("rotation-period"): backupCfg.rotationPeriod = int(backup.getAttribute("rotation-period"))
+            if backup.hasAttribute("compression"): backupCfg.compression = str(backup.getAttribute("compression"))
+            if backup.hasAttribute("compression-workers"): backupCfg.compressionWorkers = int(backup.getAttribute("compression-workers"))
+            if backup.hasAttribute("compression-block-size"): backupCfg.compressionBlockSize = int(backup.getAttribute("compression-block-size")) * 1024
+            if backup.hasAttribute("backup-mode"): backupCfg.backupMode = str(backup.getAttribute("backup-mode"))
+            if backup.hasAttribute("full-backup-period"): backupCfg.fullBackupPeriod = int(backup.getAttribute("full-backup-period"))
+            if backup.hasAttribute("target-format"): backupCfg.targetFormat = str(backup.getAttribute("target-format"))
+            if backup.hasAttribute("chunk-size"): backupCfg.chunkSize = int(backup.getAttribute("chunk-size")) * 1024
+            if backup.hasAttribute("digest-algorithm"): backupCfg.digestAlgorithm = str(backup.getAttribute("digest-algorithm"))
+            if backup.hasAttribute("check-mode"): backupCfg.checkMode = str(backup.getAttribute("check-mode"))
+            if backup.hasAttribute("scan-threads"): backupCfg.scanThreads = int(backup.getAttribute("scan-threads"))
+            if backup.hasAttribute("verify-content"): backupCfg.verifyContent = bool(backup.getAttribute("verify-content"))
+            if backup.hasAttribute("verify-workers"): backupCfg.verifyWorkers = int(backup.getAttribute("verify-workers"))
+            if backup.hasAttribute("verify-max-file-size"): backupCfg.verifyMaxFileSize = int(backup.getAttribute("verify-max-file-size")) * 1024 * 1024
+            if backup.hasAttribute("verify-sample"): backupCfg.verifySample = float(backup.getAttribute("verify-sample"))
+            if backup.hasAttribute("verify-full-weekday"): backupCfg.verifyFullWeekday = int(backup.getAttribute("verify-full-weekday"))
+            if backup.hasAttribute("staging"): backupCfg.staging = str(backup.getAttribute("staging"))
+            if backup.hasAttribute("copy-chunk-size"): backupCfg.copyChunkSize = int(backup.getAttribute("copy-chunk-size")) * 1024 * 1024
+            if backup.hasAttribute("copy-retries"): backupCfg.copyRetries = int(backup.getAttribute("copy-retries"))
+            if backup.hasAttribute("copy-fsync"): backupCfg.copyFsync = str(backup.getAttribute("copy-fsync"))
+            if backup.hasAttribute("read-limit"): backupCfg.readLimit = int(backup.getAttribute("read-limit")) * 1024
+            if backup.hasAttribute("write-limit"): backupCfg.writeLimit = int(backup.getAttribute("write-limit")) * 1024
+            if backup.hasAttribute("bandwidth-profile"): backupCfg.bandwidthProfile = str(backup.getAttribute("bandwidth-profile"))
+            if backup.hasAttribute("check-memory-limit"): backupCfg.checkMemoryLimit = int(backup.getAttribute("check-memory-limit")) * 1024 * 1024
+            if backup.hasAttribute("volume-size"): backupCfg.volumeSize = int(backup.getAttribute("volume-size")) * 1024 * 1024
+            if backup.hasAttribute("transfer-workers"): backupCfg.transferWorkers = int(backup.getAttribute("transfer-workers"))
+            if backup.hasAttribute("compression-level"): backupCfg.compressionLevel = int(backup.getAttribute("compression-level"))
+            if backup.hasAttribute("store-incompressible"): backupCfg.storeIncompressible = bool(backup.getAttribute("store-incompressible"))
+            if backup.hasAttribute("seek-point-interval"): backupCfg.seekPointInterval = int(backup.getAttribute("seek-point-interval")) * 1024 * 1024
+            if backup.hasAttribute("exclude-from"): backupCfg.excludeFrom = str(backup.getAttribute("exclude-from"))
+            if backup.hasAttribute("max-file-size"): backupCfg.maxFileSize = int(backup.getAttribute("max-file-size")) * 1024 * 1024
+            if backup.hasAttribute("one-file-system"): backupCfg.oneFileSystem = bool(backup.getAttribute("one-file-system"))
+            #include and exclude rules are applied in the order they are listed
+            backupCfg.filterRules = [(rule.tagName, rule.childNodes[0].data) for rule in backup.childNodes
+                                     if rule.nodeType == rule.ELEMENT_NODE and rule.tagName in ("include", "exclude")]
             backupCfg.source = backup.getElementsByTagName("source")[0].childNodes[0].data
-            backupCfg.target = backup.getElementsByTagName("target")[0].childNodes[0].data
+            #the first target is the primary one, archives are written into all of them at once
+            backupCfg.targets = [target.childNodes[0].data for target in backup.getElementsByTagName("target")]
+            backupCfg.target = backupCfg.targets[0]
             rexConfig.backups.append(backupCfg)
 
         if rexConfig.performReporting:
@@ -99,6 +221,8 @@ def readConfig(configFilePath):
             if reporter.hasAttribute("from-address"): reporterConfig.fromAddress = reporter.getAttribute("from-address")
             if reporter.hasAttribute("to-address"): reporterConfig.toAddress = reporter.getAttribute("to-address")
             if reporter.hasAttribute("subject-prefix"): reporterConfig.subjectPrefix = reporter.getAttribute("subject-prefix")
+            if reporter.hasAttribute("send-timeout"): reporterConfig.sendTimeout = int(reporter.getAttribute("send-timeout"))
+            if reporter.hasAttribute("send-retries"): reporterConfig.sendRetries = int(reporter.getAttribute("send-retries"))
             rexConfig.reporterConfig = reporterConfig
 
             #Parsing smtp configuration
@@ -108,12 +232,47 @@ def readConfig(configFilePath):
             if smtp.hasAttribute("port"): smtpConfig.port = smtp.getAttribute("port")
             if smtp.hasAttribute("username"): smtpConfig.username = smtp.getAttribute("username")
             if smtp.hasAttribute("password"): smtpConfig.password = smtp.getAttribute("password")
+            if smtp.hasAttribute("timeout"): smtpConfig.timeout = int(smtp.getAttribute("timeout"))
+            if smtp.hasAttribute("tls"): smtpConfig.tls = bool(smtp.getAttribute("tls"))
             reporterConfig.smtpConfig = smtpConfig
     except Exception:
         raise ConfigError("Invalid file format.")
 
     return rexConfig
 
+def readCachedConfig(configFilePath, cacheFilePath):
+    """
+    Returns RexConfig object read from the config file like #readConfig() does, but keeps the parsed config in the cache
+    file and only parses the config file again once it (or this module) changed.
+    """
+    signature = getConfigSignature(configFilePath)
+    try:
+        with open(cacheFilePath, "rb") as f:
+            cachedSignature, rexConfig = pickle.load(f)
+        if cachedSignature == signature:
+            return rexConfig
+    except Exception:
+        pass
+
+    rexConfig = readConfig(configFilePath)
+    try:
+        partFilePath = cacheFilePath + ".part"
+        with open(partFilePath, "wb") as f:
+            pickle.dump((signature, rexConfig), f, pickle.HIGHEST_PROTOCOL)
+        os.replace(partFilePath, cacheFilePath)
+    except Exception as ex:
+        logging.warning("Failed to cache parsed configuration: " + ex.__str__())
+    return rexConfig
+
+def getConfigSignature(configFilePath):
+    """
+    Returns a tuple identifying the content of the config file and the version of the config classes.
+    """
+    configStat = os.stat(configFilePath)
+    moduleStat = os.stat(__file__)
+    return (os.path.abspath(configFilePath), configStat.st_mtime_ns, configStat.st_size, moduleStat.st_mtime_ns,
+            moduleStat.st_size)
+
 class ConfigError(Exception):
      """
      Abstract configuration error.
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import json
+import time
+import errno
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+#Copies are written to <target>.part, the verified offset is checkpointed in <target>.part.ckpt
+PARTIAL_SUFFIX = ".part"
+CHECKPOINT_SUFFIX = ".ckpt"
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+BUFFER_SIZE = 4 * 1024 * 1024
+#Size of the tail of the verified data which is compared between source and partial copy before resuming
+VERIFY_WINDOW = 1024 * 1024
+
+FSYNC_NONE = "none"
+FSYNC_CHECKPOINT = "checkpoint"
+FSYNC_END = "end"
+
+#Errors which network file systems report on glitches and which are worth a retry
+TRANSIENT_ERRORS = set([errno.EIO, errno.EAGAIN, errno.EINTR, errno.ETIMEDOUT, errno.ESTALE, errno.ENOTCONN,
+                        errno.ECONNRESET, errno.ECONNABORTED, errno.EHOSTDOWN, errno.EHOSTUNREACH, errno.ENETRESET,
+                        errno.ENETDOWN, errno.ENETUNREACH, errno.EBUSY])
+#Errors meaning that a zero-copy system call isn't supported for this pair of files
+UNSUPPORTED_ERRORS = set([errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF, errno.ENOTSUP])
+
+
+class CopyError(Exception):
+     """
+     Abstract copy engine error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class CopyOptions:
+    """
+    Parameters of the copy engine. chunk_size is the amount of data copied between checkpoints, reads and writes are
+    charged to io_throttle if given.
+    """
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, retries=5, backoff=2.0, fsync=FSYNC_END, io_throttle=None):
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.backoff = backoff
+        self.fsync = fsync
+        self.io_throttle = io_throttle
+
+
+def is_transient(ex):
+    return isinstance(ex, OSError) and ex.errno in TRANSIENT_ERRORS
+
+
+def read_checkpoint(checkpoint_path, src_stat):
+    """
+    Returns the checkpointed offset if the checkpoint belongs to the same version of the source, 0 otherwise.
+    """
+    try:
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint["size"] == src_stat.st_size and checkpoint["mtime"] == src_stat.st_mtime_ns:
+            return checkpoint["offset"]
+    except (OSError, ValueError, KeyError):
+        pass
+    return 0
+
+
+def write_checkpoint(checkpoint_path, src_stat, offset):
+    part_path = checkpoint_path + PARTIAL_SUFFIX
+    with open(part_path, "w") as f:
+        json.dump({"size": src_stat.st_size, "mtime": src_stat.st_mtime_ns, "offset": offset}, f)
+    os.replace(part_path, checkpoint_path)
+
+
+def verify_tail(src_path, part_path, offset):
+    """
+    Compares the last VERIFY_WINDOW bytes before offset in source and partial copy.
+    """
+    start = max(0, offset - VERIFY_WINDOW)
+    with open(src_path, "rb") as src, open(part_path, "rb") as part:
+        src.seek(start)
+        part.seek(start)
+        return src.read(offset - start) == part.read(offset - start)
+
+
+def remove_partial_copy(part_path):
+    """
+    Removes a partial copy together with its checkpoint (and a checkpoint being written).
+    """
+    checkpoint_path = part_path + CHECKPOINT_SUFFIX
+    for path in (part_path, checkpoint_path, checkpoint_path + PARTIAL_SUFFIX):
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+def copy_range(src_fd, dst_fd, offset, count, zero_copy):
+    """
+    Copies count bytes at offset from src to dst. Returns a tuple (copied bytes, data) where data is the copied bytes
+    when they went through user space (None for zero-copy transfers).
+    """
+    if zero_copy:
+        if hasattr(os, "copy_file_range"):
+            return os.copy_file_range(src_fd, dst_fd, count, offset, offset), None
+        if hasattr(os, "sendfile"):
+            os.lseek(dst_fd, offset, os.SEEK_SET)
+            return os.sendfile(dst_fd, src_fd, offset, count), None
+        raise OSError(errno.ENOSYS, "No zero-copy system call available")
+    data = os.pread(src_fd, min(count, BUFFER_SIZE), offset)
+    written = 0
+    while written < len(data):
+        written += os.pwrite(dst_fd, data[written:], offset + written)
+    return len(data), data
+
+
+def hash_range(file_path, digest, start, end, io_throttle=None):
+    """
+    Updates digest with the bytes of the file from start to end, reads are charged to io_throttle if given.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining:
+            data = f.read(min(BUFFER_SIZE, remaining))
+            if not data:
+                raise CopyError("File was truncated while being hashed: " + file_path)
+            digest.update(data)
+            if io_throttle:
+                io_throttle.read(len(data))
+            remaining -= len(data)
+
+
+def copy_file(file_path, dir_path, options=None, digest_algorithm=None, expected_digest=None):
+    """
+    Copies a file to dir_path resumably. Data goes to a partial file and the verified offset is checkpointed every
+    chunk, transient errors are retried with exponential backoff resuming from the last checkpoint. A copy which finally
+    fails is removed together with its checkpoint. copy_file_range/sendfile are used where available, large buffers
+    otherwise. If a digest has to be computed, data copied through buffers is hashed on the way and data copied by the
+    kernel is hashed by reading the copy back once it's complete. The copy is compared with the expected digest if
+    given. Returns the absolute path of the copy.
+    """
+    options = options if options else CopyOptions()
+    if not os.path.isfile(file_path):
+        raise CopyError("Provided path does not exist or is not a file: " + file_path)
+    if not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+
+    target_path = os.path.join(dir_path, os.path.basename(file_path))
+    part_path = target_path + PARTIAL_SUFFIX
+    checkpoint_path = part_path + CHECKPOINT_SUFFIX
+    src_stat = os.stat(file_path)
+    zero_copy = True
+
+    attempt = 0
+    while True:
+        try:
+            offset = read_checkpoint(checkpoint_path, src_stat) if os.path.isfile(part_path) else 0
+            if offset and not verify_tail(file_path, part_path, offset):
+                logging.warning("Partial copy doesn't match the source, starting over: " + part_path)
+                offset = 0
+            if offset:
+                logging.info("Resuming copy of " + file_path + " at offset " + str(offset))
+
+            digest = hashlib.new(digest_algorithm) if digest_algorithm else None
+            if digest and offset:
+                hash_range(file_path, digest, 0, offset)
+            #data is hashed while it's copied as long as it goes through buffers, the rest is read back from the copy
+            digested = offset
+
+            src_fd = os.open(file_path, os.O_RDONLY)
+            dst_fd = os.open(part_path, os.O_WRONLY | os.O_CREAT, 0o644)
+            try:
+                os.ftruncate(dst_fd, offset)
+                next_checkpoint = offset + options.chunk_size
+                while offset < src_stat.st_size:
+                    count = min(next_checkpoint, src_stat.st_size) - offset
+                    if options.io_throttle:
+                        #throttled copies go in small steps so the rate stays smooth
+                        count = min(count, BUFFER_SIZE)
+                    try:
+                        copied, data = copy_range(src_fd, dst_fd, offset, count, zero_copy)
+                    except OSError as ex:
+                        if zero_copy and ex.errno in UNSUPPORTED_ERRORS:
+                            logging.debug("Zero-copy not supported, falling back to buffers: " + ex.__str__())
+                            zero_copy = False
+                            continue
+                        raise
+                    if copied == 0:
+                        raise CopyError("Source file was truncated while being copied: " + file_path)
+                    if digest and data is not None and digested == offset:
+                        digest.update(data)
+                        digested += copied
+                    if options.io_throttle:
+                        options.io_throttle.read(copied)
+                        options.io_throttle.write(copied)
+                    offset += copied
+                    if offset >= next_checkpoint or offset == src_stat.st_size:
+                        if options.fsync == FSYNC_CHECKPOINT:
+                            os.fsync(dst_fd)
+                        write_checkpoint(checkpoint_path, src_stat, offset)
+                        next_checkpoint = offset + options.chunk_size
+                if options.fsync in (FSYNC_CHECKPOINT, FSYNC_END):
+                    os.fsync(dst_fd)
+            finally:
+                os.close(src_fd)
+                os.close(dst_fd)
+
+            if digest and digested < src_stat.st_size:
+                hash_range(part_path, digest, digested, src_stat.st_size, options.io_throttle)
+            if digest and expected_digest and digest.hexdigest() != expected_digest:
+                raise CopyError("Digest of the copy doesn't match: " + target_path)
+            os.replace(part_path, target_path)
+            if os.path.isfile(checkpoint_path):
+                os.remove(checkpoint_path)
+            return target_path
+        except Exception as ex:
+            if not is_transient(ex) or attempt >= options.retries:
+                remove_partial_copy(part_path)
+                raise
+            delay = options.backoff * (2 ** attempt)
+            attempt += 1
+            logging.warning("Transient error while copying " + file_path + " (attempt " + str(attempt) + " of " + \
+                            str(options.retries) + "), retrying in " + str(delay) + "s: " + ex.__str__())
+            time.sleep(delay)
+
+
+class TransferPool:
+    """
+    Copies files into dir_path with a pool of workers while the caller keeps producing them. Copied sources (and their
+    sidecars) are removed if remove_source is set.
+    """
+    def __init__(self, dir_path, options=None, workers=4, remove_source=True):
+        self.dir_path = dir_path
+        self.options = options
+        self.remove_source = remove_source
+        self.executor = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="transfer")
+        self.futures = []
+
+    def submit(self, file_path, digest_algorithm=None, expected_digest=None, sidecars=()):
+        self.futures.append(self.executor.submit(self.transfer, file_path, digest_algorithm, expected_digest,
+                                                 list(sidecars)))
+
+    def transfer(self, file_path, digest_algorithm, expected_digest, sidecars):
+        copies = [copy_file(file_path, self.dir_path, self.options, digest_algorithm, expected_digest)]
+        copies += [copy_file(sidecar_path, self.dir_path, self.options) for sidecar_path in sidecars]
+        if self.remove_source:
+            for path in [file_path] + sidecars:
+                os.remove(path)
+        return copies
+
+    def wait(self):
+        """
+        Waits for all transfers and returns the paths of all copies. Raises the first failure.
+        """
+        try:
+            return [path for future in self.futures for path in future.result()]
+        finally:
+            self.executor.shutdown()
+
+    def abort(self):
+        """
+        Cancels pending transfers and removes the copies made so far.
+        """
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown()
+        for future in self.futures:
+            if not future.cancelled() and future.exception() is None:
+                for path in future.result():
+                    if os.path.isfile(path):
+                        os.remove(path)
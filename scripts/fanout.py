@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import queue
+import threading
+
+#Number of chunks buffered for a branch before the producer has to wait for it
+DEFAULT_QUEUE_SIZE = 64
+FLUSH = object()
+CLOSE = object()
+
+
+class FanOutError(Exception):
+     """
+     Abstract fan-out error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class Branch(threading.Thread):
+    """
+    Writes the chunks put into its bounded queue to fileobj from its own thread. The first failure is kept in error,
+    everything queued afterwards is discarded so that the producer never waits for a failed branch.
+    """
+    def __init__(self, name, fileobj, queue_size=DEFAULT_QUEUE_SIZE):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.fileobj = fileobj
+        self.queue = queue.Queue(queue_size)
+        self.error = None
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is CLOSE:
+                    return
+                if self.error is None:
+                    if data is FLUSH:
+                        self.fileobj.flush()
+                    else:
+                        self.fileobj.write(data)
+            except Exception as ex:
+                self.error = ex
+            finally:
+                self.queue.task_done()
+
+
+class FanOutWriter:
+    """
+    Write-only file object copying everything written to several file objects at once, each of them is written by its
+    own thread from a queue of at most queue_size chunks. A slow file object holds the producer back only once its
+    queue is full, a failing one is dropped (see #get_errors()) while the others go on. Writes fail only once all file
+    objects failed. Closing the writer doesn't close the file objects.
+    """
+    def __init__(self, fileobjs, names=None, queue_size=DEFAULT_QUEUE_SIZE):
+        names = names if names else ["fanout-" + str(i) for i in range(len(fileobjs))]
+        self.branches = [Branch(name, fileobj, queue_size) for name, fileobj in zip(names, fileobjs)]
+        self.closed = False
+        for branch in self.branches:
+            branch.start()
+
+    def write(self, data):
+        #chunks are shared by the branches, so they must not change once queued
+        data = bytes(data)
+        for branch in self.branches:
+            if branch.error is None:
+                branch.queue.put(data)
+        self.check_errors()
+        return len(data)
+
+    def flush(self):
+        """
+        Waits until all branches wrote everything queued so far and flushed their file objects.
+        """
+        for branch in self.branches:
+            if branch.error is None:
+                branch.queue.put(FLUSH)
+        for branch in self.branches:
+            branch.queue.join()
+        self.check_errors()
+
+    def check_errors(self):
+        if all(branch.error is not None for branch in self.branches):
+            raise FanOutError("Writing failed everywhere: " + "; ".join(branch.name + ": " + branch.error.__str__()
+                                                                         for branch in self.branches))
+
+    def get_errors(self):
+        """
+        Returns a list with the error of every file object (None for the ones written successfully so far).
+        """
+        return [branch.error for branch in self.branches]
+
+    def close(self):
+        """
+        Stops the branch threads once they wrote everything queued.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for branch in self.branches:
+            branch.queue.put(CLOSE)
+        for branch in self.branches:
+            branch.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
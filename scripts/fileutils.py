@@ -19,15 +19,22 @@ __email__ = "denys.sobchyshak@gmail.com"
 
 import os
 import sys
-import shutil
-import tarfile
-import time
 import datetime
 import logging
-import hashlib
-import re
 
-from shutil import make_archive
+import walker
+import volumes
+import compressors
+from lazyimport import LazyModule
+
+#modules only needed once an archive is written or read are imported on first use
+shutil = LazyModule("shutil")
+tarfile = LazyModule("tarfile")
+hashlib = LazyModule("hashlib")
+archiveindex = LazyModule("archiveindex")
+throttle = LazyModule("throttle")
+mergejoin = LazyModule("mergejoin")
+fanout = LazyModule("fanout")
 
 
 class FileUtilsError(Exception):
@@ -42,11 +49,30 @@ class FileUtilsError(Exception):
 fileErrorMsg = "Provided path does not exist or is not a file: "
 dirErrorMsg = "Provided path does not exist or is not a directory: "
 
+#Environment variable overriding the working directory (where config, tmp, logs and data dirs are looked up)
+WORKING_DIR_ENV = "REX_BACKUP_HOME"
+#Suffix of archives which are still being written to the target, it never matches the archive name pattern
+PARTIAL_SUFFIX = ".part"
+#Size of the blocks written to the target while streaming an archive
+STREAM_BUFFER_SIZE = 1024 * 1024
+#Supported compression modes of streamed archives, see #compressors
+COMPRESSION_GZIP = compressors.CODEC_GZIP
+COMPRESSION_PARALLEL_GZIP = compressors.CODEC_PARALLEL_GZIP
+COMPRESSION_XZ = compressors.CODEC_XZ
+COMPRESSION_ZSTD = compressors.CODEC_ZSTD
+COMPRESSION_LZ4 = compressors.CODEC_LZ4
+#Algorithms which can be used for archive digests, the digest is stored in an <archive>.<algorithm> sidecar
+DIGEST_ALGORITHMS = ["sha256", "blake2b", "sha512", "sha1", "md5"]
+DEFAULT_DIGEST_ALGORITHM = "sha256"
+
 
 def get_working_dir():
     """
-    Returns script working directory. (Parent directory of the script that invoked python interpreter)
+    Returns script working directory. (Parent directory of the script that invoked python interpreter unless
+    overridden by the REX_BACKUP_HOME environment variable)
     """
+    if os.environ.get(WORKING_DIR_ENV):
+        return os.environ[WORKING_DIR_ENV]
     return os.path.join(sys.path[0], os.pardir)
 
 
@@ -80,6 +106,26 @@ def get_tmp_remote_dir():
     return tmp_dir
 
 
+def get_job_tmp_dir(job_id):
+    """
+    Returns path to the temporary directory of a single backup job. Creates one if it didn't exist.
+    """
+    tmp_dir = os.path.join(get_tmp_dir(), "jobs", str(job_id))
+    if not os.path.exists(tmp_dir):
+        os.makedirs(tmp_dir)
+    return tmp_dir
+
+
+def get_data_dir():
+    """
+    Returns path to the directory of persistent script data (e.g. the archive catalog). Creates one if it didn't exist.
+    """
+    data_dir = os.path.join(get_working_dir(), "data")
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    return data_dir
+
+
 def get_log_dir():
     """
     Returns path to the log directory. Creates one if it didn't exist.
@@ -98,53 +144,323 @@ def clean_tmp():
     shutil.rmtree(get_tmp_remote_dir())
 
 
-def archive_dir(dir_path, archive_type):
+def clean_job_tmp(job_id):
     """
-    Performs an archiving operation on the dirPath and stores the archive in the #get_tmp_local_dir(). Returns an absolute
-    path to the archive file.
+    Deletes the temporary directory of a single backup job leaving other jobs' files intact.
     """
-    if os.path.isdir(dir_path):
-        src_name = os.path.basename(dir_path)
-        arc_name = src_name + "-" + datetime.datetime.now().strftime("%Y%m%d%H%M")
-        return make_archive(os.path.join(get_tmp_local_dir(), arc_name), archive_type, dir_path)
-    else:
-        raise FileUtilsError(dirErrorMsg + dir_path)
+    tmp_dir = os.path.join(get_tmp_dir(), "jobs", str(job_id))
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
 
 
-def generate_md5_file(file_path):
+def get_mount_point(path):
     """
-    Generates an md5 code for a file and returns the absolute path to the generated file.
+    Returns the mount point the path resides on. Path doesn't have to exist yet, the closest existing parent is used.
     """
-    if os.path.isfile(file_path):
-        md5_str = file_path + "-" + str(time.time())
-        #Apparently md5 algorithm operates on bytes, that's why we need to encode the string
-        m = hashlib.md5(md5_str.encode("utf-8"))
-        md5_file = open(file_path+".md5", "w")
-        md5_file.write(m.hexdigest() + "\t" + os.path.basename(file_path))
-        md5_file.close()
-        return md5_file.name
+    path = os.path.realpath(os.path.abspath(path))
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    while not os.path.ismount(path):
+        path = os.path.dirname(path)
+    return path
+
+
+class HashingWriter:
+    """
+    Write-through file object wrapper which incrementally digests all bytes written to the underlying file.
+    """
+    def __init__(self, fileobj, algorithm=DEFAULT_DIGEST_ALGORITHM):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+class HashingReader:
+    """
+    Read-through file object wrapper which incrementally digests all bytes read from the underlying file.
+    """
+    def __init__(self, fileobj, algorithm=DEFAULT_DIGEST_ALGORITHM):
+        self.fileobj = fileobj
+        self.hash = hashlib.new(algorithm)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+    def drain(self):
+        """
+        Reads (and digests) the rest of the underlying file.
+        """
+        while self.read(STREAM_BUFFER_SIZE):
+            pass
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def get_digest_file_path(file_path, algorithm):
+    """
+    Returns path of the digest sidecar of a file, e.g. <archive>.sha256
+    """
+    return file_path + "." + algorithm
+
+
+def write_digest_file(file_path, algorithm, hexdigest):
+    """
+    Writes a digest sidecar next to the file in the format of sha256sum and alike. Returns path to the sidecar.
+    """
+    digest_file_path = get_digest_file_path(file_path, algorithm)
+    with open(digest_file_path, "w") as f:
+        f.write(hexdigest + "  " + os.path.basename(file_path) + "\n")
+    return digest_file_path
+
+
+def find_digest_file(file_path):
+    """
+    Looks for a digest sidecar of the file. Returns a tuple (algorithm, hexdigest) or None.
+    """
+    for algorithm in DIGEST_ALGORITHMS:
+        digest_file_path = get_digest_file_path(file_path, algorithm)
+        if os.path.isfile(digest_file_path):
+            with open(digest_file_path, "r") as f:
+                return algorithm, f.read().split()[0]
+
+
+def compute_file_digest(file_path, algorithm=DEFAULT_DIGEST_ALGORITHM, io_throttle=None):
+    """
+    Streams the file (or volume set) through a hash and returns its hex digest. Reads are charged to io_throttle if
+    given.
+    """
+    if archive_exists(file_path):
+        with volumes.open_archive(file_path) as f:
+            reader = HashingReader(throttle.ThrottledReader(f, io_throttle) if io_throttle else f, algorithm)
+            reader.drain()
+        return reader.hexdigest()
     else:
         raise FileUtilsError(fileErrorMsg + file_path)
 
 
-def copy_file(file_path, dir_path):
+class ArchiveOutput:
     """
-    Copies source file to the target dir. Returns absolute path to the target file or none.
+    Destination of an archive written by #stream_archive_dir(): a partial file which #commit() renames to target_file
+    or, if volume_size is given, a volume set. Writes are charged to io_throttle if given.
     """
-    if os.path.isfile(file_path):
-        if not os.path.isdir(dir_path):
+    def __init__(self, target_file, volume_size=None, digest_algorithm=None, on_volume=None, io_throttle=None):
+        self.target_file = target_file
+        self.part_file = target_file + PARTIAL_SUFFIX
+        self.volume_writer = None
+        if volume_size:
+            def volume_done(volume_path, hexdigest):
+                if hexdigest:
+                    write_digest_file(volume_path, digest_algorithm, hexdigest)
+                if on_volume:
+                    on_volume(volume_path, hexdigest)
+            self.volume_writer = volumes.VolumeWriter(target_file, volume_size, digest_algorithm, volume_done)
+            self.raw = self.volume_writer
+        else:
+            self.raw = open(self.part_file, "wb")
+        self.writer = throttle.ThrottledWriter(self.raw, io_throttle) if io_throttle else self.raw
+
+    def write(self, data):
+        return self.writer.write(data)
+
+    def flush(self):
+        self.writer.flush()
+
+    def commit(self):
+        """
+        Syncs the archive and moves it into place, a volume set gets its descriptor.
+        """
+        if self.volume_writer is None:
+            self.raw.flush()
+            os.fsync(self.raw.fileno())
+            self.raw.close()
+            os.replace(self.part_file, self.target_file)
+        else:
+            self.volume_writer.close()
+        return self.target_file
+
+    def abort(self):
+        if self.volume_writer is None:
+            self.raw.close()
+            remove_file(self.part_file)
+        else:
+            self.volume_writer.abort()
+
+
+def stream_archive_dir(dir_path, target_dir, compression=COMPRESSION_GZIP, workers=None, block_size=None,
+                       members=None, suffix="", digest_algorithm=None, stats=None, io_throttle=None, volume_size=None,
+                       on_volume=None, level=None, store_incompressible=True, seek_interval=None, file_filter=None,
+                       failed_dirs=None, tmp_dir=None):
+    """
+    Archives dir_path straight into target_dir in a single pass (read, compress, write) without staging the archive in
+    the #get_tmp_local_dir(). Data is written to a partial file in the target which is atomically renamed to the usual
+    <name>-YYYYmmddHHMM<suffix>.tar<codec extension> once the archive is complete. compression is one of the codecs of
+    #compressors ("gzip", "pgzip", "xz", "zstd" or "lz4") used at the given level (codec default if None). With pgzip
+    compression blocks of block_size bytes are compressed by a pool of workers. With store_incompressible content which
+    is compressed already (by extension or a sample) is stored instead of being compressed again. If members (names
+    like "./dir/file") are given only those entries are archived, otherwise the whole directory is, except for entries
+    excluded by the file_filter (a #filters.FileFilter). If digest_algorithm is given, the digest of the archive is
+    computed while it is written and stored in a sidecar next to it. A member index (<archive>.idx) is always written
+    alongside the archive.
+    If a stats dict is given it is filled with "files", "bytes_read" (size of the tar stream), "bytes_written" (size of
+    the archive) and "targets" (number of targets it was written to).
+    Source reads and archive writes are charged to io_throttle if given. If volume_size is given the archive is split
+    into a volume set instead of a single file, on_volume(volume_path, hexdigest) is called for every completed volume.
+    If seek_interval is given, seek points are recorded every seek_interval bytes of the tar stream in a seek index
+    (<archive>.seek) so that members can be restored without decompressing the archive from its start.
+
+    target_dir may also be a list of directories, the compressed stream is then fanned out to all of them at once (see
+    #fanout.FanOutWriter) and the indexes are written into tmp_dir (defaults to #get_tmp_local_dir()) first. A target
+    failing on its own doesn't stop the others, its error message is put into the failed_dirs dict if given.
+    Returns an absolute path to the archive file (the logical path of a volume set) in the first target it was
+    written to.
+    """
+    if os.path.isdir(dir_path):
+        target_dirs = list(target_dir) if isinstance(target_dir, (list, tuple)) else [target_dir]
+        failed_dirs = failed_dirs if failed_dirs is not None else dict()
+        src_name = os.path.basename(dir_path)
+        arc_name = src_name + "-" + datetime.datetime.now().strftime("%Y%m%d%H%M") + suffix + ".tar" + \
+                   compressors.get_extension(compression)
+        outputs = []
+        output_dirs = []
+        for output_dir in target_dirs:
             try:
-                os.makedirs(dir_path)
-                logging.info("Created a directory: " + dir_path)
+                ensure_dir(output_dir)
+                outputs.append(ArchiveOutput(os.path.join(output_dir, arc_name), volume_size, digest_algorithm,
+                                             on_volume, io_throttle))
+                output_dirs.append(output_dir)
             except Exception as ex:
-                raise FileUtilsError("Copy destination can't be reached. Couldn't create directory: " + dir_path + \
-                                     ". Reason: " + ex.__str__())
+                if len(target_dirs) == 1:
+                    raise
+                failed_dirs[output_dir] = ex.__str__()
+                logging.error("Failed to write archive to " + output_dir + ": " + ex.__str__())
+        if not outputs:
+            raise FileUtilsError("Failed to write archive to any target: " + arc_name)
+        fan_out = None
+        if len(outputs) > 1:
+            fan_out = fanout.FanOutWriter(outputs, ["fanout-" + os.path.basename(os.path.normpath(output_dir))
+                                                    for output_dir in output_dirs])
+        #with several targets the indexes are copied into every target the archive made it to
+        index_file = outputs[0].target_file if fan_out is None else \
+            os.path.join(tmp_dir or get_tmp_local_dir(), arc_name)
+        index = archiveindex.IndexWriter(archiveindex.get_index_path(index_file))
+        seek_index_path = archiveindex.get_seek_index_path(index_file)
+        seek_index = archiveindex.SeekIndexWriter(seek_index_path) if seek_interval else None
+        committed = []
+        try:
+            part = fan_out if fan_out is not None else outputs[0]
+            part = HashingWriter(part, digest_algorithm) if digest_algorithm else part
+            with compressors.open_writer(part, compression, level, os.path.splitext(arc_name)[0], workers,
+                                         block_size, seek_interval,
+                                         seek_index.add if seek_index else None) as compressor:
+                #tar isn't opened in stream mode so that member content reaches the compressor unbuffered and
+                #switching to store mode happens exactly at member boundaries
+                with archiveindex.IndexingTarFile.open(mode="w", fileobj=compressor,
+                                                       copybufsize=STREAM_BUFFER_SIZE) as tar:
+                    tar.index = index
+                    tar.read_throttle = io_throttle
+                    tar.compressor = compressor if store_incompressible else None
+                    add_to_archive(tar, dir_path, members, file_filter)
+                tar_size = tar.offset
+            part.flush()
+            errors = [None] * len(outputs)
+            if fan_out is not None:
+                fan_out.close()
+                errors = fan_out.get_errors()
+            for output, output_dir, error in zip(outputs, output_dirs, errors):
+                try:
+                    if error is not None:
+                        raise error
+                    committed.append(output.commit())
+                except Exception as ex:
+                    if fan_out is None:
+                        raise
+                    output.abort()
+                    failed_dirs[output_dir] = ex.__str__()
+                    logging.error("Failed to write archive to " + output_dir + ": " + ex.__str__())
+            if not committed:
+                raise FileUtilsError("Failed to write archive to any target: " + arc_name)
+            index.commit(get_archive_size(committed[0]))
+            if seek_index:
+                seek_index.commit()
+            for target_file in committed:
+                if fan_out is not None:
+                    copy_sidecar(index.index_path, archiveindex.get_index_path(target_file))
+                    if seek_index:
+                        copy_sidecar(seek_index.seek_index_path, archiveindex.get_seek_index_path(target_file))
+                if digest_algorithm:
+                    write_digest_file(target_file, digest_algorithm, part.hexdigest())
+            if fan_out is not None:
+                remove_file(index.index_path)
+                if seek_index:
+                    remove_file(seek_index.seek_index_path)
+            if stats is not None:
+                stats.update({"files": index.count, "bytes_read": tar_size,
+                              "bytes_written": get_archive_size(committed[0]), "targets": len(committed)})
+        except Exception:
+            index.abort()
+            if seek_index:
+                seek_index.abort()
+            if fan_out is not None:
+                fan_out.close()
+            for output in outputs:
+                if output.target_file not in committed:
+                    output.abort()
+            raise
+        return committed[0]
+    else:
+        raise FileUtilsError(dirErrorMsg + dir_path)
 
-        target_file = os.path.join(dir_path , os.path.basename(file_path))
-        shutil.copyfile(file_path, target_file)
-        return target_file
+
+def copy_sidecar(file_path, target_path):
+    """
+    Copies a sidecar file to target_path through a partial file, so that an incomplete copy never shows up.
+    """
+    shutil.copyfile(file_path, target_path + PARTIAL_SUFFIX)
+    os.replace(target_path + PARTIAL_SUFFIX, target_path)
+
+
+def add_to_archive(tar, dir_path, members=None, file_filter=None):
+    """
+    Adds the whole dir_path to an open tar or, if members are given, only the listed entries (without recursion).
+    Without members entries excluded by the file_filter are left out, excluded directories aren't even read.
+    """
+    if members is None and file_filter is None:
+        tar.add(dir_path, arcname=os.curdir)
     else:
-        raise FileUtilsError(fileErrorMsg + file_path)
+        tar.add(dir_path, arcname=os.curdir, recursive=False)
+        if members is None:
+            entries = walker.walk(dir_path, with_stat=False, sort=True, file_filter=file_filter)
+            members = (entry.key for entry in entries)
+        for member in members:
+            try:
+                tar.add(os.path.join(dir_path, member[2:]), arcname=member, recursive=False)
+            except FileNotFoundError:
+                logging.warning("File disappeared before it could be archived: " + member)
+
+
+def ensure_dir(dir_path):
+    """
+    Creates dir_path (and its parents) if it doesn't exist yet.
+    """
+    if not os.path.isdir(dir_path):
+        try:
+            os.makedirs(dir_path)
+            logging.info("Created a directory: " + dir_path)
+        except Exception as ex:
+            raise FileUtilsError("Destination can't be reached. Couldn't create directory: " + dir_path + \
+                                 ". Reason: " + ex.__str__())
 
 
 def remove_file(file_path):
@@ -158,58 +474,114 @@ def remove_file(file_path):
         return False
 
 
-def get_files(dir_path, pattern=""):
+def get_sidecars(file_path):
+    """
+    Returns sorted paths of the sidecar files (<archive>.<ext>) of an archive.
+    """
+    prefix = os.path.basename(file_path) + "."
+    dir_path = os.path.dirname(file_path)
+    if not os.path.isdir(dir_path):
+        return []
+    return sorted(os.path.join(dir_path, name) for name in os.listdir(dir_path) if name.startswith(prefix))
+
+
+def remove_archive(file_path):
+    """
+    Removes an archive together with its sidecar files (<archive>.<ext>). Returns True if the archive was removed.
+    """
+    volume_set = volumes.is_volume_set(file_path)
+    for sidecar_path in get_sidecars(file_path):
+        remove_file(sidecar_path)
+    return remove_file(file_path) or volume_set
+
+
+def archive_exists(file_path):
+    """
+    Returns True if there is an archive file or a volume set at file_path.
+    """
+    return os.path.isfile(file_path) or volumes.is_volume_set(file_path)
+
+
+def get_archive_size(file_path):
+    """
+    Returns size of an archive file or the total size of a volume set.
+    """
+    if volumes.is_volume_set(file_path):
+        return volumes.read_descriptor(file_path)["size"]
+    return os.path.getsize(file_path)
+
+
+def get_files(dir_path, pattern="", threads=1):
     """
     Searches dir_path and its subdirectories for files. File names are optionally checked against regexp pattern.
     """
     if os.path.isdir(dir_path):
-        archives = []
-        for dirpath, dirnames, filenames in os.walk(dir_path):
-            for filename in filenames:
-                if re.search(pattern, filename):
-                    archives.append(os.path.join(dirpath, filename))
-        return archives
+        return list(walker.find_files(dir_path, pattern, threads))
     else:
         raise FileUtilsError(dirErrorMsg + dir_path)
 
 
-def compare_archive_against_dir(archive_file_path, source_dir_path, exclude_regexp="", ignore_links=True):
-    """
-    Traverses source_dir_path and tries to find matches in the archive. Returns a list of inconsistencies or None.
-    """
-    #TODO:determine read mode automatically as well as tar vs zip file
-    if not archive_file_path.endswith("tar.gz"):
-        raise NotImplementedError("Only tar.gz archives are supported at the moment")
-
-    archive_file = tarfile.open(archive_file_path, "r:gz")
-    tar_members = dict()
-    for member in archive_file.getmembers():
-        tar_members[member.name] = member.mtime
-
-    src_members = dict()
-    for dirpath, dirnames, filenames in os.walk(source_dir_path):
-        for filename in filenames:
-            file_absolute_path = os.path.join(dirpath, filename)
-            if ignore_links and not os.path.islink(file_absolute_path):
-                src_members[file_absolute_path] = os.path.getmtime(file_absolute_path)
-        for dirname in dirnames:
-            dir_absolute_path = os.path.join(dirpath, dirname)
-            if ignore_links and not os.path.islink(dir_absolute_path):
-                src_members[dir_absolute_path] = os.path.getmtime(dir_absolute_path)
-
-    inconsistencies = []
-    for srcKey in src_members:
-        tar_key = srcKey.replace(source_dir_path, ".")
-        alt_tar_key = tar_key + os.path.sep
-
-        #determine which key is used
-        key = tar_key if tar_key in tar_members else alt_tar_key
-        if not re.search(exclude_regexp, key):
-            if key != tar_key and not (key in tar_members):  # don't perform double checks
-                inconsistencies.append("Can't find key in the archive: " + tar_key)
-            elif datetime.date.fromtimestamp(src_members[srcKey]) != datetime.date.fromtimestamp(tar_members[key]):
-                inconsistencies.append("Wrong modification time detected: key=" + tar_key + ";archiveMtime=" + \
-                                       timestamp2str(tar_members[tar_key]) + ";srcMtime=" + timestamp2str(src_members[srcKey]))
+def read_archive_members(archive_file_path, digest_algorithm=None, io_throttle=None, tar_members=None):
+    """
+    Reads a tar archive (any codec of #compressors) in a single streaming pass and returns a tuple (members, hexdigest)
+    where members is an ExternalSorter of member names and their mtimes (tar_members if given) and hexdigest is the
+    digest of the archive bytes (None if no algorithm is given). Reads are charged to io_throttle if given.
+    """
+    tar_members = tar_members if tar_members is not None else mergejoin.ExternalSorter()
+    with volumes.open_archive(archive_file_path) as f:
+        reader = throttle.ThrottledReader(f, io_throttle) if io_throttle else f
+        reader = HashingReader(reader, digest_algorithm) if digest_algorithm else reader
+        with compressors.open_reader(reader) as stream, \
+                tarfile.open(fileobj=stream, mode="r|", bufsize=STREAM_BUFFER_SIZE) as archive_file:
+            for member in archive_file:
+                tar_members.add(member.name, member.mtime)
+                #TarFile keeps every member read, which isn't needed for a single pass
+                archive_file.members = []
+        if digest_algorithm:
+            reader.drain()
+            return tar_members, reader.hexdigest()
+    return tar_members, None
+
+
+def compare_members_against_dir(tar_members, source_dir_path, file_filter=None, ignore_links=True, members=None,
+                                threads=1, inconsistencies=None, memory_limit=None, tmp_dir=None):
+    """
+    Checks that every entry of source_dir_path which isn't excluded by the file_filter (the one used for archiving) is
+    archived with the same modification date. tar_members are (name, mtime) pairs, a dict or an ExternalSorter (which
+    drops trailing slashes of directory names before sorting). Both sides are sorted with at most memory_limit bytes in
+    memory each (spilling to tmp_dir beyond that) and merge-joined, so memory doesn't grow with the size of the tree.
+    Found inconsistencies are appended to the given InconsistencyLog (an in-memory one by default) which is returned if
+    it isn't empty, None otherwise.
+    """
+    members = set(members) if members is not None else None
+    inconsistencies = inconsistencies if inconsistencies is not None else mergejoin.InconsistencyLog()
+
+    if not isinstance(tar_members, mergejoin.ExternalSorter):
+        tar_sorter = mergejoin.ExternalSorter(memory_limit, tmp_dir)
+        tar_sorter.extend(tar_members.items() if isinstance(tar_members, dict) else tar_members)
+        tar_members = tar_sorter
+    src_members = mergejoin.ExternalSorter(memory_limit, tmp_dir)
+    try:
+        #with a known member set only those entries are looked up instead of walking the whole tree
+        entries = walker.walk(source_dir_path, threads=threads, file_filter=file_filter) if members is None else \
+            walker.stat_keys(source_dir_path, members, file_filter)
+        for entry in entries:
+            if ignore_links and entry.is_link:
+                continue
+            src_members.add(entry.key, entry.stat.st_mtime)
+
+        for name, tar_mtime, src_mtime in mergejoin.join_sorted(tar_members, src_members):
+            if src_mtime is None:
+                continue
+            key = mergejoin.decode_name(name)
+            if tar_mtime is None:
+                inconsistencies.append("Can't find key in the archive: " + key)
+            elif datetime.date.fromtimestamp(src_mtime) != datetime.date.fromtimestamp(tar_mtime):
+                inconsistencies.append("Wrong modification time detected: key=" + key + ";archiveMtime=" + \
+                                       timestamp2str(tar_mtime) + ";srcMtime=" + timestamp2str(src_mtime))
+    finally:
+        src_members.close()
+        tar_members.close()
 
     if len(inconsistencies) > 0:
         return inconsistencies
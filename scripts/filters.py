@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import re
+import stat
+
+import walker
+
+#Rule kinds of a backup, in the order they are applied
+RULE_INCLUDE = "include"
+RULE_EXCLUDE = "exclude"
+
+
+class FilterError(Exception):
+     """
+     Abstract filter error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class Rule:
+    """
+    Compiled gitignore-style glob. regex matches paths relative to the source root ("dir/file"), dir_only rules (the
+    glob ended with a slash) only match directories. A matching include rule takes back an earlier exclude.
+    """
+    __slots__ = ("pattern", "regex", "include", "dir_only")
+
+    def __init__(self, pattern, regex, include, dir_only):
+        self.pattern = pattern
+        self.regex = regex
+        self.include = include
+        self.dir_only = dir_only
+
+
+def translate_glob(glob):
+    """
+    Translates a gitignore-style glob into a regexp. A glob without a slash (other than a trailing one) matches names at
+    any depth, otherwise it is anchored at the source root. "*" and "?" don't match slashes, "**" matches across them.
+    """
+    glob = glob.rstrip("/")
+    anchored = "/" in glob
+    glob = glob.lstrip("/")
+    parts = []
+    i = 0
+    while i < len(glob):
+        c = glob[i]
+        if glob.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+            continue
+        if glob.startswith("**", i):
+            parts.append(".*" if i + 2 == len(glob) else "[^/]*")
+            i += 2
+            continue
+        if c == "*":
+            parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "\\" and i + 1 < len(glob):
+            i += 1
+            parts.append(re.escape(glob[i]))
+        elif c == "[" and "]" in glob[i + 2:]:
+            end = glob.index("]", i + 2)
+            content = glob[i + 1:end]
+            if content.startswith("!"):
+                content = "^" + content[1:]
+            parts.append("[" + content.replace("\\", "\\\\") + "]")
+            i = end
+        else:
+            parts.append(re.escape(c))
+        i += 1
+    return "^" + ("" if anchored else "(?:.*/)?") + "".join(parts) + "$"
+
+
+def compile_rule(kind, glob):
+    """
+    Compiles an include or exclude glob. Like in .gitignore files an exclude glob starting with "!" is an include.
+    """
+    include = kind == RULE_INCLUDE
+    if glob.startswith("!") and not include:
+        include, glob = True, glob[1:]
+    glob = glob.strip()
+    if not glob or glob == "/":
+        raise FilterError("Empty " + kind + " pattern")
+    try:
+        return Rule(glob, re.compile(translate_glob(glob)), include, glob.endswith("/"))
+    except re.error as ex:
+        raise FilterError("Invalid " + kind + " pattern " + glob + ": " + ex.__str__())
+
+
+def read_rules_file(file_path):
+    """
+    Reads exclude rules from a file in the .gitignore format: one glob per line, "!" includes, "#" starts a comment.
+    Returns a list of (kind, glob) tuples.
+    """
+    rules = []
+    with open(file_path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            #"\#" starts a glob with a hash, "\!" one with an exclamation mark (escaped by the glob itself)
+            if line.startswith("\\#"):
+                line = line[1:]
+            rules.append((RULE_EXCLUDE, line))
+    return rules
+
+
+class FileFilter:
+    """
+    Decides which entries of a source are backed up. An entry is excluded if exclude_regexp is found in its key
+    ("./dir/file", directories are also searched as "./dir/") or if the last of the include and exclude rules matching
+    it is an exclude. Regular files larger than max_file_size bytes are excluded as well as, with one_file_system,
+    entries on another file system than the root. Excluding a directory excludes everything below it, walks don't
+    descend into it at all (see #walker.walk()), so nothing below it can be included again.
+    """
+    def __init__(self, root, exclude_regexp="", rules=(), max_file_size=None, one_file_system=False):
+        self.exclude = walker.compile_pattern(exclude_regexp)
+        self.rules = [compile_rule(kind, glob) for kind, glob in rules]
+        self.max_file_size = max_file_size
+        self.device = os.stat(root).st_dev if one_file_system and os.path.isdir(root) else None
+        #size and device checks need the stat of every entry
+        self.needs_stat = bool(max_file_size) or one_file_system
+
+    def is_excluded(self, key, is_dir, st=None):
+        """
+        Decides about a single entry whose parents are known to be included, which is the case while walking.
+        """
+        if st is not None:
+            if self.device is not None and st.st_dev != self.device:
+                return True
+            if self.max_file_size and stat.S_ISREG(st.st_mode) and st.st_size > self.max_file_size:
+                return True
+        excluded = False
+        if self.exclude is not None:
+            excluded = self.exclude.search(key) is not None or (is_dir and self.exclude.search(key + "/") is not None)
+        path = key[2:] if key.startswith(os.curdir + "/") else key
+        for rule in self.rules:
+            if (is_dir or not rule.dir_only) and rule.regex.match(path):
+                excluded = not rule.include
+        return excluded
+
+    def is_excluded_path(self, key, is_dir, st=None):
+        """
+        Decides about an entry looked up without a walk (e.g. a journaled change or an archive member), its parent
+        directories are checked as well.
+        """
+        parts = key.split("/")
+        for i in range(2, len(parts)):
+            if self.is_excluded("/".join(parts[:i]), True):
+                return True
+        return self.is_excluded(key, is_dir, st)
+
+
+def make_filter(root, exclude_regexp="", rules=(), max_file_size=None, one_file_system=False):
+    """
+    Returns a FileFilter for the source root or None if nothing is filtered at all.
+    """
+    if not exclude_regexp and not rules and not max_file_size and not one_file_system:
+        return None
+    return FileFilter(root, exclude_regexp, rules, max_file_size, one_file_system)
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import gzip
+import json
+
+import walker
+
+#Kinds of archives, the suffix is placed between the archive date and its extension (e.g. src-201311051200.incr.tar.gz)
+KIND_FULL = "full"
+KIND_INCREMENTAL = "incr"
+KIND_DIFFERENTIAL = "diff"
+KIND_SUFFIXES = {KIND_FULL: "", KIND_INCREMENTAL: "." + KIND_INCREMENTAL, KIND_DIFFERENTIAL: "." + KIND_DIFFERENTIAL}
+
+MANIFEST_SUFFIX = ".manifest"
+MANIFEST_VERSION = 1
+
+
+class Manifest:
+    """
+    State of a source directory at the time an archive was made. entries maps archive member names ("./dir/file") to
+    a [size, mtime_ns, inode, mode] list, changed lists members stored in the archive and deleted lists members which
+    disappeared since the base archive.
+    """
+    def __init__(self, kind=KIND_FULL, base=None, entries=None, changed=None, deleted=None):
+        self.kind = kind
+        self.base = base
+        self.entries = entries if entries is not None else dict()
+        self.changed = changed if changed is not None else []
+        self.deleted = deleted if deleted is not None else []
+
+
+def get_manifest_path(archive_path):
+    """
+    Returns path of the manifest sidecar of an archive.
+    """
+    return archive_path + MANIFEST_SUFFIX
+
+
+def scan_dir(dir_path, threads=1, file_filter=None):
+    """
+    Walks dir_path and returns a dict of archive member names to [size, mtime_ns, inode, mode] of every entry in it
+    which isn't excluded by the file_filter.
+    """
+    entries = dict()
+    for entry in walker.walk(dir_path, threads=threads, file_filter=file_filter):
+        st = entry.stat
+        entries[entry.key] = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode]
+    return entries
+
+
+def apply_changes(entries, dir_path, changed_keys, file_filter=None):
+    """
+    Returns a copy of entries (a scan of dir_path made earlier) brought up to date by re-reading only the changed_keys
+    instead of walking the whole tree. Keys which no longer exist (or are excluded by the file_filter) are removed
+    together with everything below them.
+    """
+    entries = dict(entries)
+    existing = set()
+    for entry in walker.stat_keys(dir_path, changed_keys, file_filter):
+        st = entry.stat
+        entries[entry.key] = [st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode]
+        existing.add(entry.key)
+    removed = set(key for key in changed_keys if key not in existing)
+    if removed:
+        prefixes = tuple(key + "/" for key in removed)
+        for key in [k for k in entries if k in removed or k.startswith(prefixes)]:
+            del entries[key]
+    return entries
+
+
+def diff_entries(base_entries, entries):
+    """
+    Compares two scans and returns a tuple of sorted lists (changed, deleted). An entry is changed if it is new or any
+    of its size, mtime, inode or mode differs from the base.
+    """
+    changed = [key for key, value in entries.items() if base_entries.get(key) != value]
+    deleted = [key for key in base_entries if key not in entries]
+    return sorted(changed), sorted(deleted)
+
+
+def write_manifest(file_path, manifest):
+    """
+    Writes a manifest next to its archive. The file is renamed into place once completely written.
+    """
+    part_file = file_path + ".part"
+    with gzip.open(part_file, "wt", encoding="utf-8") as f:
+        json.dump({"version": MANIFEST_VERSION, "kind": manifest.kind, "base": manifest.base,
+                   "entries": manifest.entries, "changed": manifest.changed, "deleted": manifest.deleted}, f)
+    os.replace(part_file, file_path)
+    return file_path
+
+
+def read_manifest(file_path):
+    """
+    Reads a manifest written by #write_manifest().
+    """
+    with gzip.open(file_path, "rt", encoding="utf-8") as f:
+        data = json.load(f)
+    return Manifest(data["kind"], data.get("base"), data["entries"], data.get("changed"), data.get("deleted"))
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+
+import os
+import heapq
+import struct
+import tempfile
+
+#Memory used for (name, mtime) records before they are spilled to disk
+DEFAULT_MEMORY_LIMIT = 64 * 1024 * 1024
+#Rough size of a (bytes, int) tuple in a list on top of the name bytes
+RECORD_OVERHEAD = 120
+RECORD_HEADER = struct.Struct("<Iq")
+RUN_BUFFER_SIZE = 256 * 1024
+#Number of inconsistencies kept in memory for reports, the rest only goes to the inconsistency file
+DEFAULT_KEEP = 100
+
+
+def encode_name(name):
+    return name.encode("utf-8", "surrogateescape")
+
+
+def decode_name(name):
+    return name.decode("utf-8", "surrogateescape")
+
+
+class ExternalSorter:
+    """
+    Sorts (name, mtime) records by name with bounded memory. Records are kept as compact (bytes, int) tuples and once
+    memory_limit is exceeded they are sorted and spilled to a run file in tmp_dir. Iterating yields (name, mtime)
+    tuples of encoded names in order, merging all runs lazily.
+    """
+    def __init__(self, memory_limit=DEFAULT_MEMORY_LIMIT, tmp_dir=None):
+        self.memory_limit = memory_limit or DEFAULT_MEMORY_LIMIT
+        self.tmp_dir = tmp_dir
+        self.buffer = []
+        self.buffer_size = 0
+        self.runs = []
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, name, mtime):
+        #directory members may have been archived with a trailing slash, they are sorted and compared without it
+        name = encode_name(name)
+        record = (name.rstrip(b"/") or name, int(mtime))
+        self.buffer.append(record)
+        self.buffer_size += len(record[0]) + RECORD_OVERHEAD
+        self.count += 1
+        if self.buffer_size >= self.memory_limit:
+            self.spill()
+
+    def extend(self, records):
+        for name, mtime in records:
+            self.add(name, mtime)
+
+    def spill(self):
+        self.buffer.sort()
+        run = tempfile.TemporaryFile(prefix="rex-sort-", dir=self.tmp_dir, buffering=RUN_BUFFER_SIZE)
+        for name, mtime in self.buffer:
+            run.write(RECORD_HEADER.pack(len(name), mtime))
+            run.write(name)
+        run.flush()
+        self.runs.append(run)
+        self.buffer = []
+        self.buffer_size = 0
+
+    @staticmethod
+    def read_run(run):
+        run.seek(0)
+        while True:
+            header = run.read(RECORD_HEADER.size)
+            if not header:
+                return
+            length, mtime = RECORD_HEADER.unpack(header)
+            yield run.read(length), mtime
+
+    def __iter__(self):
+        self.buffer.sort()
+        if not self.runs:
+            return iter(self.buffer)
+        return heapq.merge(self.buffer, *[self.read_run(run) for run in self.runs])
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+
+
+def join_sorted(left, right):
+    """
+    Full outer merge-join of two iterables of (key, value) sorted by key. Yields (key, left_value, right_value) with None
+    for the side a key is missing from.
+    """
+    left, right = iter(left), iter(right)
+    l, r = next(left, None), next(right, None)
+    while l is not None or r is not None:
+        if r is None or (l is not None and l[0] < r[0]):
+            yield l[0], l[1], None
+            l = next(left, None)
+        elif l is None or r[0] < l[0]:
+            yield r[0], None, r[1]
+            r = next(right, None)
+        else:
+            yield l[0], l[1], r[1]
+            l, r = next(left, None), next(right, None)
+
+
+class InconsistencyLog:
+    """
+    Collects inconsistencies without holding all of them in memory. Every message is written to the file at path (if
+    given, it's replaced once the first message comes), only the first keep messages are kept for reports.
+    """
+    def __init__(self, path=None, keep=DEFAULT_KEEP):
+        self.path = path
+        self.keep = keep
+        self.kept = []
+        self.count = 0
+        self.file = None
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for message in self.kept:
+            yield message
+        if self.count > len(self.kept):
+            yield "... and " + str(self.count - len(self.kept)) + " more" + \
+                  (" in " + self.path if self.path else "")
+
+    def append(self, message):
+        self.count += 1
+        if len(self.kept) < self.keep:
+            self.kept.append(message)
+        if self.path:
+            if not self.file:
+                self.file = open(self.path, "w", encoding="utf-8", errors="surrogateescape")
+            self.file.write(message + "\n")
+
+    def extend(self, messages):
+        for message in messages or []:
+            self.append(message)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
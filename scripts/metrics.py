@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import re
+import json
+import fcntl
+import tempfile
+import logging
+import time
+import socket
+import threading
+import contextlib
+
+
+#Files rewritten by concurrent runs are locked through <file>.lock
+LOCK_SUFFIX = ".lock"
+#Phase series of the Prometheus file: name{phase="...",source="...",target="..."} value
+PROMETHEUS_SERIES_PATTERN = re.compile(r'^(\w+)\{phase="(?:[^"\\]|\\.)*",source="((?:[^"\\]|\\.)*)",'
+                                       r'target="((?:[^"\\]|\\.)*)"\} ')
+
+
+class Phases:
+    Downtime = "downtime-check"
+    Archive = "archive"
+    Copy = "copy"
+    Check = "check"
+    Rotation = "rotation"
+
+
+class PhaseMetrics:
+    """
+    Measurements of a single phase of a backup job. processCpu is the CPU time the whole process spent while the phase
+    ran: it includes worker threads of the phase (compression, transfers) but also phases of other jobs running at the
+    same time.
+    """
+    def __init__(self, phase=None, source=None, target=None):
+        self.phase = phase
+        self.source = source
+        self.target = target
+        self.started = None
+        self.wall = 0.0
+        self.processCpu = 0.0
+        self.bytesRead = 0
+        self.bytesWritten = 0
+        self.files = 0
+        self.targets = 1
+        self.success = True
+
+    def get_compression_ratio(self):
+        return float(self.bytesWritten) / self.bytesRead if self.phase == Phases.Archive and self.bytesRead else None
+
+    def get_throughput(self):
+        """
+        Returns MB/s of the bytes read (or written if nothing was read).
+        """
+        size = self.bytesRead or self.bytesWritten
+        return size / 1024.0 / 1024.0 / self.wall if self.wall else 0.0
+
+    def to_dict(self):
+        return {"phase": self.phase, "source": self.source, "target": self.target, "started": self.started,
+                "wall": self.wall, "process_cpu": self.processCpu, "bytes_read": self.bytesRead,
+                "bytes_written": self.bytesWritten, "files": self.files, "targets": self.targets,
+                "compression_ratio": self.get_compression_ratio(), "success": self.success}
+
+
+@contextlib.contextmanager
+def measure(phases, phase, source=None, target=None):
+    """
+    Context manager timing a phase. Yields PhaseMetrics for the phase to fill in its counters, the metrics are appended
+    to the phases list when the phase ends (even if it fails).
+    """
+    metrics = PhaseMetrics(phase, source, target)
+    metrics.started = time.time()
+    wall_start = time.monotonic()
+    cpu_start = time.process_time()
+    try:
+        yield metrics
+    except BaseException:
+        metrics.success = False
+        raise
+    finally:
+        metrics.wall = time.monotonic() - wall_start
+        metrics.processCpu = time.process_time() - cpu_start
+        phases.append(metrics)
+
+
+class ProgressEvents:
+    Started = "started"
+    Progress = "progress"
+    Finished = "finished"
+
+
+class ProgressEvent:
+    """
+    Progress of a phase of a backup job passed to progress callbacks. Counters of started and progress events are the
+    bytes transferred so far, the ones of the finished event are the final counters of the phase (PhaseMetrics).
+    """
+    def __init__(self, event, job, metrics):
+        self.event = event
+        self.job = job
+        self.phase = metrics.phase
+        self.source = metrics.source
+        self.target = metrics.target
+        self.bytesRead = metrics.bytesRead
+        self.bytesWritten = metrics.bytesWritten
+        self.files = metrics.files
+        self.elapsed = metrics.wall if event == ProgressEvents.Finished else time.time() - metrics.started
+        self.success = metrics.success
+
+    def to_dict(self):
+        return {"event": self.event, "job": self.job, "phase": self.phase, "source": self.source,
+                "target": self.target, "bytes_read": self.bytesRead, "bytes_written": self.bytesWritten,
+                "files": self.files, "elapsed": self.elapsed, "success": self.success}
+
+
+class ProgressMeter:
+    """
+    Reports progress of the phases of a backup job to a callback (called with a ProgressEvent). The meter stands in for
+    the Throttle of the job (see #throttle.Throttle): transfers are passed on to io_throttle if given and counted
+    towards the phase running in the calling thread, or the phase started last if the thread runs none (e.g. writer
+    threads of the compressor). Progress is reported at most every interval seconds per phase.
+    """
+    def __init__(self, callback, job=None, io_throttle=None, interval=1.0):
+        self.callback = callback
+        self.job = job
+        self.io_throttle = io_throttle
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.running = []
+        self.threads = dict()
+        self.reported = dict()
+
+    def read(self, amount):
+        if self.io_throttle:
+            self.io_throttle.read(amount)
+        self.count(amount, 0)
+
+    def write(self, amount):
+        if self.io_throttle:
+            self.io_throttle.write(amount)
+        self.count(0, amount)
+
+    def count(self, read, written):
+        with self.lock:
+            progress = self.threads.get(threading.get_ident()) or (self.running[-1] if self.running else None)
+            if progress is None:
+                return
+            progress.bytesRead += read
+            progress.bytesWritten += written
+            now = time.monotonic()
+            if now - self.reported[id(progress)] < self.interval:
+                return
+            self.reported[id(progress)] = now
+            event = ProgressEvent(ProgressEvents.Progress, self.job, progress)
+        self.notify(event)
+
+    def notify(self, event):
+        try:
+            self.callback(event)
+        except Exception as ex:
+            #a broken callback mustn't fail the backup
+            logging.warning("Progress callback failed: " + ex.__str__())
+
+    @contextlib.contextmanager
+    def measure(self, phases, phase, source=None, target=None):
+        """
+        Same as #measure(), the phase is reported when it starts and ends and while it transfers data.
+        """
+        progress = PhaseMetrics(phase, source, target)
+        progress.started = time.time()
+        ident = threading.get_ident()
+        with self.lock:
+            self.running.append(progress)
+            self.threads[ident] = progress
+            self.reported[id(progress)] = time.monotonic()
+        self.notify(ProgressEvent(ProgressEvents.Started, self.job, progress))
+        metrics = None
+        try:
+            with measure(phases, phase, source, target) as metrics:
+                yield metrics
+        finally:
+            with self.lock:
+                self.running.remove(progress)
+                if self.threads.get(ident) is progress:
+                    del self.threads[ident]
+                del self.reported[id(progress)]
+            if metrics is not None:
+                self.notify(ProgressEvent(ProgressEvents.Finished, self.job, metrics))
+
+
+def format_table(phases):
+    """
+    Returns a plain text table summarising phases, suitable for the report email.
+    """
+    lines = ["%-15s %-30s %9s %10s %10s %10s %8s %7s" % ("phase", "source", "wall s", "proc cpu s", "MB read",
+                                                          "MB written", "files", "MB/s")]
+    for m in phases:
+        source = m.source or ""
+        lines.append("%-15s %-30s %9.1f %10.1f %10.1f %10.1f %8d %7.1f%s" % (
+            m.phase, source if len(source) <= 30 else "..." + source[-27:], m.wall, m.processCpu,
+            m.bytesRead / 1048576.0, m.bytesWritten / 1048576.0, m.files, m.get_throughput(),
+            "" if m.success else " FAILED"))
+    return "\n".join(lines)
+
+
+@contextlib.contextmanager
+def lock_file(file_path):
+    """
+    Context manager holding an exclusive lock on <file_path>.lock, serializing runs (of this or other processes) which
+    read and rewrite the file. The lock file outlives renames of the file itself.
+    """
+    with open(file_path + LOCK_SUFFIX, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def replace_file(file_path, data):
+    """
+    Writes data into a uniquely named file next to file_path and renames it over file_path, so readers never see it
+    half written.
+    """
+    fd, part_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + ".", suffix=".part",
+                                     dir=os.path.dirname(os.path.abspath(file_path)))
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+        os.chmod(part_path, 0o644)
+        os.replace(part_path, file_path)
+    except BaseException:
+        if os.path.isfile(part_path):
+            os.remove(part_path)
+        raise
+
+
+def append_json(phases, file_path, status=None, keep_runs=None):
+    """
+    Appends one JSON line describing the run to the metrics history file. If keep_runs is given older runs are dropped
+    from the file, see #trim_json(). Concurrent runs are serialized with #lock_file().
+    """
+    record = {"timestamp": time.time(), "host": socket.gethostname(), "status": status,
+              "phases": [m.to_dict() for m in phases]}
+    with lock_file(file_path):
+        with open(file_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        if keep_runs:
+            trim_json(file_path, keep_runs)
+    return file_path
+
+
+def trim_json(file_path, keep_runs):
+    """
+    Drops runs from the metrics history file which aren't among the last keep_runs runs of any of their sources. The
+    file is written aside and renamed, the caller holds the #lock_file() of the file. Returns the number of dropped
+    runs.
+    """
+    runs = read_json(file_path)
+    counts = dict()
+    kept = []
+    for run in reversed(runs):
+        sources = set(phase.get("source") for phase in run.get("phases", [])) or set([None])
+        for source in sources:
+            counts[source] = counts.get(source, 0) + 1
+        if any(counts[source] <= keep_runs for source in sources):
+            kept.append(run)
+    if len(kept) == len(runs):
+        return 0
+
+    replace_file(file_path, "".join(json.dumps(run) + "\n" for run in reversed(kept)))
+    return len(runs) - len(kept)
+
+
+def read_json(file_path):
+    """
+    Reads all runs recorded in a metrics history file.
+    """
+    runs = []
+    if os.path.isfile(file_path):
+        with open(file_path) as f:
+            for line in f:
+                if line.strip():
+                    runs.append(json.loads(line))
+    return runs
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def read_prometheus_series(file_path):
+    """
+    Reads the series of a Prometheus text file written by #write_prometheus(). Returns a list of (metric name,
+    (source label, target label), line) tuples, labels are escaped as in the file.
+    """
+    series = []
+    if os.path.isfile(file_path):
+        with open(file_path) as f:
+            for line in f:
+                m = PROMETHEUS_SERIES_PATTERN.match(line)
+                if m:
+                    series.append((m.group(1), (m.group(2), m.group(3)), line.rstrip("\n")))
+    return series
+
+
+def write_prometheus(phases, file_path):
+    """
+    Writes phase metrics in the Prometheus text format for the node exporter textfile collector. Series of the
+    sources and targets of the phases replace the ones of their earlier runs, series of other sources and targets
+    (written by other runs) are kept. The file is written aside and renamed so the collector never reads it half
+    written, concurrent runs are serialized with #lock_file().
+    """
+    gauges = [
+        ("rex_backup_phase_duration_seconds", "Wall time of a backup phase.", lambda m: m.wall),
+        ("rex_backup_phase_process_cpu_seconds", "CPU time of the process while a backup phase ran.",
+         lambda m: m.processCpu),
+        ("rex_backup_phase_read_bytes", "Bytes read by a backup phase.", lambda m: m.bytesRead),
+        ("rex_backup_phase_written_bytes", "Bytes written by a backup phase.", lambda m: m.bytesWritten),
+        ("rex_backup_phase_files", "Files processed by a backup phase.", lambda m: m.files),
+        ("rex_backup_phase_targets", "Targets a backup phase wrote into.", lambda m: m.targets),
+        ("rex_backup_phase_success", "1 if a backup phase succeeded, 0 otherwise.", lambda m: 1 if m.success else 0),
+    ]
+    updated = set((escape_label(m.source or ""), escape_label(m.target or "")) for m in phases)
+    with lock_file(file_path):
+        kept = [(name, line) for name, key, line in read_prometheus_series(file_path) if key not in updated]
+        lines = []
+        for name, description, value in gauges:
+            lines.append("# HELP " + name + " " + description)
+            lines.append("# TYPE " + name + " gauge")
+            lines.extend(line for series_name, line in kept if series_name == name)
+            for m in phases:
+                labels = "phase=\"%s\",source=\"%s\",target=\"%s\"" % (escape_label(m.phase),
+                                                                    escape_label(m.source or ""),
+                                                                    escape_label(m.target or ""))
+                lines.append("%s{%s} %s" % (name, labels, repr(float(value(m)))))
+        lines.append("# HELP rex_backup_last_run_timestamp_seconds Time the last backup run finished.")
+        lines.append("# TYPE rex_backup_last_run_timestamp_seconds gauge")
+        lines.append("rex_backup_last_run_timestamp_seconds " + repr(time.time()))
+        replace_file(file_path, "\n".join(lines) + "\n")
+    return file_path
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+
+import os
+import time
+import uuid
+import shutil
+import logging
+import smtplib
+import threading
+import email
+import email.utils
+
+MESSAGE_SUFFIX = ".eml"
+FAILED_DIR_NAME = "failed"
+#Socket timeout of every SMTP operation in seconds
+DEFAULT_TIMEOUT = 30
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 2.0
+#Reports which couldn't be sent for that many days are given up
+DEFAULT_MAX_AGE = 7
+
+
+class OutboxError(Exception):
+     """
+     Abstract outbox error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class Outbox:
+    """
+    Directory of reports waiting to be sent, one <time>-<id>.eml file per message so that reports survive the run which
+    queued them. Messages are sent in the order they were queued, the ones rejected by the mail server are moved into
+    the failed subdirectory.
+    """
+    def __init__(self, dir_path):
+        self.dir_path = dir_path
+        self.failed_dir_path = os.path.join(dir_path, FAILED_DIR_NAME)
+
+    def put(self, message):
+        """
+        Queues an email.message.Message. Returns the path of the queued file.
+        """
+        if not os.path.isdir(self.dir_path):
+            os.makedirs(self.dir_path, exist_ok=True)
+        #the report is dated when it's made, not when it finally gets through
+        if "Date" not in message:
+            message["Date"] = email.utils.formatdate(localtime=True)
+        if "Message-ID" not in message:
+            message["Message-ID"] = email.utils.make_msgid()
+        name = time.strftime("%Y%m%d%H%M%S") + "-" + uuid.uuid4().hex[:8] + MESSAGE_SUFFIX
+        file_path = os.path.join(self.dir_path, name)
+        with open(file_path + ".part", "wb") as f:
+            f.write(message.as_bytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(file_path + ".part", file_path)
+        return file_path
+
+    def get_messages(self):
+        """
+        Returns paths of the queued messages, oldest first.
+        """
+        if not os.path.isdir(self.dir_path):
+            return []
+        return [os.path.join(self.dir_path, n) for n in sorted(os.listdir(self.dir_path)) if n.endswith(MESSAGE_SUFFIX)]
+
+    def read(self, file_path):
+        with open(file_path, "rb") as f:
+            return email.message_from_binary_file(f)
+
+    def remove(self, file_path):
+        os.remove(file_path)
+
+    def reject(self, file_path, reason):
+        """
+        Moves a message which will never be sent out of the queue.
+        """
+        logging.error("Giving up sending report " + os.path.basename(file_path) + ": " + reason)
+        if not os.path.isdir(self.failed_dir_path):
+            os.makedirs(self.failed_dir_path, exist_ok=True)
+        shutil.move(file_path, os.path.join(self.failed_dir_path, os.path.basename(file_path)))
+
+    def __len__(self):
+        return len(self.get_messages())
+
+
+class SmtpSender:
+    """
+    SMTP client which opens one connection (STARTTLS and login included) on first use and reuses it for all messages
+    until closed. Every socket operation times out after timeout seconds.
+    """
+    def __init__(self, host, port, username=None, password=None, tls=True, timeout=DEFAULT_TIMEOUT):
+        self.host = host
+        self.port = int(port)
+        self.username = username
+        self.password = password
+        self.tls = tls
+        self.timeout = timeout
+        self.connection = None
+
+    def send(self, message):
+        if self.connection is None:
+            connection = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+            try:
+                if self.tls:
+                    connection.starttls()
+                if self.username:
+                    connection.login(self.username, self.password)
+            except Exception:
+                connection.close()
+                raise
+            self.connection = connection
+        self.connection.send_message(message)
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except Exception:
+                self.connection.close()
+            self.connection = None
+
+
+def is_permanent_failure(ex):
+    """
+    Tells if the mail server refused a message for good, retrying it would not help.
+    """
+    if isinstance(ex, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, msg in ex.recipients.values())
+    return isinstance(ex, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)) and ex.smtp_code >= 500
+
+
+class ReportSender:
+    """
+    Background thread delivering the outbox through senders made by sender_factory. Failed deliveries are retried with
+    exponential backoff, messages still queued after that are sent by a later run. Callers only wait for it as long as
+    they want to with #wait().
+    """
+    def __init__(self, outbox, sender_factory, retries=DEFAULT_RETRIES, backoff=DEFAULT_BACKOFF, max_age=DEFAULT_MAX_AGE):
+        self.outbox = outbox
+        self.sender_factory = sender_factory
+        self.retries = retries
+        self.backoff = backoff
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.pending = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Starts delivering the outbox unless it's empty. Messages queued while a delivery is running are picked up by it.
+        """
+        with self.lock:
+            self.pending.set()
+            if self.thread is None or not self.thread.is_alive():
+                if not self.outbox.get_messages():
+                    return
+                self.thread = threading.Thread(target=self.run, name="report-sender")
+                self.thread.daemon = True
+                self.thread.start()
+
+    def wait(self, timeout=None):
+        """
+        Waits up to timeout seconds for the delivery to finish. Returns True if nothing is being sent anymore.
+        """
+        thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+            if thread.is_alive():
+                logging.warning("Reports are still being sent, " + str(len(self.outbox)) + \
+                                " queued reports are left to a later run")
+                return False
+        return True
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.pending.is_set():
+                    return
+                self.pending.clear()
+            try:
+                self.flush()
+            except Exception as ex:
+                logging.error("Failed to send reports: " + ex.__str__())
+
+    def flush(self):
+        """
+        Sends all queued messages over one connection. Returns True if the outbox was emptied.
+        """
+        sender = self.sender_factory()
+        attempt = 0
+        try:
+            while True:
+                try:
+                    paths = self.outbox.get_messages()
+                    if not paths:
+                        return True
+                    for path in paths:
+                        if time.time() - os.path.getmtime(path) > self.max_age * 24 * 3600:
+                            self.outbox.reject(path, "not sent for more than " + str(self.max_age) + " days")
+                            continue
+                        try:
+                            sender.send(self.outbox.read(path))
+                        except smtplib.SMTPException as ex:
+                            if not is_permanent_failure(ex):
+                                raise
+                            self.outbox.reject(path, ex.__str__())
+                            continue
+                        self.outbox.remove(path)
+                        attempt = 0
+                        logging.info("Report sent: " + os.path.basename(path))
+                except (smtplib.SMTPException, OSError) as ex:
+                    sender.close()
+                    attempt += 1
+                    if attempt > self.retries:
+                        logging.error("Failed to send reports, " + str(len(self.outbox)) + \
+                                      " reports stay queued for a later run: " + ex.__str__())
+                        return False
+                    delay = self.backoff * 2 ** (attempt - 1)
+                    logging.warning("Failed to send reports, retrying in " + str(delay) + " seconds: " + ex.__str__())
+                    time.sleep(delay)
+        finally:
+            sender.close()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import time
+import zlib
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+#Deflate can reference up to 32K of preceding data, that much of the previous block is used as a dictionary
+WINDOW_SIZE = 32 * 1024
+DEFAULT_BLOCK_SIZE = 128 * 1024
+DEFAULT_LEVEL = 9
+READ_SIZE = 1024 * 1024
+
+
+def compress_block(data, dictionary, level):
+    """
+    Compresses a single block into a raw deflate stream ending on a byte boundary (sync flush), so that compressed
+    blocks can simply be concatenated. The tail of the previous block is used as a dictionary to keep the ratio close
+    to the one of a single-threaded stream.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+                                      zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ParallelGzipWriter:
+    """
+    Write-only file object producing a standard single member gzip stream into fileobj. Written data is cut into
+    block_size blocks which are compressed independently by a pool of workers (the way pigz does it) and written out in
+    order. While set_store(True) is in effect blocks are stored (deflate level 0) instead of compressed, which saves the
+    effort on content that is compressed already. Closing the writer doesn't close the underlying fileobj.
+
+    Every block starts on a byte boundary and only refers to its dictionary, so decompression can start at any block
+    given the dictionary (like zran does). If seek_interval is given, on_seek_point(offset, compressed_offset, window)
+    is called for the first block starting at least seek_interval bytes after the previous seek point.
+    """
+    def __init__(self, fileobj, name="", level=DEFAULT_LEVEL, block_size=DEFAULT_BLOCK_SIZE, workers=None,
+                 seek_interval=None, on_seek_point=None):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_level = level
+        self.block_size = max(WINDOW_SIZE, int(block_size))
+        self.workers = max(1, int(workers if workers else os.cpu_count() or 1))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers) if self.workers > 1 else None
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.dictionary = b""
+        self.crc = 0
+        self.size = 0
+        self.closed = False
+        self.seek_interval = seek_interval if on_seek_point else None
+        self.on_seek_point = on_seek_point
+        self.next_seek_point = 0
+        self.compressed_size = 0
+        self._write_header(name)
+
+    def _write_header(self, name):
+        flags = 0
+        fname = b""
+        if name:
+            flags = 0x08
+            fname = os.path.basename(name).encode("latin-1", "replace") + b"\0"
+        self._write(b"\x1f\x8b\x08" + struct.pack("<BLBB", flags, int(time.time()), 0, 255) + fname)
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.compressed_size += len(data)
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self.buffer += data
+        while len(self.buffer) >= self.block_size:
+            block = bytes(self.buffer[:self.block_size])
+            del self.buffer[:self.block_size]
+            self._submit(block)
+        return len(data)
+
+    def _submit(self, block):
+        seek_point = None
+        if self.seek_interval and self.size >= self.next_seek_point:
+            seek_point = (self.size, self.dictionary)
+            self.next_seek_point = self.size + self.seek_interval
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        if self.executor:
+            self.pending.append((self.executor.submit(compress_block, block, self.dictionary, self.block_level),
+                                 seek_point))
+            #keeps memory bounded when compression is slower than the producer
+            while len(self.pending) > 2 * self.workers:
+                future, seek_point = self.pending.popleft()
+                self._write_block(future.result(), seek_point)
+        else:
+            self._write_block(compress_block(block, self.dictionary, self.block_level), seek_point)
+        self.dictionary = block[-WINDOW_SIZE:]
+
+    def _write_block(self, compressed, seek_point):
+        if seek_point is not None:
+            self.on_seek_point(seek_point[0], self.compressed_size, seek_point[1])
+        self._write(compressed)
+
+    def set_store(self, store):
+        """
+        Switches between storing and compressing data written from now on, buffered data is cut into a block first.
+        """
+        level = 0 if store else self.level
+        if level != self.block_level:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            self.block_level = level
+
+    def tell(self):
+        return self.size + len(self.buffer)
+
+    def flush(self):
+        while self.pending:
+            future, seek_point = self.pending.popleft()
+            self._write_block(future.result(), seek_point)
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self.buffer:
+                self._submit(bytes(self.buffer))
+                self.buffer = bytearray()
+            self.flush()
+            #an empty final deflate block terminates the stream
+            self._write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+            self._write(struct.pack("<LL", self.crc & 0xffffffff, self.size & 0xffffffff))
+            self.fileobj.flush()
+        finally:
+            self.closed = True
+            if self.executor:
+                self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        elif self.executor:
+            self.closed = True
+            self.executor.shutdown(wait=False)
+
+
+class InflateReader:
+    """
+    Read-only file object decompressing a gzip stream written by ParallelGzipWriter from the current position of fileobj,
+    which has to be the start of one of its blocks, window being the dictionary of that block.
+    """
+    def __init__(self, fileobj, window=b""):
+        self.fileobj = fileobj
+        if window:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=window)
+        else:
+            self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.buffer = b""
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        available = len(self.buffer)
+        while (size is None or size < 0 or available < size) and not self.decompressor.eof:
+            data = self.decompressor.unconsumed_tail or self.fileobj.read(READ_SIZE)
+            if not data:
+                break
+            #output is bounded, highly compressible data would blow up otherwise
+            data = self.decompressor.decompress(data, READ_SIZE)
+            chunks.append(data)
+            available += len(data)
+        data = b"".join(chunks)
+        if size is None or size < 0:
+            self.buffer = b""
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+    def close(self):
+        self.buffer = b""
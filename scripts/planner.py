@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import zlib
+import heapq
+import random
+import logging
+import collections
+
+import fileutils
+import walker
+import metrics
+import compressors
+
+#Number of files (picked with a probability proportional to their size) a sample of a source compresses
+SAMPLE_FILES = 64
+#Number of recent runs of a source its estimates are based on
+HISTORY_RUNS = 10
+#Rates assumed without any history
+DEFAULT_ARCHIVE_RATE = 20 * 1024 * 1024
+DEFAULT_COPY_RATE = 50 * 1024 * 1024
+DEFAULT_CHECK_FILE_TIME = 0.001
+DEFAULT_RATIO = 0.5
+
+
+class SourceSample:
+    """
+    Counts of a source: all regular files and the ones changed since the base archive (all of them without a base),
+    plus the sizes of the samples taken from changed files before and after compression.
+    """
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.changedFiles = 0
+        self.changedBytes = 0
+        self.sampledBytes = 0
+        self.compressedBytes = 0
+
+    def get_ratio(self):
+        """
+        Returns the compression ratio of the sampled content (None if nothing was sampled).
+        """
+        return float(self.compressedBytes) / self.sampledBytes if self.sampledBytes else None
+
+
+def sample_source(source, file_filter=None, since=None, sample_files=SAMPLE_FILES, threads=1):
+    """
+    Walks the source (only metadata is read) and compresses the beginning of sample_files changed files, picked with a
+    probability proportional to their size so that the ratio is weighted by size like the archive is. Files modified
+    before since (a timestamp) are counted as unchanged. Returns a SourceSample.
+    """
+    sample = SourceSample()
+    rng = random.Random(source)
+    picked = []
+    for entry in walker.walk(source, with_stat=True, threads=threads, file_filter=file_filter):
+        if entry.is_dir or entry.is_link or not entry.stat:
+            continue
+        size = entry.stat.st_size
+        sample.files += 1
+        sample.bytes += size
+        if since is not None and entry.stat.st_mtime < since:
+            continue
+        sample.changedFiles += 1
+        sample.changedBytes += size
+        if size > 0:
+            #weighted reservoir sampling (Efraimidis-Spirakis), the files with the largest keys are kept
+            item = (rng.random() ** (1.0 / size), entry.path)
+            if len(picked) < sample_files:
+                heapq.heappush(picked, item)
+            elif item > picked[0]:
+                heapq.heapreplace(picked, item)
+
+    for key, path in picked:
+        try:
+            with open(path, "rb") as f:
+                data = f.read(compressors.SAMPLE_SIZE)
+        except OSError as ex:
+            logging.debug("Can't sample " + path + ": " + ex.__str__())
+            continue
+        if not data:
+            continue
+        sample.sampledBytes += len(data)
+        if os.path.splitext(path)[1].lower() in compressors.INCOMPRESSIBLE_EXTENSIONS:
+            sample.compressedBytes += len(data)
+        else:
+            sample.compressedBytes += min(len(data), len(zlib.compress(data, 1)))
+    return sample
+
+
+class History:
+    """
+    Archive, copy and check phases of the runs recorded in the metrics history (see #metrics.read_json()), only the
+    successful phases of the last HISTORY_RUNS runs of every source are kept.
+    """
+    def __init__(self, runs, history_runs=HISTORY_RUNS):
+        self.phases = collections.defaultdict(lambda: collections.deque(maxlen=history_runs))
+        for run in runs:
+            for phase in run.get("phases", []):
+                if phase.get("success") and phase.get("wall"):
+                    self.phases[(phase["phase"], phase["source"])].append(phase)
+
+    def get_phases(self, phase, source=None):
+        """
+        Returns recent phases of the source, or of all sources if source is None.
+        """
+        if source is not None:
+            return list(self.phases.get((phase, source), []))
+        return [p for (name, s), phases in self.phases.items() if name == phase for p in phases]
+
+    def get_median(self, phase, source, value):
+        """
+        Returns the median of value(phase) over the recent phases of the source, falling back to all sources (None if
+        there are none). Phases value returns None for are left out.
+        """
+        for phases in (self.get_phases(phase, source), self.get_phases(phase)):
+            values = sorted(v for v in (value(p) for p in phases) if v is not None)
+            if values:
+                return values[len(values) // 2]
+        return None
+
+    def has_source(self, phase, source):
+        return len(self.get_phases(phase, source)) > 0
+
+
+class JobEstimate:
+    """
+    Predicted work of a backup job: files and bytes read from the source, size of the archive written into every
+    target and seconds of its phases. start and end are set by #simulate(), a job within its backup downtime has
+    nothing to do.
+    """
+    def __init__(self, backup, kind=None, downtime=False):
+        self.backup = backup
+        self.kind = kind
+        self.downtime = downtime
+        self.sampled = False
+        self.files = 0
+        self.bytes = 0
+        self.archiveBytes = 0
+        self.archiveSeconds = 0.0
+        self.copySeconds = 0.0
+        self.checkSeconds = 0.0
+        self.start = 0.0
+        self.end = 0.0
+        self.deferred = False
+        self.mounts = set(fileutils.get_mount_point(target) for target in backup.targets or [backup.target])
+
+    @property
+    def seconds(self):
+        return self.archiveSeconds + self.copySeconds + self.checkSeconds
+
+
+def get_archive_ratio(phase):
+    #bytes written into all targets were recorded before the number of targets was
+    targets = 1 if "targets" in phase else len((phase.get("target") or "").split(", "))
+    return float(phase["bytes_written"]) / targets / phase["bytes_read"] if phase.get("bytes_read") else None
+
+
+def estimate_job(estimate, history, sample=None, copied=False, checked=True, deep_check=False):
+    """
+    Fills in an estimate from the source sample (the recent archives of the source in the history if no sample is
+    given) and the rates of the history: archive throughput and compression ratio, copy throughput (if the archive is
+    copied, i.e. staged locally) and check time per file (if checked, archive bytes are read at the archive rate by
+    deep checks of sources without history). Sources without history are estimated with the rates of all sources or
+    the default ones. Returns the estimate.
+    """
+    source = estimate.backup.source
+    if sample is not None:
+        estimate.sampled = True
+        estimate.files, estimate.bytes = sample.changedFiles, sample.changedBytes
+    else:
+        estimate.files = history.get_median(metrics.Phases.Archive, source, lambda p: p.get("files")) or 0
+        estimate.bytes = history.get_median(metrics.Phases.Archive, source, lambda p: p.get("bytes_read")) or 0
+    if history.has_source(metrics.Phases.Archive, source) or sample is None or sample.get_ratio() is None:
+        ratio = history.get_median(metrics.Phases.Archive, source, get_archive_ratio)
+    else:
+        ratio = sample.get_ratio()
+    estimate.archiveBytes = int(estimate.bytes * (ratio if ratio is not None else DEFAULT_RATIO))
+
+    rate = history.get_median(metrics.Phases.Archive, source, lambda p: p["bytes_read"] / p["wall"] if p.get("bytes_read") else None)
+    estimate.archiveSeconds = estimate.bytes / (rate or DEFAULT_ARCHIVE_RATE)
+    if copied:
+        rate = history.get_median(metrics.Phases.Copy, source, lambda p: p["bytes_written"] / p["wall"] if p.get("bytes_written") else None)
+        estimate.copySeconds = estimate.archiveBytes / (rate or DEFAULT_COPY_RATE)
+    if checked:
+        if history.has_source(metrics.Phases.Check, source):
+            file_time = history.get_median(metrics.Phases.Check, source, lambda p: p["wall"] / p["files"] if p.get("files") else None)
+            estimate.checkSeconds = estimate.files * (file_time or DEFAULT_CHECK_FILE_TIME)
+        else:
+            estimate.checkSeconds = estimate.files * DEFAULT_CHECK_FILE_TIME
+            if deep_check:
+                estimate.checkSeconds += estimate.archiveBytes / DEFAULT_ARCHIVE_RATE
+    return estimate
+
+
+class Plan:
+    """
+    Order jobs are handed to the scheduler in and the predicted run: runtime is the predicted time in seconds from the
+    start of the first job to the end of the last one. Deferred jobs are left out of the run as they would end after
+    the backup window (seconds, 0 if there is none).
+    """
+    def __init__(self, estimates, runtime, window=0, deferred=None):
+        self.estimates = estimates
+        self.runtime = runtime
+        self.window = window
+        self.deferred = deferred if deferred else []
+
+    def get_backups(self):
+        return [e.backup for e in self.estimates]
+
+    def exceeds_window(self):
+        return bool(self.window) and self.runtime > self.window
+
+
+def simulate(estimates, max_workers=1, max_jobs_per_target=1):
+    """
+    Predicts when every job starts and ends if the jobs are handed in this order to a #scheduler.BackupScheduler, which
+    starts the first pending jobs whose target mount points have a free slot whenever a worker is free. Returns the
+    predicted runtime.
+    """
+    max_workers = max(1, int(max_workers))
+    max_jobs_per_target = max(1, int(max_jobs_per_target))
+    pending = list(estimates)
+    running = []
+    active = collections.Counter()
+    now = 0.0
+    while pending or running:
+        for estimate in list(pending):
+            if len(running) >= max_workers:
+                break
+            if all(active[mount] < max_jobs_per_target for mount in estimate.mounts):
+                pending.remove(estimate)
+                active.update(estimate.mounts)
+                estimate.start = now
+                estimate.end = now + (0.0 if estimate.downtime else estimate.seconds)
+                running.append(estimate)
+        finished = min(running, key=lambda e: e.end)
+        running.remove(finished)
+        active.subtract(finished.mounts)
+        now = max(now, finished.end)
+    return now
+
+
+def make_plan(estimates, max_workers=1, max_jobs_per_target=1, longest_first=True, window=0, defer=False):
+    """
+    Plans a run. With longest_first the jobs are ordered by their predicted time, longest first, which keeps the
+    workers busy until the end of the run instead of leaving one long job running alone. With defer the jobs are
+    added in this order and a job is deferred if it would make itself or a job added before it end after the window
+    (in seconds) which it didn't before, so shorter jobs may still fill the gaps. Jobs starting right away are never
+    deferred as waiting can't make them fit. Returns a Plan.
+    """
+    ordered = list(estimates)
+    if longest_first:
+        ordered.sort(key=lambda e: 0.0 if e.downtime else e.seconds, reverse=True)
+    if not (window and defer):
+        return Plan(ordered, simulate(ordered, max_workers, max_jobs_per_target), window)
+
+    planned = []
+    deferred = []
+    late = set()
+    for estimate in ordered:
+        planned.append(estimate)
+        simulate(planned, max_workers, max_jobs_per_target)
+        now_late = set(id(e) for e in planned if e.end > window)
+        if (id(estimate) in now_late and estimate.start > 0) or now_late - late - set([id(estimate)]):
+            planned.remove(estimate)
+            estimate.deferred = True
+            deferred.append(estimate)
+        else:
+            late = now_late
+    return Plan(planned, simulate(planned, max_workers, max_jobs_per_target), window, deferred)
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+
+def format_plan(plan):
+    """
+    Returns a plain text table of the planned jobs followed by the predicted runtime.
+    """
+    lines = ["%-30s %-12s %9s %10s %10s %9s %9s %9s" % ("source", "kind", "files", "MB read", "MB archive", "duration",
+                                                        "start", "end")]
+    for e in plan.estimates + plan.deferred:
+        source = e.backup.source
+        if e.downtime:
+            kind = "downtime"
+        else:
+            kind = (e.kind or "") + ("" if e.sampled else "*")
+        lines.append("%-30s %-12s %9d %10.1f %10.1f %9s %9s %9s%s" % (
+            source if len(source) <= 30 else "..." + source[-27:], kind, e.files, e.bytes / 1048576.0,
+            e.archiveBytes / 1048576.0, format_duration(0 if e.downtime else e.seconds),
+            "-" if e.deferred else format_duration(e.start), "-" if e.deferred else format_duration(e.end),
+            " DEFERRED" if e.deferred else ""))
+    if not all(e.sampled or e.downtime for e in plan.estimates + plan.deferred):
+        lines.append("* estimated from earlier runs of the source")
+    lines.append("Predicted runtime: " + format_duration(plan.runtime) +
+                 (" of a " + format_duration(plan.window) + " backup window" if plan.window else ""))
+    if plan.exceeds_window():
+        lines.append("WARNING: the run is predicted to exceed the backup window by " +
+                     format_duration(plan.runtime - plan.window))
+    if plan.deferred:
+        lines.append("Deferred to the next run: " + ", ".join(e.backup.source for e in plan.deferred))
+    return "\n".join(lines)
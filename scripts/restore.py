@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import fnmatch
+import tarfile
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import volumes
+import fileutils
+import compressors
+import archiveindex
+
+READ_SIZE = 1024 * 1024
+#Refuses absolute paths and links pointing outside of the restore dir where tarfile supports extraction filters
+EXTRACT_FILTER = "tar" if hasattr(tarfile, "tar_filter") else None
+
+
+class RestoreError(Exception):
+     """
+     Abstract restore error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class ExtractGroup:
+    """
+    Members restored from one stretch of the archive: decompression starts at the seek point (None means the start of
+    the archive), skips to the first member and ends after the last one.
+    """
+    def __init__(self, point):
+        self.point = point
+        self.entries = []
+
+
+def normalize_name(name):
+    """
+    Strips the leading "./" (or "/") of member names and patterns, the archive root becomes an empty string.
+    """
+    name = name.strip("/")
+    while name == "." or name.startswith("./"):
+        name = name[2:]
+    return name
+
+
+def is_selected(name, patterns):
+    """
+    Decides if a member is selected by any of the glob patterns (see #normalize_name()). A pattern matching a directory
+    selects everything below it as well.
+    """
+    name = normalize_name(name)
+    if not name:
+        return False
+    prefixes = [name]
+    while "/" in prefixes[-1]:
+        prefixes.append(prefixes[-1].rsplit("/", 1)[0])
+    return any(fnmatch.fnmatchcase(prefix, pattern) for pattern in patterns for prefix in prefixes)
+
+
+def read_selected_entries(archive_path, patterns):
+    """
+    Returns the indexed members selected by the patterns in archive order, or None if the archive has no usable member
+    index.
+    """
+    index_path = archiveindex.get_index_path(archive_path)
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        entries, trailer = archiveindex.read_index(index_path)
+    except Exception as ex:
+        logging.warning("Failed to read archive index, the archive will be scanned. Reason: " + ex.__str__())
+        return None
+    if trailer["archive_size"] != fileutils.get_archive_size(archive_path):
+        logging.warning("Archive index doesn't match the archive, the archive will be scanned: " + index_path)
+        return None
+    return [entry for entry in entries if is_selected(entry.name, patterns)]
+
+
+def read_seek_index(archive_path):
+    seek_index_path = archiveindex.get_seek_index_path(archive_path)
+    if not os.path.isfile(seek_index_path):
+        return None
+    try:
+        return archiveindex.SeekIndex(seek_index_path)
+    except Exception as ex:
+        logging.warning("Failed to read seek index, the archive will be read from its start. Reason: " + ex.__str__())
+        return None
+
+
+def make_groups(entries, seek_index):
+    """
+    Groups entries by the seek point preceding them, every group can be extracted independently of the others.
+    """
+    groups = []
+    for entry in entries:
+        point = seek_index.find(entry.offset) if seek_index else None
+        if not groups or groups[-1].point is not point:
+            groups.append(ExtractGroup(point))
+        groups[-1].entries.append(entry)
+    return groups
+
+
+def skip(stream, size):
+    while size > 0:
+        data = stream.read(min(size, READ_SIZE))
+        if not data:
+            raise RestoreError("Archive ended before the indexed member offset")
+        size -= len(data)
+
+
+def extract_member(archive_file, member, dest_dir, directories):
+    if member.isdir():
+        #modification time of directories is restored once their content is extracted
+        directories.append((os.path.join(dest_dir, normalize_name(member.name)), member.mtime))
+    if EXTRACT_FILTER:
+        archive_file.extract(member, dest_dir, filter=EXTRACT_FILTER)
+    else:
+        archive_file.extract(member, dest_dir)
+
+
+def extract_group(archive_path, codec, seek_index, group, dest_dir):
+    """
+    Extracts the members of a group. Returns a tuple (restored names, directories, errors).
+    """
+    restored, directories, errors = [], [], []
+    wanted = dict((entry.name, entry) for entry in group.entries)
+    start = group.point.offset if group.point else 0
+    with volumes.open_archive(archive_path) as f:
+        if group.point:
+            stream = compressors.open_seek_reader(f, codec, group.point.compressed_offset,
+                                                  seek_index.get_window(group.point))
+        else:
+            stream = compressors.open_reader(f)
+        try:
+            skip(stream, group.entries[0].offset - start)
+            with tarfile.open(fileobj=stream, mode="r|") as archive_file:
+                while wanted:
+                    member = archive_file.next()
+                    if member is None:
+                        break
+                    archive_file.members = []
+                    if wanted.pop(member.name, None) is None:
+                        continue
+                    try:
+                        extract_member(archive_file, member, dest_dir, directories)
+                        restored.append(member.name)
+                    except Exception as ex:
+                        errors.append("Failed to restore " + member.name + ": " + ex.__str__())
+        finally:
+            stream.close()
+    for name in wanted:
+        errors.append("Member not found in the archive: " + name)
+    return restored, directories, errors
+
+
+def scan_archive(archive_path, patterns, dest_dir):
+    """
+    Extracts the selected members of an archive without a member index in a single pass over the whole archive.
+    Returns a tuple (restored names, directories, errors).
+    """
+    restored, directories, errors = [], [], []
+    with volumes.open_archive(archive_path) as f:
+        with compressors.open_reader(f) as stream, tarfile.open(fileobj=stream, mode="r|") as archive_file:
+            for member in archive_file:
+                archive_file.members = []
+                if not is_selected(member.name, patterns):
+                    continue
+                try:
+                    extract_member(archive_file, member, dest_dir, directories)
+                    restored.append(member.name)
+                except Exception as ex:
+                    errors.append("Failed to restore " + member.name + ": " + ex.__str__())
+    return restored, directories, errors
+
+
+def restore(archive_path, patterns, dest_dir, workers=4):
+    """
+    Extracts the members of an archive (a file or a volume set) matching any of the glob patterns (e.g. "etc/*.conf",
+    a directory selects its whole content) into dest_dir. Members are looked up in the member index and decompression
+    starts at the nearest seek point before them, so only the stretches of the archive holding selected members are
+    read. Stretches following different seek points are extracted by a pool of workers in parallel. Archives without an
+    index are scanned from their start. Returns a tuple (restored names, errors).
+    """
+    if not fileutils.archive_exists(archive_path):
+        raise RestoreError("Archive doesn't exist: " + archive_path)
+    patterns = [normalize_name(pattern) or "*" for pattern in patterns]
+    fileutils.ensure_dir(dest_dir)
+
+    entries = read_selected_entries(archive_path, patterns)
+    if entries is None:
+        logging.info("Scanning archive " + archive_path + " for members to restore")
+        restored, directories, errors = scan_archive(archive_path, patterns, dest_dir)
+    else:
+        seek_index = read_seek_index(archive_path)
+        groups = make_groups(entries, seek_index)
+        logging.info("Restoring " + str(len(entries)) + " members from " + str(len(groups)) + " parts of archive " + \
+                     archive_path)
+        #parents are created upfront as workers would race creating them
+        for entry in entries:
+            parent = os.path.dirname(normalize_name(entry.name))
+            if parent:
+                os.makedirs(os.path.join(dest_dir, parent), exist_ok=True)
+        with volumes.open_archive(archive_path) as f:
+            codec = compressors.detect_codec(f.read(6))
+        restored, directories, errors = [], [], []
+        with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+            futures = [executor.submit(extract_group, archive_path, codec, seek_index, group, dest_dir)
+                       for group in groups]
+            for group, future in zip(groups, futures):
+                try:
+                    group_restored, group_directories, group_errors = future.result()
+                except Exception as ex:
+                    group_restored, group_directories, group_errors = [], [], [
+                        "Failed to restore " + str(len(group.entries)) + " members starting with " + \
+                        group.entries[0].name + ": " + ex.__str__()]
+                restored += group_restored
+                directories += group_directories
+                errors += group_errors
+
+    #deepest directories first, so that restoring a parent's time isn't undone by its children
+    for dir_path, mtime in sorted(directories, key=lambda d: d[0], reverse=True):
+        try:
+            os.utime(dir_path, (mtime, mtime))
+        except OSError as ex:
+            errors.append("Failed to restore modification time of " + dir_path + ": " + ex.__str__())
+    logging.info("Restored " + str(len(restored)) + " members, " + str(len(errors)) + " errors")
+    return restored, errors
@@ -21,16 +21,37 @@ __version__ = 1.1
 import logging
 import datetime
 import time
-import smtplib
+import copy
+import itertools
 import operator
-import socket
 import os
 import re
-from email.mime.text import MIMEText
+import threading
+import signal
 from optparse import OptionParser
 
 import fileutils
 import config
+import manifest
+import catalog
+import volumes
+import compressors
+from lazyimport import LazyModule
+
+#modules only needed once a backup is due are imported on first use
+scheduler = LazyModule("scheduler")
+chunkstore = LazyModule("chunkstore")
+archiveindex = LazyModule("archiveindex")
+verifier = LazyModule("verifier")
+metrics = LazyModule("metrics")
+copyengine = LazyModule("copyengine")
+throttle = LazyModule("throttle")
+mergejoin = LazyModule("mergejoin")
+watcher = LazyModule("watcher")
+outbox = LazyModule("outbox")
+restore = LazyModule("restore")
+filters = LazyModule("filters")
+planner = LazyModule("planner")
 
 
 class Status:
@@ -50,45 +71,140 @@ class Tasks:
     Backup = "backup task"
     Check = "backup check task"
     Cleanup = "cleanup task"
+    Rotation = "rotation task"
+    Plan = "backup planning"
+
+
+class BackupModes:
+    Full = "full"
+    Incremental = "incremental"
+    Differential = "differential"
+
+
+class TargetFormats:
+    Archive = "archive"
+    ChunkStore = "chunkstore"
+
+
+class Staging:
+    Stream = "stream"
+    Local = "local"
+
+
+class CheckModes:
+    Index = "index"
+    Digest = "digest"
+    Deep = "deep"
 
 
-ARCHIVE_FORMATS = ["zip", "tar", "bztar", "gztar"]
-messages = []
-status = Status.Success
-skipped_backups = 0
-inconsistencies_found = 0
+class JobOrders:
+    LongestFirst = "longest-first"
+    Config = "config"
+
+
+class WindowActions:
+    Warn = "warn"
+    Defer = "defer"
+
+
+ARCHIVE_FORMATS = ["tar" + extension for extension in sorted(set(compressors.EXTENSIONS.values()))]
+ARCHIVE_FORMAT_PATTERN = r"\.(" + "|".join(re.escape(f) for f in ARCHIVE_FORMATS) + ")"
+ARCHIVE_NAME_PATTERN = re.compile(r"^.*-\d+((\.incr|\.diff)?" + ARCHIVE_FORMAT_PATTERN + r"(\.volumes)?|\.snapshot)$")
+ARCHIVE_DATE_PATTERN = re.compile(r"(?<=-)(\d+)(?=((\.incr|\.diff)?" + ARCHIVE_FORMAT_PATTERN + r"|\.snapshot))")
+ARCHIVE_KIND_PATTERN = re.compile(r"-\d+\.(incr|diff)" + ARCHIVE_FORMAT_PATTERN + "$")
+CATALOG_FILE_NAME = "catalog.sqlite"
+CONFIG_CACHE_FILE_NAME = "config.cache"
+OUTBOX_DIR_NAME = "outbox"
+METRICS_FILE_NAME = "metrics.jsonl"
+JOURNALS_DIR_NAME = "journals"
+
+archive_catalog = None
+archive_catalog_lock = threading.Lock()
+report_sender = None
+report_sender_lock = threading.Lock()
+#state shared by all runs of the process: ids of job tmp dirs, number of runs in progress and (source, target) pairs
+#being backed up
+job_ids = itertools.count()
+active_runs = 0
+running_backups = set()
+run_state_lock = threading.Lock()
 
 
 #-----------------------------------------------------------------------------------------------------------------------
 # General functions
 #-----------------------------------------------------------------------------------------------------------------------
-def get_global_status():
+class TaskResult:
     """
-    Parses global status and messages and determines real status of a backup.
+    Outcome of a single task of a job: its status (see Status), the task (see Tasks), where it took place and a message.
     """
-    global status
-    failedMessages = []
-    if status == Status.Skipped:
-        return status
-    for m in messages:
-        if m.startswith(Status.Failed):
-            failedMessages.append(m)
-            status = Status.Incomplete
+    def __init__(self, status, task, location, message=""):
+        self.status = status
+        self.task = task
+        self.location = location
+        self.message = message
 
-    for m in failedMessages:
-        if Tasks.Backup in m:
-            status = Status.Failed
+    def __str__(self):
+        template = get_template_by_status(self.status)
+        return self.status + ": " + (template % {"what": self.task, "where": self.location}) + "\n" + self.message
 
-    return status
 
+class JobResult:
+    """
+    Contains task results and counters collected while running a single backup job (or merged from several jobs).
+    archives lists the paths of the archives (or snapshots) written into the targets.
+    """
+    def __init__(self, source=None):
+        self.source = source
+        self.backups = 1 if source else 0
+        self.tasks = []
+        self.skipped = 0
+        self.inconsistencies = 0
+        self.phases = []
+        self.archives = []
+
+    @property
+    def messages(self):
+        return [task.__str__() for task in self.tasks]
+
+    def add_message(self, status, task_type, location, message=""):
+        """
+        Adds provided info to the task results.
+        """
+        self.tasks.append(TaskResult(status, task_type, location, message))
+
+    def get_status(self):
+        return get_global_status(self, self.backups)
 
-def add_message(status, task_type, location, message=""):
+    def merge(self, other):
+        """
+        Appends task results and counters of another result to this one.
+        """
+        self.backups += other.backups
+        self.tasks.extend(other.tasks)
+        self.skipped += other.skipped
+        self.inconsistencies += other.inconsistencies
+        self.phases.extend(other.phases)
+        self.archives.extend(other.archives)
+        return self
+
+
+def get_global_status(result, total_backups):
     """
-    Adds provided info to the messages.
+    Determines real status of a run from its merged job results.
     """
-    global messages
-    template = get_template_by_status(status)
-    messages.append(status + ": " + (template % {"what": task_type, "where": location}) + "\n" + message)
+    if total_backups > 0 and result.skipped == total_backups:
+        return Status.Skipped
+
+    status = Status.Success
+    for task in result.tasks:
+        if task.status == Status.Failed:
+            status = Status.Incomplete
+
+    for task in result.tasks:
+        if task.status == Status.Failed and task.task == Tasks.Backup:
+            status = Status.Failed
+
+    return status
 
 
 def get_template_by_status(status):
@@ -106,109 +222,817 @@ def get_template_by_status(status):
 #-----------------------------------------------------------------------------------------------------------------------
 # Main tasks and routines
 #-----------------------------------------------------------------------------------------------------------------------
-def main():
-    global status, skipped_backups, inconsistencies_found
+def main(daemon=False, config_file_path=None):
     #Processing configuration
-    rex_config = None
+    rex_config = read_rex_config(config_file_path)
+
+    if rex_config and rex_config.performReporting and has_queued_reports():
+        #reports earlier runs couldn't send go out while this run works
+        get_report_sender(rex_config.reporterConfig).start()
+
+    if rex_config and not daemon and is_all_downtime_period(rex_config.backups):
+        #nothing to back up, check, rotate or report
+        logging.info("All backups are within their backup downtime, nothing to do.")
+        wait_for_reports(rex_config)
+        return
+
+    if rex_config:
+        if len(rex_config.backups) > 0:
+            try:
+                throttle.set_priority(rex_config.niceness, rex_config.ioClass, rex_config.ioPriority)
+            except Exception as ex:
+                logging.warning("Failed to lower process priority: " + ex.__str__())
+        if daemon:
+            run_daemon(rex_config)
+        else:
+            BackupRunner(rex_config).run()
+        wait_for_reports(rex_config)
+
+
+def read_rex_config(config_file_path=None):
+    """
+    Reads the config file (resources/config.xml in the working dir by default). Returns None if it can't be parsed.
+    """
     try:
-        config_file_path = os.path.join(fileutils.get_working_dir(), "resources", "config.xml")
+        config_file_path = config_file_path or os.path.join(fileutils.get_working_dir(), "resources", "config.xml")
         logging.info("Reading config file: " + config_file_path)
-        rex_config = config.readConfig(config_file_path)
+        return config.readCachedConfig(config_file_path, os.path.join(fileutils.get_data_dir(), CONFIG_CACHE_FILE_NAME))
     except Exception as ex:
         logging.fatal("Failed to parse configuration file. Reason: " + ex.__str__())
+        return None
+
+
+def perform_plan(config_file_path=None):
+    """
+    Prints the plan of a run (see #plan_backups()) without performing it. Every due source is sampled. Returns True if
+    the run is predicted to fit the backup window.
+    """
+    rex_config = read_rex_config(config_file_path)
+    if not rex_config:
+        return False
+    try:
+        plan = plan_backups(rex_config, rex_config.backups, sample=True)
+    except Exception as ex:
+        logging.error("Failed to plan backups: " + ex.__str__())
+        return False
+    print(planner.format_plan(plan))
+    return not plan.exceeds_window()
+
+
+def plan_backups(rex_config, backups, sample=False):
+    """
+    Plans a run of the backups (see #planner.make_plan()): jobs are ordered by job-order and deferred if they are
+    predicted to end after the backup window and the window-action says so. Estimates are based on the metrics history
+    of earlier runs, sources without history (or all due sources with sample) are sampled. Returns a #planner.Plan.
+    """
+    history = planner.History(metrics.read_json(get_metrics_file_path(rex_config)))
+    estimates = []
+    for backup in backups:
+        if is_downtime_period(backup):
+            estimates.append(planner.JobEstimate(backup, downtime=True))
+            continue
+        estimate = planner.JobEstimate(backup, manifest.KIND_FULL)
+        source_sample = None
+        if sample or not history.has_source(metrics.Phases.Archive, backup.source):
+            since = None
+            if backup.targetFormat != TargetFormats.ChunkStore:
+                estimate.kind, base_archive = get_backup_kind(backup)
+                since = time.mktime(parse_archive_date(base_archive).timetuple()) if base_archive else None
+            logging.info("Sampling source " + backup.source)
+            source_sample = planner.sample_source(backup.source, get_file_filter(backup), since,
+                                                  threads=backup.scanThreads or 1)
+        planner.estimate_job(estimate, history, source_sample, is_staged_locally(backup), rex_config.performChecks,
+                             backup.checkMode == CheckModes.Deep)
+        estimates.append(estimate)
+    return planner.make_plan(estimates, rex_config.maxWorkers, rex_config.maxJobsPerTarget,
+                             rex_config.jobOrder != JobOrders.Config, (rex_config.backupWindow or 0) * 60,
+                             rex_config.windowAction == WindowActions.Defer)
+
+
+class BackupRunner:
+    """
+    Performs a run over the backups of a RexConfig (all of them unless backups are given): backup jobs on the workers of
+    a #scheduler.BackupScheduler followed by cleanup, metrics export and reporting, and returns the merged JobResult.
+    Jobs are handed to the scheduler in the order planned by #plan_backups(). All state of a run is kept in the
+    runner, so several runners (e.g. of different configs) may run at the same time in threads or asyncio executors of
+    one process. A backup which is already being backed up by another run is skipped,
+    the tmp directory is only wiped by the last run to finish. progress is a callback receiving a
+    #metrics.ProgressEvent whenever a phase of a job starts, transfers data or ends. journals maps backup sources and
+    primary targets to change journals (daemon mode only), global_buckets are the (read, write) buckets shared by all
+    jobs (made of the config's limits if not given).
+    """
+    def __init__(self, rex_config, backups=None, progress=None, journals=None, global_buckets=None):
+        self.rex_config = rex_config
+        self.backups = backups if backups is not None else rex_config.backups
+        self.progress = progress
+        self.journals = journals
+        self.global_buckets = global_buckets
+
+    def run(self):
+        global active_runs
+        with run_state_lock:
+            active_runs += 1
+        try:
+            return self.perform_run()
+        finally:
+            with run_state_lock:
+                active_runs -= 1
+
+    def perform_run(self):
+        rex_config = self.rex_config
+        report = JobResult()
 
-    if rex_config:
         #step 1:performing backups
-        if len(rex_config.backups) > 0:
-            for backup in rex_config.backups:
-                if not is_downtime_period(backup):
-                    try:
-                        perform_backup(backup)
-                        add_message(Status.Success, Tasks.Backup, backup.source)
-                    except Exception as ex:
-                        add_message(Status.Failed, Tasks.Backup,backup.source,ex.__str__())
-                        logging.error("Failed to perform backup: " + ex.__str__())
-                        break
-                    try:
-                        if rex_config.performChecks:
-                            perform_backup_check(backup)
-                            add_message(Status.Success, Tasks.Check, backup.source)
-                    except ArchiveIntegrityError as ex:
-                        add_message(Status.Failed, Tasks.Check,backup.source,ex.__str__())
-                        logging.error("Backup check found some archive inconsistencies: " + ex.__str__())
-                        inconsistencies_found+=len(ex.inconsistencies)
-                    except Exception as ex:
-                        add_message(Status.Failed, Tasks.Check,backup.source,ex.__str__())
-                        logging.error("Failed to perform backup check: " + ex.__str__())
-                else:
-                    skipped_backups += 1
-                    add_message(Status.Skipped, Tasks.Backup, backup.source)
-                fileutils.clean_tmp()
-            if skipped_backups == len(rex_config.backups):
-                status = Status.Skipped
+        if len(self.backups) > 0:
+            if self.global_buckets is None:
+                self.global_buckets = throttle.make_buckets(rex_config.readLimit, rex_config.writeLimit,
+                                                            rex_config.bandwidthProfile)
+            backups = self.plan(report)
+            backup_scheduler = scheduler.BackupScheduler(rex_config.maxWorkers, rex_config.maxJobsPerTarget)
+            job_results = backup_scheduler.run(backups, lambda job_id, backup: self.make_job(backup).run())
+            for job_result in job_results:
+                report.merge(job_result)
 
         #step 2:performing cleanup
         try:
-            perform_backup_cleanup(rex_config)
-            add_message(Status.Success, Tasks.Cleanup, fileutils.get_tmp_dir())
+            perform_backup_cleanup(rex_config, report.phases, report)
+            report.add_message(Status.Success, Tasks.Cleanup, fileutils.get_tmp_dir())
         except Exception as ex:
-            add_message(Status.Failed, Tasks.Cleanup, fileutils.get_tmp_dir(), ex.__str__())
+            report.add_message(Status.Failed, Tasks.Cleanup, fileutils.get_tmp_dir(), ex.__str__())
             logging.error("Failed to perform backup cleanup: " + ex.__str__())
 
+        try:
+            export_metrics(report, len(self.backups), rex_config)
+        except Exception as ex:
+            logging.error("Failed to export metrics: " + ex.__str__())
+
         #step 3: performing reporting
         try:
             if rex_config.performReporting:
-                perform_reporting(messages, rex_config.reporterConfig)
+                perform_reporting(report, len(self.backups), rex_config.reporterConfig)
         except Exception as ex:
             logging.error("Failed to perform reporting: " + ex.__str__())
+        return report
+
+    def plan(self, report):
+        """
+        Returns the backups in the planned order, deferred backups are reported as skipped and a run predicted to
+        exceed the backup window is warned about. Planning failures leave the order as configured.
+        """
+        rex_config = self.rex_config
+        if not rex_config.backupWindow and (rex_config.jobOrder == JobOrders.Config or len(self.backups) < 2):
+            return self.backups
+        try:
+            plan = plan_backups(rex_config, self.backups)
+        except Exception as ex:
+            logging.warning("Failed to plan backups: " + ex.__str__())
+            return self.backups
+        logging.info("Backup plan:\n" + planner.format_plan(plan))
+        for estimate in plan.deferred:
+            report.backups += 1
+            report.skipped += 1
+            report.add_message(Status.Skipped, Tasks.Backup, estimate.backup.source, "Deferred to the next run, "
+                               "it is predicted to end after the backup window.")
+        if plan.window:
+            import socket
+            message = "Predicted runtime " + planner.format_duration(plan.runtime) + " of a " + \
+                      planner.format_duration(plan.window) + " backup window."
+            if plan.exceeds_window():
+                message += " The run is predicted to exceed the backup window."
+                logging.warning(message)
+            report.add_message(Status.Success, Tasks.Plan, socket.gethostname(), message)
+        return plan.get_backups()
+
+    def make_job(self, backup):
+        journal = self.journals[backup.source][backup.target] if self.journals else None
+        return BackupJob(backup, self.rex_config, self.global_buckets, journal, self.progress)
+
+
+def run_daemon(rex_config):
+    """
+    Keeps running until terminated: sources of all backups are watched for changes which are recorded in persistent
+    journals, and every daemon interval the backups whose backup downtime has passed are performed. Incremental and
+    differential backups use the journaled changes instead of walking the source.
+    """
+    stop_event = threading.Event()
+    def stop(signum, frame):
+        logging.info("Received signal " + str(signum) + ", stopping daemon")
+        stop_event.set()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    journal_dir = os.path.join(fileutils.get_data_dir(), JOURNALS_DIR_NAME)
+    fileutils.ensure_dir(journal_dir)
+    journals = dict()
+    for backup in rex_config.backups:
+        journals.setdefault(backup.source, dict())[backup.target] = watcher.Journal(
+            watcher.get_journal_path(journal_dir, backup.source, backup.target))
+    watchers = []
+    for source, source_journals in journals.items():
+        #a source backed up into several targets is watched once, each target keeps its own journal
+        watcher_thread = threading.Thread(target=watcher.watch, name="watcher-" + str(len(watchers)),
+                                          args=(source, list(source_journals.values()), stop_event,
+                                                rex_config.pollInterval))
+        watcher_thread.daemon = True
+        watcher_thread.start()
+        watchers.append(watcher_thread)
+
+    logging.info("Daemon started, checking backups every " + str(rex_config.daemonInterval) + " minutes")
+    global_buckets = throttle.make_buckets(rex_config.readLimit, rex_config.writeLimit, rex_config.bandwidthProfile)
+    while not stop_event.is_set():
+        try:
+            due_backups = [b for b in rex_config.backups if not is_downtime_period(b)]
+            if due_backups:
+                BackupRunner(rex_config, due_backups, journals=journals, global_buckets=global_buckets).run()
+        except Exception as ex:
+            logging.error("Failed to perform daemon run: " + ex.__str__())
+        stop_event.wait(rex_config.daemonInterval * 60)
+
+    for watcher_thread in watchers:
+        watcher_thread.join()
+    logging.info("Daemon stopped")
+
+
+class BackupJob:
+    """
+    Performs backup and check of a single backup config in its own tmp directory and returns a JobResult, the config of
+    the run (rex_config) defaults to one with just this backup. I/O of the job is limited by the backup's own limits
+    and the (read, write) global_buckets shared by all jobs. Changes recorded in the journal are used instead of a
+    source scan if given and handed back to it if the archive didn't make it into the primary target. A backup with
+    several targets is archived once into all of them, success of the backup and its check are reported per target.
+    progress is a callback receiving a #metrics.ProgressEvent whenever a phase starts, transfers data or ends. Jobs of
+    different backups may run concurrently in threads or asyncio executors.
+    """
+    def __init__(self, backup, rex_config=None, global_buckets=None, journal=None, progress=None):
+        self.backup = backup
+        self.rex_config = rex_config if rex_config else config.RexConfig(backups=[backup])
+        self.global_buckets = global_buckets
+        self.journal = journal
+        self.progress = progress
+        #ids are unique within the process so that jobs of concurrent runs don't share tmp directories
+        self.job_id = next(job_ids)
+
+    def run(self):
+        backup = self.backup
+        result = JobResult(backup.source)
+        keys = set((backup.source, target) for target in get_targets(backup))
+        with run_state_lock:
+            busy = not keys.isdisjoint(running_backups)
+            if not busy:
+                running_backups.update(keys)
+        if busy:
+            result.skipped += 1
+            result.add_message(Status.Skipped, Tasks.Backup, backup.source, "Backup is already running.")
+            return result
+        try:
+            self.perform_job(result)
+        finally:
+            with run_state_lock:
+                running_backups.difference_update(keys)
+        return result
+
+    def perform_job(self, result):
+        backup, journal, job_id = self.backup, self.journal, self.job_id
+        targets = get_targets(backup)
+        try:
+            io_throttle = get_backup_throttle(backup, self.global_buckets)
+            measure = metrics.measure
+            if self.progress:
+                meter = metrics.ProgressMeter(self.progress, job_id, io_throttle)
+                io_throttle, measure = meter, meter.measure
+            with measure(result.phases, metrics.Phases.Downtime, backup.source, backup.target):
+                downtime = is_downtime_period(backup)
+            if downtime:
+                result.skipped += 1
+                result.add_message(Status.Skipped, Tasks.Backup, backup.source)
+                return
+
+            changes = journal.begin() if journal else None
+            if changes is not None and not changes and is_unchanged_backup(backup):
+                journal.commit()
+                result.skipped += 1
+                result.add_message(Status.Skipped, Tasks.Backup, backup.source, "No changes since the previous backup.")
+                return
+
+            failed_targets = dict()
+            try:
+                with measure(result.phases, metrics.Phases.Archive, backup.source, ", ".join(targets)) as phase:
+                    archive_path = perform_backup(backup, phase, fileutils.get_job_tmp_dir(job_id), io_throttle,
+                                                  changes, failed_targets)
+                if is_staged_locally(backup):
+                    perform_backup_copies(backup, archive_path, result.phases, io_throttle, failed_targets, measure)
+            except Exception as ex:
+                if journal:
+                    journal.rollback()
+                for target in targets:
+                    result.add_message(Status.Failed, Tasks.Backup, get_location(backup, target),
+                                       failed_targets.get(target, ex.__str__()))
+                logging.error("Failed to perform backup: " + ex.__str__())
+                return
+            if journal:
+                #journaled changes are relative to the newest archive in the primary target
+                if targets[0] in failed_targets:
+                    journal.rollback()
+                else:
+                    journal.commit()
+            result.archives.extend(get_archive_paths(backup, archive_path, failed_targets))
+            for target in targets:
+                if target in failed_targets:
+                    result.add_message(Status.Failed, Tasks.Backup, get_location(backup, target),
+                                       failed_targets[target])
+                else:
+                    result.add_message(Status.Success, Tasks.Backup, get_location(backup, target))
+
+            for target in targets:
+                if not self.rex_config.performChecks or target in failed_targets:
+                    continue
+                location = get_location(backup, target)
+                tmp_dir = fileutils.get_job_tmp_dir(job_id)
+                if len(targets) > 1:
+                    #archives fetched by deep checks have the same name in every target
+                    tmp_dir = os.path.join(tmp_dir, str(targets.index(target)))
+                    fileutils.ensure_dir(tmp_dir)
+                try:
+                    with measure(result.phases, metrics.Phases.Check, backup.source, target) as phase:
+                        perform_backup_check(get_target_config(backup, target), tmp_dir, phase, io_throttle,
+                                             get_inconsistency_file_path(backup, target))
+                    result.add_message(Status.Success, Tasks.Check, location)
+                except ArchiveIntegrityError as ex:
+                    result.add_message(Status.Failed, Tasks.Check, location, ex.__str__())
+                    logging.error("Backup check found some archive inconsistencies: " + ex.__str__())
+                    result.inconsistencies += len(ex.inconsistencies)
+                except Exception as ex:
+                    result.add_message(Status.Failed, Tasks.Check, location, ex.__str__())
+                    logging.error("Failed to perform backup check: " + ex.__str__())
+        except Exception as ex:
+            result.add_message(Status.Failed, Tasks.Backup, backup.source, ex.__str__())
+            logging.error("Failed to run backup job: " + ex.__str__())
+        finally:
+            fileutils.clean_job_tmp(job_id)
 
 
 def is_downtime_period(backup_config):
+    """
+    Tells if the newest archive of the backup is younger than its backup downtime in every target. The newest archive
+    recorded in the catalog is looked at first without re-scanning the target, archives added behind the catalog's back
+    can only make the downtime longer, so the target is only synchronized when that archive is out of the downtime.
+    """
     if int(backup_config.backupDowntime) == 0:
         return False
-    else:
-        archive_path = get_newest_archive_path(backup_config.target)
+    return all(is_target_downtime_period(backup_config, target) for target in get_targets(backup_config))
+
+
+def is_target_downtime_period(backup_config, target):
+    for archive_path in (get_catalog().get_newest_archive(target, sync=False), get_newest_archive_path(target)):
         if archive_path:
             last_backup_time = parse_archive_date(archive_path).date()
             next_backup_time = last_backup_time + datetime.timedelta(days=int(backup_config.backupDowntime))
             now = datetime.date.fromtimestamp(time.time())
             if now < next_backup_time:
                 return True
-        else:
-            return False
+    return False
+
+
+def is_all_downtime_period(backups):
+    """
+    Tells if every backup is within its backup downtime, i.e. a run has nothing to do.
+    """
+    return len(backups) > 0 and all(is_downtime_period(b) for b in backups)
 
 
-def perform_backup(backup_config):
+def perform_backup(backup_config, phase=None, tmp_dir=None, io_throttle=None, changes=None, failed_targets=None):
     """
-    Performs backup according to provided config.
+    Performs backup according to provided config. Byte and file counts are recorded into the phase metrics if given.
+    Returns the path of the archive. Archives staged locally are written into tmp_dir (defaults to #get_tmp_local_dir())
+    and have to be moved to the targets with #perform_backup_copies(). All I/O is charged to io_throttle if given.
+    changes is a set of keys changed since the newest archive, which spares incremental and differential backups a
+    source scan. A backup with several targets streams one archive into all of them at once, targets which failed on
+    their own are put into the failed_targets dict with their error message (the path of the archive in the first
+    target it made it into is returned then). Raises TaskError if the backup failed everywhere.
     """
+    phase = phase if phase else metrics.PhaseMetrics()
+    failed_targets = failed_targets if failed_targets is not None else dict()
+    targets = get_targets(backup_config)
     try:
         logging.info("Performing backup task: " + backup_config.__str__())
 
-        logging.info("Archiving directory: " + backup_config.source)
-        archive_file_path = fileutils.archive_dir(backup_config.source, ARCHIVE_FORMATS[3])
-        logging.info("Copying archive to target directory: " + backup_config.target)
-        fileutils.copy_file(archive_file_path, backup_config.target)
+        if backup_config.targetFormat == TargetFormats.ChunkStore:
+            #a chunk store isn't a single stream, every target stores the chunks it lacks on its own
+            snapshot_paths = []
+            for target in targets:
+                try:
+                    snapshot_paths.append(perform_chunkstore_backup(get_target_config(backup_config, target), phase,
+                                                                    io_throttle))
+                except Exception as ex:
+                    if len(targets) == 1:
+                        raise
+                    failed_targets[target] = ex.__str__()
+                    logging.error("Failed to store snapshot in " + target + ": " + ex.__str__())
+            if not snapshot_paths:
+                raise TaskError("Failed to store snapshot in any target.")
+            logging.info("Backup complete")
+            return snapshot_paths[0]
+
+        snapshot = None
+        if backup_config.backupMode != BackupModes.Full:
+            snapshot = manifest.Manifest()
+            snapshot.kind, base_archive = get_backup_kind(backup_config)
+            snapshot.entries = get_source_entries(backup_config, changes if snapshot.kind != manifest.KIND_FULL else None)
+            if snapshot.kind != manifest.KIND_FULL:
+                base = manifest.read_manifest(manifest.get_manifest_path(base_archive))
+                snapshot.base = os.path.basename(base_archive)
+                snapshot.changed, snapshot.deleted = manifest.diff_entries(base.entries, snapshot.entries)
+                logging.info("Making " + snapshot.kind + " archive based on " + snapshot.base + ": " + \
+                             str(len(snapshot.changed)) + " changed and " + str(len(snapshot.deleted)) + " deleted entries")
+            else:
+                snapshot.changed = sorted(snapshot.entries.keys())
+
+        archive_dir_path = targets if len(targets) > 1 else backup_config.target
+        if is_staged_locally(backup_config):
+            archive_dir_path = tmp_dir if tmp_dir else fileutils.get_tmp_local_dir()
+            logging.info("Archiving directory " + backup_config.source + " to local staging dir " + archive_dir_path)
+        else:
+            logging.info("Archiving directory " + backup_config.source + " straight to " + ", ".join(targets))
+        transfer_pools = []
+        if is_staged_locally(backup_config) and backup_config.volumeSize:
+            #completed volumes are shipped to the targets while the next ones are being written, with several targets
+            #the local volumes are only removed once they were copied everywhere (see #perform_backup_copies())
+            transfer_pools = [copyengine.TransferPool(target, get_copy_options(backup_config, io_throttle),
+                                                      backup_config.transferWorkers, len(targets) == 1)
+                              for target in targets]
+        stats = dict()
+        try:
+            archive_file_path = fileutils.stream_archive_dir(
+                backup_config.source, archive_dir_path, backup_config.compression, backup_config.compressionWorkers,
+                backup_config.compressionBlockSize, snapshot.changed if snapshot and snapshot.base else None,
+                manifest.KIND_SUFFIXES[snapshot.kind] if snapshot else "", backup_config.digestAlgorithm or None,
+                stats, io_throttle, backup_config.volumeSize, get_volume_transfer(transfer_pools),
+                backup_config.compressionLevel, backup_config.storeIncompressible, backup_config.seekPointInterval or None,
+                get_file_filter(backup_config), failed_targets, tmp_dir)
+            for target, transfer_pool in zip(targets, transfer_pools):
+                try:
+                    transfer_pool.wait()
+                except Exception as ex:
+                    if len(targets) == 1:
+                        raise
+                    failed_targets[target] = ex.__str__()
+                    logging.error("Failed to transfer volumes to " + target + ": " + ex.__str__())
+            if len(failed_targets) == len(targets):
+                raise TaskError("Failed to transfer volumes to any target.")
+        except Exception:
+            for transfer_pool in transfer_pools:
+                transfer_pool.abort()
+            raise
+        phase.files, phase.bytesRead, phase.bytesWritten = stats["files"], stats["bytes_read"], stats["bytes_written"]
+        phase.targets = stats.get("targets", 1)
+        logging.info("Archive written: " + archive_file_path)
+        written_paths = [archive_file_path]
+        if not is_staged_locally(backup_config):
+            written_paths = [os.path.join(target, os.path.basename(archive_file_path)) for target in targets
+                             if target not in failed_targets]
+        for path in written_paths:
+            if snapshot:
+                manifest.write_manifest(manifest.get_manifest_path(path), snapshot)
+            if not is_staged_locally(backup_config):
+                get_catalog().add_archive(path, os.path.dirname(path), parse_archive_date(path),
+                                          snapshot.kind if snapshot else manifest.KIND_FULL,
+                                          snapshot.base if snapshot else None)
 
         logging.info("Backup complete")
+        return archive_file_path
     except Exception as ex:
         raise TaskError("Failed to perform backup: " + ex.__str__())
 
 
-def perform_backup_check(backup_config):
+def get_source_entries(backup_config, changes=None):
+    """
+    Returns the manifest entries of the source. With a set of keys changed since the newest archive only those are
+    re-read and applied to the entries of its manifest, otherwise the whole source is scanned.
+    """
+    if changes is not None:
+        archive_path = get_newest_source_archive_path(backup_config)
+        if archive_path and os.path.isfile(manifest.get_manifest_path(archive_path)):
+            logging.info("Applying " + str(len(changes)) + " journaled changes to the manifest of " + archive_path)
+            base = manifest.read_manifest(manifest.get_manifest_path(archive_path))
+            return manifest.apply_changes(base.entries, backup_config.source, changes, get_file_filter(backup_config))
+    logging.info("Scanning source directory for changes: " + backup_config.source)
+    return manifest.scan_dir(backup_config.source, backup_config.scanThreads, get_file_filter(backup_config))
+
+
+def is_unchanged_backup(backup_config):
+    """
+    Tells if a backup without any journaled changes can be skipped, which is the case when it would produce an empty
+    incremental or differential archive.
+    """
+    if backup_config.targetFormat == TargetFormats.ChunkStore or backup_config.backupMode == BackupModes.Full:
+        return False
+    return get_backup_kind(backup_config)[0] != manifest.KIND_FULL
+
+
+def get_volume_transfer(transfer_pools):
+    """
+    Returns a callback submitting completed volumes with their digest sidecars to every transfer pool (None without
+    pools).
+    """
+    if not transfer_pools:
+        return None
+    def transfer_volume(volume_path, hexdigest):
+        digest = fileutils.find_digest_file(volume_path)
+        for transfer_pool in transfer_pools:
+            transfer_pool.submit(volume_path, digest[0] if digest else None, hexdigest,
+                                 [fileutils.get_digest_file_path(volume_path, digest[0])] if digest else [])
+    return transfer_volume
+
+
+def perform_backup_copies(backup_config, archive_path, phases, io_throttle=None, failed_targets=None, measure=None):
     """
-    Checks if backup was performed correctly according to specified config.
+    Copies a locally staged archive into every target of the backup with #perform_backup_copy(), several targets are
+    copied to concurrently. The local archive is removed afterwards. Targets which failed on their own are put into the
+    failed_targets dict with their error message, phase metrics of every copy (timed with measure, #metrics.measure()
+    by default) are appended to phases. Raises TaskError if the copy failed everywhere.
     """
+    from concurrent.futures import ThreadPoolExecutor
+    failed_targets = failed_targets if failed_targets is not None else dict()
+    measure = measure if measure else metrics.measure
+    targets = get_targets(backup_config)
+    if len(targets) == 1:
+        with measure(phases, metrics.Phases.Copy, backup_config.source, backup_config.target) as phase:
+            perform_backup_copy(backup_config, archive_path, phase, io_throttle)
+        return
+
+    def copy_to(target):
+        with measure(phases, metrics.Phases.Copy, backup_config.source, target) as phase:
+            perform_backup_copy(get_target_config(backup_config, target), archive_path, phase, io_throttle, False)
+    try:
+        with ThreadPoolExecutor(max_workers=len(targets), thread_name_prefix="copy") as executor:
+            copies = [(target, executor.submit(copy_to, target)) for target in targets if target not in failed_targets]
+        for target, future in copies:
+            if future.exception() is not None:
+                failed_targets[target] = future.exception().__str__()
+                logging.error("Failed to copy archive to " + target + ": " + future.exception().__str__())
+    finally:
+        fileutils.remove_archive(archive_path)
+    if len(failed_targets) == len(targets):
+        raise TaskError("Failed to copy archive to any target.")
+
+
+def perform_backup_copy(backup_config, archive_path, phase=None, io_throttle=None, remove_source=True):
+    """
+    Copies a locally staged archive with its sidecars to the target using the resumable copy engine and removes the
+    local files afterwards (unless remove_source is False). Sidecars are copied first so that the archive only appears
+    in the target once it's complete, the archive itself is verified against its digest while being copied. Volumes of
+    a volume set are already in the target, its descriptor is copied last.
+    """
+    phase = phase if phase else metrics.PhaseMetrics()
+    target_path = os.path.join(backup_config.target, os.path.basename(archive_path))
+    try:
+        logging.info("Copying archive " + archive_path + " to " + backup_config.target)
+        options = get_copy_options(backup_config, io_throttle)
+        archive_size = fileutils.get_archive_size(archive_path)
+        descriptor_path = volumes.get_descriptor_path(archive_path)
+        sidecars = [p for p in fileutils.get_sidecars(archive_path) if p != descriptor_path]
+        for sidecar_path in sidecars:
+            copyengine.copy_file(sidecar_path, backup_config.target, options)
+            phase.bytesWritten += os.path.getsize(sidecar_path)
+        if volumes.is_volume_set(archive_path):
+            copyengine.copy_file(descriptor_path, backup_config.target, options)
+        else:
+            expected_digest = fileutils.find_digest_file(archive_path)
+            copyengine.copy_file(archive_path, backup_config.target, options,
+                                 expected_digest[0] if expected_digest else None,
+                                 expected_digest[1] if expected_digest else None)
+        phase.files = 1
+        phase.bytesRead = phase.bytesWritten = phase.bytesWritten + archive_size
+        base = None
+        if parse_archive_kind(target_path) != manifest.KIND_FULL:
+            base = manifest.read_manifest(manifest.get_manifest_path(target_path)).base
+        get_catalog().add_archive(target_path, backup_config.target, parse_archive_date(target_path),
+                                  parse_archive_kind(target_path), base)
+        if remove_source:
+            fileutils.remove_archive(archive_path)
+        logging.info("Archive copied: " + target_path)
+    except Exception as ex:
+        if volumes.is_volume_set(archive_path) and not volumes.is_volume_set(target_path):
+            #volumes shipped during archiving would otherwise be orphaned
+            fileutils.remove_archive(target_path)
+        raise TaskError("Failed to copy archive to target: " + ex.__str__())
+
+
+def is_staged_locally(backup_config):
+    return backup_config.staging == Staging.Local and backup_config.targetFormat != TargetFormats.ChunkStore
+
+
+def get_copy_options(backup_config, io_throttle=None):
+    return copyengine.CopyOptions(backup_config.copyChunkSize or copyengine.DEFAULT_CHUNK_SIZE,
+                                  backup_config.copyRetries, fsync=backup_config.copyFsync, io_throttle=io_throttle)
+
+
+def get_targets(backup_config):
+    """
+    Returns all targets of a backup, the first one is its primary target.
+    """
+    return backup_config.targets or [backup_config.target]
+
+
+def get_target_config(backup_config, target):
+    """
+    Returns a copy of the backup config limited to one of its targets, for everything done per target (checks,
+    rotation, ...).
+    """
+    target_config = copy.copy(backup_config)
+    target_config.target = target
+    target_config.targets = [target]
+    return target_config
+
+
+def get_location(backup_config, target):
+    """
+    Returns where a task of the backup took place for reports: its source, followed by the target if there are several.
+    """
+    if len(get_targets(backup_config)) > 1:
+        return backup_config.source + " -> " + target
+    return backup_config.source
+
+
+def get_archive_paths(backup_config, archive_path, failed_targets):
+    """
+    Returns paths of an archive (as returned by #perform_backup()) in all targets it was written into.
+    """
+    targets = [target for target in get_targets(backup_config) if target not in failed_targets]
+    if is_staged_locally(backup_config):
+        relative_path = os.path.basename(archive_path)
+    else:
+        relative_path = os.path.relpath(archive_path, targets[0])
+    return [os.path.join(target, relative_path) for target in targets]
+
+
+def get_file_filter(backup_config):
+    """
+    Returns the FileFilter deciding which entries of the source are backed up (None if all of them are). Archiving and
+    checks use the same rules: exclude-regexp, the rules read from the exclude-from file (relative to the source) and
+    the <include> and <exclude> elements of the backup, max-file-size and one-file-system.
+    """
+    rules = []
+    if backup_config.excludeFrom:
+        rules_path = os.path.join(backup_config.source, backup_config.excludeFrom)
+        try:
+            rules += filters.read_rules_file(rules_path)
+        except FileNotFoundError:
+            logging.warning("Exclude file doesn't exist, its rules aren't applied: " + rules_path)
+    rules += backup_config.filterRules or []
+    return filters.make_filter(backup_config.source, backup_config.excludeRegexp, rules, backup_config.maxFileSize,
+                               backup_config.oneFileSystem)
+
+
+def get_backup_throttle(backup_config, global_buckets=None):
+    """
+    Returns a Throttle combining the limits of a backup with the global (read, write) buckets or None if nothing is
+    limited.
+    """
+    read_bucket, write_bucket = throttle.make_buckets(backup_config.readLimit, backup_config.writeLimit,
+                                                      backup_config.bandwidthProfile)
+    global_read, global_write = global_buckets if global_buckets else (None, None)
+    io_throttle = throttle.Throttle([read_bucket, global_read], [write_bucket, global_write])
+    return io_throttle if io_throttle.read_buckets or io_throttle.write_buckets else None
+
+
+def perform_chunkstore_backup(backup_config, phase, io_throttle=None):
+    """
+    Stores source files into the deduplicating chunk store located in the target.
+    """
+    logging.info("Storing directory " + backup_config.source + " in chunk store " + backup_config.target)
+    if not os.path.isdir(backup_config.source):
+        raise fileutils.FileUtilsError(fileutils.dirErrorMsg + backup_config.source)
+    fileutils.ensure_dir(backup_config.target)
+    store = chunkstore.ChunkStore(backup_config.target, backup_config.chunkSize, io_throttle)
+    snapshot_path = store.backup_dir(backup_config.source, get_file_filter(backup_config))
+    phase.files, phase.bytesRead, phase.bytesWritten = store.files, store.bytes_read, store.bytes_written
+    logging.info("Snapshot written: " + snapshot_path + ". Reused chunks of " + str(store.reused_files) + \
+                 " unchanged files, read " + str(store.bytes_read) + " bytes, wrote " + str(store.bytes_written) + \
+                 " bytes of new chunks")
+    get_catalog().add_archive(snapshot_path, backup_config.target, parse_archive_date(snapshot_path), manifest.KIND_FULL)
+    return snapshot_path
+
+
+def get_backup_kind(backup_config):
+    """
+    Determines which kind of archive has to be made according to backup mode and full backup period. Returns a tuple
+    (kind, base_archive_path) where base archive is the one changes are detected against (None for a full archive).
+    """
+    if backup_config.backupMode == BackupModes.Full or not os.path.isdir(backup_config.target):
+        return manifest.KIND_FULL, None
+
+    archive_dates = get_source_archives(get_archive_names_and_times(backup_config.target), backup_config.source)
+    archives = sorted((a for a in archive_dates if os.path.isfile(manifest.get_manifest_path(a))),
+                      key=lambda a: archive_dates[a])
+    full_archives = [a for a in archives if parse_archive_kind(a) == manifest.KIND_FULL]
+    if not full_archives:
+        return manifest.KIND_FULL, None
+
+    last_full = full_archives[-1]
+    if int(backup_config.fullBackupPeriod) > 0:
+        next_full_date = archive_dates[last_full].date() + datetime.timedelta(days=int(backup_config.fullBackupPeriod))
+        if datetime.date.fromtimestamp(time.time()) >= next_full_date:
+            return manifest.KIND_FULL, None
+
+    if backup_config.backupMode == BackupModes.Differential:
+        kind, base_archive = manifest.KIND_DIFFERENTIAL, last_full
+    elif backup_config.backupMode == BackupModes.Incremental:
+        kind, base_archive = manifest.KIND_INCREMENTAL, archives[-1]
+    else:
+        raise TaskError("Unknown backup mode: " + str(backup_config.backupMode))
+    #the same archive goes into all targets, so all of them need its base
+    for target in get_targets(backup_config)[1:]:
+        if not fileutils.archive_exists(os.path.join(target, os.path.basename(base_archive))):
+            logging.info("Making full archive as " + target + " lacks the base archive " + base_archive)
+            return manifest.KIND_FULL, None
+    return kind, base_archive
+
+
+def perform_backup_check(backup_config, tmp_dir=None, phase=None, io_throttle=None, inconsistency_file_path=None):
+    """
+    Checks if backup was performed correctly according to specified config. tmp_dir is a scratch directory of the check
+    (defaults to #get_tmp_remote_dir()). Byte and file counts are recorded into the phase metrics if given. Reads are
+    charged to io_throttle if given. Inconsistencies are written to inconsistency_file_path (defaults to
+    #get_inconsistency_file_path()).
+    """
+    phase = phase if phase else metrics.PhaseMetrics()
+    tmp_dir = tmp_dir if tmp_dir else fileutils.get_tmp_remote_dir()
+    inconsistencies = mergejoin.InconsistencyLog(inconsistency_file_path or get_inconsistency_file_path(backup_config))
     try:
         logging.info("Checking backup: " + backup_config.__str__())
 
-        archive_path = get_newest_archive_path(backup_config.target)
+        archive_path = get_newest_source_archive_path(backup_config)
         if not archive_path:
             raise TaskError("No archive was found in the target dir: " + backup_config.target)
-        logging.info("Copying newest archive: " + archive_path)
-        tmp_archive = fileutils.copy_file(archive_path, fileutils.get_tmp_remote_dir())
+        if archive_path.endswith(chunkstore.SNAPSHOT_SUFFIX):
+            check_snapshot(archive_path, backup_config, inconsistencies, tmp_dir)
+            logging.info("Backup check completed")
+            if inconsistencies:
+                raise ArchiveIntegrityError("Found inconsistencies while checking snapshot and source.", inconsistencies)
+            return
+
+        members = None
+        read_path = archive_path
+        if parse_archive_kind(archive_path) != manifest.KIND_FULL:
+            members = manifest.read_manifest(manifest.get_manifest_path(archive_path)).changed
+
+        tar_members = mergejoin.ExternalSorter(backup_config.checkMemoryLimit, tmp_dir)
+        index_path = archiveindex.get_index_path(archive_path)
+        if backup_config.checkMode != CheckModes.Deep and os.path.isfile(index_path):
+            logging.info("Reading archive index: " + index_path)
+            tar_members.extend(archiveindex.get_index_members(archive_path, fileutils.get_archive_size(archive_path)))
+            phase.bytesRead += os.path.getsize(index_path)
+            if backup_config.checkMode == CheckModes.Digest:
+                expected_digest = fileutils.find_digest_file(archive_path)
+                if expected_digest:
+                    logging.info("Hashing archive in target: " + archive_path)
+                    verify_archive_digest(archive_path, expected_digest,
+                                          fileutils.compute_file_digest(archive_path, expected_digest[0], io_throttle))
+                    phase.bytesRead += fileutils.get_archive_size(archive_path)
+                else:
+                    logging.warning("No digest found for archive, skipping content verification: " + archive_path)
+        elif is_staged_locally(backup_config):
+            #archive is fetched with the resumable copy engine, which verifies the digest while copying
+            expected_digest = fileutils.find_digest_file(archive_path)
+            logging.info("Fetching newest archive from target: " + archive_path)
+            try:
+                read_path = fetch_archive(backup_config, archive_path, tmp_dir, expected_digest, io_throttle)
+            except copyengine.CopyError as ex:
+                raise ArchiveIntegrityError("Archive digest doesn't match its sidecar.", [ex.__str__()])
+            phase.bytesRead += fileutils.get_archive_size(archive_path)
+            if not expected_digest:
+                logging.warning("No digest found for archive, skipping content verification: " + archive_path)
+            tar_members, digest = fileutils.read_archive_members(read_path, io_throttle=io_throttle,
+                                                                 tar_members=tar_members)
+        else:
+            #archive is read in place, its digest is computed in the same pass which lists its members
+            expected_digest = fileutils.find_digest_file(archive_path)
+            logging.info("Reading newest archive in target: " + archive_path)
+            tar_members, digest = fileutils.read_archive_members(archive_path,
+                                                                 expected_digest[0] if expected_digest else None,
+                                                                 io_throttle, tar_members)
+            phase.bytesRead += fileutils.get_archive_size(archive_path)
+            if expected_digest:
+                verify_archive_digest(archive_path, expected_digest, digest)
+            else:
+                logging.warning("No digest found for archive, skipping content verification: " + archive_path)
+
+        phase.files = len(tar_members)
         logging.info("Checking archive consistency.")
-        inconsistencies = fileutils.compare_archive_against_dir(tmp_archive, backup_config.source, backup_config.excludeRegexp)
+        fileutils.compare_members_against_dir(tar_members, backup_config.source, get_file_filter(backup_config),
+                                              members=members, threads=backup_config.scanThreads,
+                                              inconsistencies=inconsistencies,
+                                              memory_limit=backup_config.checkMemoryLimit, tmp_dir=tmp_dir)
+        if backup_config.verifyContent:
+            sample = backup_config.verifySample
+            if backup_config.verifyFullWeekday is not None and datetime.date.today().weekday() == backup_config.verifyFullWeekday:
+                sample = 100
+            logging.info("Verifying content of " + str(sample) + "% of archived files.")
+            phase.bytesRead += fileutils.get_archive_size(read_path)
+            inconsistencies.extend(verifier.verify_archive_content(
+                read_path, backup_config.source, backup_config.verifyWorkers, backup_config.verifyMaxFileSize, sample,
+                get_file_filter(backup_config), io_throttle))
 
         logging.info("Backup check completed")
         if inconsistencies:
@@ -217,60 +1041,195 @@ def perform_backup_check(backup_config):
         raise ex
     except Exception as ex:
         raise TaskError("Could not check backup: " + ex.__str__())
+    finally:
+        inconsistencies.close()
+
+
+def fetch_archive(backup_config, archive_path, dir_path, expected_digest=None, io_throttle=None):
+    """
+    Copies an archive from the target into dir_path with the resumable copy engine verifying its digest. Volumes of a
+    volume set are fetched concurrently, each verified against its own digest. Returns the path of the local copy.
+    """
+    options = get_copy_options(backup_config, io_throttle)
+    if not volumes.is_volume_set(archive_path):
+        return copyengine.copy_file(archive_path, dir_path, options, expected_digest[0] if expected_digest else None,
+                                    expected_digest[1] if expected_digest else None)
+    descriptor = volumes.read_descriptor(archive_path)
+    transfer_pool = copyengine.TransferPool(dir_path, options, backup_config.transferWorkers, remove_source=False)
+    for volume_path, (name, size, digest) in zip(volumes.get_volume_paths(archive_path), descriptor["volumes"]):
+        transfer_pool.submit(volume_path, descriptor["algorithm"] if digest else None, digest)
+    transfer_pool.wait()
+    copyengine.copy_file(volumes.get_descriptor_path(archive_path), dir_path, options)
+    return os.path.join(dir_path, os.path.basename(archive_path))
+
+
+def get_inconsistency_file_path(backup_config, target=None):
+    """
+    Returns path of the file all inconsistencies found by the last check of a backup are written to, a backup with
+    several targets has one per target.
+    """
+    name = os.path.basename(os.path.normpath(backup_config.source))
+    if target and len(get_targets(backup_config)) > 1:
+        name += "-" + os.path.basename(os.path.normpath(target))
+    return os.path.join(fileutils.get_log_dir(), name + "-inconsistencies.log")
+
+
+def verify_archive_digest(archive_path, expected_digest, digest):
+    """
+    Compares an archive digest with the (algorithm, hexdigest) tuple read from its sidecar.
+    """
+    if digest != expected_digest[1]:
+        raise ArchiveIntegrityError("Archive digest doesn't match its sidecar.", [
+            "Wrong " + expected_digest[0] + " digest of " + archive_path + ": expected=" + expected_digest[1] + \
+            ";actual=" + digest])
+
+
+def check_snapshot(snapshot_path, backup_config, inconsistencies, tmp_dir=None):
+    """
+    Checks that all chunks of a chunk store snapshot are present and compares its entries against the source. Found
+    inconsistencies are appended to the given InconsistencyLog.
+    """
+    logging.info("Checking snapshot consistency: " + snapshot_path)
+    store = chunkstore.ChunkStore(backup_config.target, backup_config.chunkSize)
+    inconsistencies.extend("Can't find chunk in the store: " + c for c in store.get_missing_chunks(snapshot_path))
+    fileutils.compare_members_against_dir(chunkstore.get_snapshot_members(snapshot_path), backup_config.source,
+                                          get_file_filter(backup_config), threads=backup_config.scanThreads,
+                                          inconsistencies=inconsistencies, memory_limit=backup_config.checkMemoryLimit,
+                                          tmp_dir=tmp_dir)
 
 
-def perform_backup_cleanup(cfg):
+def perform_backup_cleanup(cfg, phases=None, report=None):
     """
-    Performs a cleanup of files and directories which are no longer needed.
+    Performs a cleanup of files and directories which are no longer needed. Metrics of every rotation are appended to
+    phases if given. Archives are rotated in every target of a backup, rotations which removed archives or failed
+    are added to the report (a JobResult) if given.
     """
+    phases = phases if phases is not None else []
     try:
-        logging.info("Cleaning up tmp directory.")
-        fileutils.clean_tmp()
+        with run_state_lock:
+            #jobs of other runs still use the tmp directory, the last run to finish cleans it up
+            if active_runs <= 1:
+                logging.info("Cleaning up tmp directory.")
+                fileutils.clean_tmp()
 
         total_removed = 0
         for backup in cfg.backups:
-            if int(backup.rotationPeriod) != 0:
-                archives_to_remove = []
-                archive_dates = get_archive_names_and_times(backup.target)
-                newest_archive_date = max(archive_dates.items(), key=operator.itemgetter(1))[1]
-                oldest_archive_date = newest_archive_date-datetime.timedelta(days=backup.rotationPeriod)
-
-                for archive in archive_dates.keys():
-                    if oldest_archive_date > archive_dates[archive]:
-                        archives_to_remove.append(archive)
-                for archive in archives_to_remove:
-                    fileutils.remove_file(archive)
-
-                total_removed += len(archives_to_remove)
-                logging.info("Cleaning up old archives at "+backup.target+". Removed a total of "+str(len(archives_to_remove))+" files")
+            if int(backup.rotationPeriod) == 0:
+                continue
+            for target in get_targets(backup):
+                try:
+                    with metrics.measure(phases, metrics.Phases.Rotation, backup.source, target) as phase:
+                        removed = rotate_archives(get_target_config(backup, target), phase)
+                    total_removed += removed
+                    if report and removed:
+                        report.add_message(Status.Success, Tasks.Rotation, get_location(backup, target),
+                                           "Removed " + str(removed) + " old archives.")
+                except Exception as ex:
+                    logging.error("Failed to rotate archives in " + target + ": " + ex.__str__())
+                    if not report:
+                        raise
+                    report.add_message(Status.Failed, Tasks.Rotation, get_location(backup, target), ex.__str__())
 
         logging.info("Removed a total of " + str(total_removed) + " old archives.")
     except Exception as ex:
         raise TaskError("Couldn't complete cleanup: " + ex.__str__())
 
 
-def perform_reporting(msgs, reporter_config):
+def rotate_archives(backup, phase):
+    """
+    Removes archives of the backup which are older than its rotation period. Returns the number of removed archives.
+    Archives of other sources sharing the target are left to their own backups.
     """
-    Performs email reporting.
+    archive_dates = get_source_archives(get_archive_names_and_times(backup.target), backup.source)
+    if not archive_dates:
+        return 0
+    newest_archive_date = max(archive_dates.items(), key=operator.itemgetter(1))[1]
+    oldest_archive_date = newest_archive_date-datetime.timedelta(days=backup.rotationPeriod)
+    removed_partials = remove_stale_partial_files(backup, newest_archive_date)
+    if removed_partials:
+        logging.info("Removed " + str(removed_partials) + " partial files left by interrupted runs at " + backup.target)
+
+    #archives which retained incremental/differential archives depend on are kept even if expired
+    dependencies = get_archive_dependencies(archive_dates)
+    retained = [a for a in archive_dates if oldest_archive_date <= archive_dates[a]]
+    required = set()
+    for archive in retained:
+        required.update(dependencies[archive])
+    archives_to_remove = [a for a in archive_dates if oldest_archive_date > archive_dates[a] and a not in required]
+    for archive in archives_to_remove:
+        fileutils.remove_archive(archive)
+        get_catalog().remove_archive(archive)
+    if backup.targetFormat == TargetFormats.ChunkStore:
+        removed_chunks = chunkstore.ChunkStore(backup.target).collect_garbage()
+        logging.info("Removed " + str(removed_chunks) + " unreferenced chunks from " + backup.target)
+
+    phase.files = len(archives_to_remove)
+    logging.info("Cleaning up old archives at "+backup.target+". Removed a total of "+str(len(archives_to_remove))+" files")
+    return len(archives_to_remove)
+
+
+def remove_stale_partial_files(backup, newest_archive_date):
     """
-    global skipped_backups, inconsistencies_found
+    Removes partial files of the backup's archives and sidecars (and checkpoints of their copies) which were left in
+    the target by killed runs, i.e. those dated before the newest archive. Completed volumes (and their sidecars) of
+    volume sets whose descriptor was never written are removed as well. Returns the number of removed files.
+    """
+    name = re.escape(os.path.basename(backup.source))
+    partial_pattern = re.compile(r"^" + name + r"-(\d{12})\..*\.part(\.ckpt(\.part)?)?$")
+    volume_pattern = re.compile(r"^(" + name + r"-(\d{12})\..*)\.v\d{4}(\.\w+)?$")
+    removed = 0
+    for file_name in os.listdir(backup.target):
+        m = partial_pattern.match(file_name)
+        if m and datetime.datetime.strptime(m.group(1), "%Y%m%d%H%M") < newest_archive_date:
+            removed += fileutils.remove_file(os.path.join(backup.target, file_name))
+            continue
+        m = volume_pattern.match(file_name)
+        if m and datetime.datetime.strptime(m.group(2), "%Y%m%d%H%M") < newest_archive_date and \
+                not os.path.exists(volumes.get_descriptor_path(os.path.join(backup.target, m.group(1)))):
+            removed += fileutils.remove_file(os.path.join(backup.target, file_name))
+    return removed
+
+
+def get_metrics_file_path(rex_config):
+    return rex_config.metricsFile or os.path.join(fileutils.get_data_dir(), METRICS_FILE_NAME)
+
+
+def export_metrics(report, total_backups, rex_config):
+    """
+    Appends phase metrics of the run to the metrics history and writes the Prometheus textfile if configured.
+    """
+    metrics_file = get_metrics_file_path(rex_config)
+    metrics.append_json(report.phases, metrics_file, get_global_status(report, total_backups),
+                        rex_config.metricsHistory)
+    logging.info("Metrics appended to " + metrics_file)
+    if rex_config.prometheusFile:
+        metrics.write_prometheus(report.phases, rex_config.prometheusFile)
+        logging.info("Prometheus metrics written to " + rex_config.prometheusFile)
+
+
+def perform_reporting(report, total_backups, reporter_config):
+    """
+    Performs email reporting of the merged job results. The report is queued in the outbox and sent in the background,
+    see #wait_for_reports().
+    """
+    import socket
+    from email.mime.text import MIMEText
     try:
         logging.info("Performing reporting.")
 
-        msg = MIMEText("\n-------------------------------------------------\n".join(msgs))
-        subj = "Status " + get_global_status() + " on " + socket.gethostname() + " host. Backups skipped: " + str(skipped_backups) + \
-               ". Files missing in archives: " + str(inconsistencies_found) + \
+        msg = MIMEText("\n-------------------------------------------------\n".join(report.messages) + \
+                       "\n-------------------------------------------------\n" + metrics.format_table(report.phases))
+        subj = "Status " + get_global_status(report, total_backups) + " on " + socket.gethostname() + \
+               " host. Backups skipped: " + str(report.skipped) + \
+               ". Files missing in archives: " + str(report.inconsistencies) + \
                ". Report as of " + datetime.datetime.now().strftime("%Y-%m-%d-%H:%M")
         msg['Subject'] = reporter_config.subjectPrefix + subj
         msg['From'] = reporter_config.fromAddress
         msg['To'] = reporter_config.toAddress
-        s = smtplib.SMTP(reporter_config.smtpConfig.host, int(reporter_config.smtpConfig.port))
-        s.starttls()
-        s.login(reporter_config.smtpConfig.username, reporter_config.smtpConfig.password)
-        s.sendmail(reporter_config.fromAddress, reporter_config.toAddress.split(","), msg.as_string())
-        s.quit()
+        report_path = get_outbox().put(msg)
+        get_report_sender(reporter_config).start()
 
-        logging.info("Reporting complete")
+        logging.info("Report queued: " + report_path)
     except Exception as ex:
         raise TaskError("Could not perform reporting: " + ex.__str__())
 
@@ -299,46 +1258,234 @@ class ArchiveIntegrityError(Exception):
          return repr(self.value) + "\n" + "\n".join(self.inconsistencies if self.inconsistencies else [])
 
 
+def get_catalog():
+    """
+    Returns the archive catalog shared by all jobs, opening it on first use.
+    """
+    global archive_catalog
+    with archive_catalog_lock:
+        if archive_catalog is None:
+            archive_catalog = catalog.Catalog(os.path.join(fileutils.get_data_dir(), CATALOG_FILE_NAME), scan_archives)
+        return archive_catalog
+
+
+def get_outbox():
+    return outbox.Outbox(os.path.join(fileutils.get_data_dir(), OUTBOX_DIR_NAME))
+
+
+def has_queued_reports():
+    return os.path.isdir(os.path.join(fileutils.get_data_dir(), OUTBOX_DIR_NAME)) and len(get_outbox()) > 0
+
+
+def get_report_sender(reporter_config):
+    """
+    Returns the background sender of the outbox shared by the whole process, creating it on first use.
+    """
+    global report_sender
+    with report_sender_lock:
+        if report_sender is None:
+            smtp_config = reporter_config.smtpConfig
+            report_sender = outbox.ReportSender(get_outbox(), lambda: outbox.SmtpSender(
+                smtp_config.host, smtp_config.port, smtp_config.username, smtp_config.password, smtp_config.tls,
+                smtp_config.timeout), reporter_config.sendRetries)
+        return report_sender
+
+
+def wait_for_reports(rex_config):
+    """
+    Gives the background sender up to the send timeout to deliver queued reports before the process exits.
+    """
+    if report_sender is not None:
+        report_sender.wait(rex_config.reporterConfig.sendTimeout)
+
+
 def get_newest_archive_path(dir_path):
     """
-    Parses source contents and tries to find file which is assumed to be the latest archive.
-    Returns a tuple of the form (absoluteFilePath, modificationTimestamp) or None
+    Looks up the archive in the dir_path which is assumed to be the latest one. Returns its absolute path or None.
     """
-    archive_dates = get_archive_names_and_times(dir_path)
-    if archive_dates:
-        return (max(archive_dates.items(), key=operator.itemgetter(1)))[0]
+    return get_catalog().get_newest_archive(dir_path)
+
+
+def get_newest_source_archive_path(backup_config):
+    """
+    Looks up the newest archive of the backup's source in its target, other sources may share the target. Returns its
+    absolute path or None.
+    """
+    archive_dates = get_source_archives(get_archive_names_and_times(backup_config.target), backup_config.source)
+    return max(archive_dates, key=lambda a: archive_dates[a]) if archive_dates else None
 
 
 def get_archive_names_and_times(dir_path):
     """
-    Traverses the sourceDir and creates a dict with archive file names as keys and their creation date as value.
+    Returns a dict with archive file names in the dir_path as keys and their creation date as value (None if there are
+    no archives). Answered by the catalog which re-scans the directory only if it changed.
     """
-    archive_dates = dict()
-    archives = fileutils.get_files(dir_path, "^.*-\d+\.tar\.gz$")
-    if archives:
-        for archive in archives:
-            archive_dates[archive] = parse_archive_date(archive)
+    archive_dates = get_catalog().get_archives(dir_path)
+    if archive_dates:
         return archive_dates
 
 
+def get_source_archives(archive_dates, source):
+    """
+    Narrows a dict of archive dates (as returned by #get_archive_names_and_times()) down to archives of the source,
+    i.e. archives named after the source directory followed by their date. Returns an empty dict if there are none.
+    """
+    pattern = re.compile("^" + re.escape(os.path.basename(source)) + r"-\d+(\.|$)")
+    return dict((a, d) for a, d in (archive_dates or dict()).items() if pattern.match(os.path.basename(a)))
+
+
+def scan_archives(dir_path):
+    """
+    Lists the archive directories of dir_path (see #catalog.get_archive_dirs()) and returns a list of (path, creation
+    date, kind) tuples of archives found in them. Volume sets are found by their descriptors and listed under the
+    logical archive path.
+    """
+    archives = []
+    for archive_dir in catalog.get_archive_dirs(dir_path):
+        with os.scandir(archive_dir) as it:
+            for entry in it:
+                if not entry.is_file() or not ARCHIVE_NAME_PATTERN.search(entry.name):
+                    continue
+                archive = entry.path
+                if archive.endswith(volumes.VOLUMES_SUFFIX):
+                    archive = archive[:-len(volumes.VOLUMES_SUFFIX)]
+                archives.append((archive, parse_archive_date(archive), parse_archive_kind(archive)))
+    return archives
+
+
 def parse_archive_date(file_name):
     """
     Finds date in the filename and returns a datetime object.
     """
-    m = re.search("(?<=-)(\d+)(?=\.tar\.gz)", file_name)
+    m = ARCHIVE_DATE_PATTERN.search(file_name)
     return datetime.datetime.strptime(m.group(0), "%Y%m%d%H%M")
 
 
+def parse_archive_kind(file_name):
+    """
+    Finds kind of the archive (full, incremental or differential) in the filename.
+    """
+    m = ARCHIVE_KIND_PATTERN.search(file_name)
+    return m.group(1) if m else manifest.KIND_FULL
+
+
+def get_archive_dependencies(archive_dates):
+    """
+    Determines archive chains. Returns a dict with archive file names as keys and sets of archives they depend on as
+    values: an incremental archive needs all archives since the previous full one, a differential one only needs the
+    previous full archive and a full archive needs nothing.
+    """
+    dependencies = dict()
+    last_full = None
+    previous = None
+    for archive in sorted(archive_dates.keys(), key=lambda a: archive_dates[a]):
+        kind = parse_archive_kind(archive)
+        if kind == manifest.KIND_FULL:
+            dependencies[archive] = set()
+            last_full = archive
+        elif kind == manifest.KIND_DIFFERENTIAL:
+            dependencies[archive] = set([last_full]) if last_full else set()
+        else:
+            dependencies[archive] = (set([previous]) | dependencies[previous]) if previous else set()
+        previous = archive
+    return dependencies
+
+
 #-----------------------------------------------------------------------------------------------------------------------
 # Misc
 #-----------------------------------------------------------------------------------------------------------------------
+def get_restore_chain(archive_path):
+    """
+    Resolves the archives an incremental or differential archive builds on through the bases recorded in their
+    manifests. Returns the paths of the archives to restore in order, i.e. the full archive first and archive_path last.
+    Raises a RestoreError if the chain can't be resolved back to a full archive.
+    """
+    chain = [archive_path]
+    while parse_archive_kind(chain[0]) != manifest.KIND_FULL:
+        manifest_path = manifest.get_manifest_path(chain[0])
+        if not os.path.isfile(manifest_path):
+            raise restore.RestoreError("Manifest of " + chain[0] + " is missing, its base archive is unknown")
+        base = manifest.read_manifest(manifest_path).base
+        base_path = os.path.join(os.path.dirname(chain[0]), base) if base else None
+        if not base_path or base_path in chain or not fileutils.archive_exists(base_path):
+            raise restore.RestoreError("Base archive " + str(base) + " of " + chain[0] + " doesn't exist")
+        chain.insert(0, base_path)
+    return chain
+
+
+def remove_deleted_members(archive_path, restored, restore_dir):
+    """
+    Removes restored members which are no longer part of the source state recorded in the manifest of archive_path,
+    i.e. those which were deleted after an earlier archive of its chain was made. Returns the number of removed entries.
+    """
+    entries = set(restore.normalize_name(key) for key in
+                  manifest.read_manifest(manifest.get_manifest_path(archive_path)).entries)
+    removed = 0
+    #deepest entries first, so that directories are empty once they are reached
+    for name in sorted(set(restore.normalize_name(name) for name in restored) - entries, reverse=True):
+        path = os.path.join(restore_dir, name)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                os.rmdir(path)
+            else:
+                os.remove(path)
+            removed += 1
+        except OSError as ex:
+            logging.warning("Failed to remove deleted member " + path + ": " + ex.__str__())
+    return removed
+
+
+def perform_restore(archive, patterns, restore_dir, workers=4):
+    """
+    Restores members matching the glob patterns from an archive into restore_dir. archive is an archive path or a
+    target directory, the newest archive of which is used then. Incremental and differential archives are restored
+    together with the archives they build on, starting with the full one, and members deleted on the way are removed
+    again. Returns True if all selected members were restored.
+    """
+    try:
+        archive_path = archive
+        if os.path.isdir(archive):
+            archive_path = get_newest_archive_path(archive)
+            if not archive_path or archive_path.endswith(chunkstore.SNAPSHOT_SUFFIX):
+                logging.error("No archive to restore from found in " + archive)
+                return False
+        chain = get_restore_chain(archive_path)
+        restored, errors = [], []
+        for path in chain:
+            logging.info("Restoring " + ", ".join(patterns) + " from " + path + " to " + restore_dir)
+            path_restored, path_errors = restore.restore(path, patterns, restore_dir, workers)
+            restored += path_restored
+            errors += path_errors
+        if len(chain) > 1:
+            removed = remove_deleted_members(archive_path, restored, restore_dir)
+            if removed:
+                logging.info("Removed " + str(removed) + " members deleted since " + chain[0])
+    except Exception as ex:
+        logging.error("Failed to perform restore: " + ex.__str__())
+        return False
+    for error in errors:
+        logging.error(error)
+    if not restored and not errors:
+        logging.warning("No archive members match " + ", ".join(patterns))
+    return len(errors) == 0
+
+
 def process_cli():
     #Handle script arguments
     parser = OptionParser("usage: %prog [options] arg")
     parser.add_option("-v","--verbose",action="store_true",dest="verbose",default=False,help="print log messages to console")
+    parser.add_option("-p","--plan",action="store_true",dest="plan",default=False,help="sample sources and print the predicted order, sizes and durations of backup jobs without performing them")
+    parser.add_option("-c","--config",dest="config",help="config file to use (defaults to resources/config.xml in the script working directory)")
+    parser.add_option("-d","--daemon",action="store_true",dest="daemon",default=False,help="keep running, watch sources for changes and perform backups whenever they are due")
+    parser.add_option("-r","--restore",action="append",dest="restore",default=[],metavar="PATTERN",help="restore archive members matching a glob pattern (e.g. \"etc/*.conf\", may be repeated) instead of performing backups")
+    parser.add_option("-a","--archive",dest="archive",help="archive to restore from, or a target directory to restore from its newest archive")
+    parser.add_option("--restore-dir",dest="restore_dir",default=os.curdir,help="directory to restore into (defaults to the current directory)")
+    parser.add_option("--restore-workers",type="int",dest="restore_workers",default=4,help="number of parts of the archive extracted in parallel (defaults to 4)")
     (options, args) = parser.parse_args()
+    if options.restore and not options.archive:
+        parser.error("--restore needs an --archive to restore from")
 
-    log_format = "%(asctime)s [%(levelname)s]:%(module)s - %(message)s"
+    log_format = "%(asctime)s [%(levelname)s]:%(threadName)s:%(module)s - %(message)s"
     if options.verbose:
         logging.basicConfig(level=logging.DEBUG,format=log_format)
     else:
@@ -346,7 +1493,15 @@ def process_cli():
         logFile = os.path.join(fileutils.get_log_dir(), "rex-backup-"+datetime.datetime.now().strftime("%Y%m%d%H%M")+".log")
         #Will create a new file each time application is executed
         logging.basicConfig(filename=logFile, filemode="w",level=logging.INFO,format=log_format)
+    return options
 
 if __name__ == '__main__':
-    process_cli()
-    main()
\ No newline at end of file
+    options = process_cli()
+    if options.restore:
+        if not perform_restore(options.archive, options.restore, options.restore_dir, options.restore_workers):
+            raise SystemExit(1)
+    elif options.plan:
+        if not perform_plan(options.config):
+            raise SystemExit(1)
+    else:
+        main(options.daemon, options.config)
\ No newline at end of file
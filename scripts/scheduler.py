@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import fileutils
+
+
+class BackupScheduler:
+    """
+    Runs backup jobs on a pool of worker threads. No more than max_workers jobs run at once and no more than
+    max_jobs_per_target jobs write to the same target mount point at the same time, a job writing to several targets
+    counts on every mount point of them.
+    """
+    def __init__(self, max_workers=1, max_jobs_per_target=1):
+        self.max_workers = max(1, int(max_workers))
+        self.max_jobs_per_target = max(1, int(max_jobs_per_target))
+
+    def run(self, backups, job_fn):
+        """
+        Calls job_fn(job_id, backup_config) for every backup and returns a list of job_fn results in the order of
+        backups. job_fn is expected to handle its own errors.
+        """
+        results = [None] * len(backups)
+        pending = [(job_id, backup, set(fileutils.get_mount_point(target) for target in backup.targets or [backup.target]))
+                   for job_id, backup in enumerate(backups)]
+        running = dict()
+        active = collections.Counter()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="backup-job") as executor:
+            while pending or running:
+                for job in list(pending):
+                    if len(running) >= self.max_workers:
+                        break
+                    job_id, backup, mounts = job
+                    if all(active[mount] < self.max_jobs_per_target for mount in mounts):
+                        pending.remove(job)
+                        active.update(mounts)
+                        logging.debug("Scheduling job " + str(job_id) + " on mounts " + ", ".join(sorted(mounts)))
+                        running[executor.submit(job_fn, job_id, backup)] = (job_id, mounts)
+
+                done, not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    job_id, mounts = running.pop(future)
+                    active.subtract(mounts)
+                    results[job_id] = future.result()
+        return results
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+
+import os
+import time
+import errno
+import ctypes
+import logging
+import datetime
+import platform
+import threading
+
+#Linux I/O scheduling classes as understood by ioprio_set(2)
+IO_CLASSES = {"realtime": 1, "best-effort": 2, "idle": 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_SET_SYSCALLS = {"x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314, "ppc64le": 273}
+
+
+class ThrottleError(Exception):
+     """
+     Abstract throttling error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class BandwidthProfile:
+    """
+    Time-of-day bandwidth limits parsed from a spec like "08:00-20:00=1024,20:00-22:00=4096" (KiB/s, 0 is unlimited).
+    Windows may span midnight, outside of all windows the configured default limit applies.
+    """
+    def __init__(self, spec=""):
+        self.windows = []
+        for item in (spec or "").split(","):
+            if not item.strip():
+                continue
+            try:
+                window, limit = item.split("=")
+                start, end = window.split("-")
+                self.windows.append((self.parse_time(start), self.parse_time(end), int(limit) * 1024))
+            except ValueError:
+                raise ThrottleError("Invalid bandwidth profile entry: " + item)
+
+    @staticmethod
+    def parse_time(value):
+        hours, minutes = value.strip().split(":")
+        return int(hours) * 60 + int(minutes)
+
+    def get_rate(self, default, now=None):
+        now = now if now else datetime.datetime.now()
+        minute = now.hour * 60 + now.minute
+        for start, end, rate in self.windows:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return rate
+        return default
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting a byte rate (bytes per second, 0 or None is unlimited). Callers take tokens
+    ahead of time and sleep off the debt outside the lock, so concurrent consumers share the rate accurately.
+    """
+    def __init__(self, rate=0, profile=None, burst_seconds=1.0):
+        self.rate = rate or 0
+        self.profile = profile
+        self.burst_seconds = burst_seconds
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get_rate(self):
+        return self.profile.get_rate(self.rate) if self.profile else self.rate
+
+    def consume(self, amount):
+        rate = self.get_rate()
+        if not rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(rate * self.burst_seconds, self.tokens + (now - self.updated) * rate) - amount
+            self.updated = now
+            delay = -self.tokens / rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Throttle:
+    """
+    Limits reads and writes of a backup job. Every transfer takes tokens from all buckets (e.g. the backup's own and
+    the global one shared by all jobs).
+    """
+    def __init__(self, read_buckets=None, write_buckets=None):
+        self.read_buckets = [b for b in (read_buckets or []) if b]
+        self.write_buckets = [b for b in (write_buckets or []) if b]
+
+    def read(self, amount):
+        for bucket in self.read_buckets:
+            bucket.consume(amount)
+
+    def write(self, amount):
+        for bucket in self.write_buckets:
+            bucket.consume(amount)
+
+
+class ThrottledReader:
+    """
+    File-like wrapper charging every read to a Throttle.
+    """
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.read(len(data))
+        return data
+
+    def close(self):
+        self.fileobj.close()
+
+
+class ThrottledWriter:
+    """
+    File-like wrapper charging every write to a Throttle.
+    """
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def write(self, data):
+        self.throttle.write(len(data))
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+
+def make_buckets(read_limit, write_limit, profile_spec):
+    """
+    Returns a (read_bucket, write_bucket) tuple for limits in bytes per second, None for unlimited ones.
+    """
+    profile = BandwidthProfile(profile_spec) if profile_spec else None
+    read_bucket = TokenBucket(read_limit, profile) if read_limit or profile else None
+    write_bucket = TokenBucket(write_limit, profile) if write_limit or profile else None
+    return read_bucket, write_bucket
+
+
+def set_priority(niceness=None, io_class=None, io_priority=None):
+    """
+    Lowers CPU and I/O priority of the calling thread. Threads started afterwards inherit both. I/O priority needs
+    Linux, it's skipped with a warning elsewhere.
+    """
+    if niceness:
+        os.setpriority(os.PRIO_PROCESS, 0, os.getpriority(os.PRIO_PROCESS, 0) + int(niceness))
+    if io_class:
+        if io_class not in IO_CLASSES:
+            raise ThrottleError("Unknown I/O class: " + str(io_class))
+        syscall_nr = IOPRIO_SET_SYSCALLS.get(platform.machine())
+        if platform.system() != "Linux" or syscall_nr is None:
+            logging.warning("I/O priority is not supported on this platform, ignoring io-class")
+            return
+        data = 0 if io_class == "idle" else int(io_priority if io_priority is not None else 4)
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.syscall(syscall_nr, IOPRIO_WHO_PROCESS, 0, (IO_CLASSES[io_class] << IOPRIO_CLASS_SHIFT) | data) != 0:
+            err = ctypes.get_errno()
+            logging.warning("Failed to set I/O priority: " + os.strerror(err) + " (" + errno.errorcode.get(err, "") + ")")
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import mmap
+import zlib
+import hashlib
+import tarfile
+import datetime
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import throttle
+import volumes
+import compressors
+
+#Files at least that large are hashed through mmap instead of read() calls
+MMAP_THRESHOLD = 8 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+#Archive hashes waiting for their source hash, bounds memory on huge trees
+MAX_PENDING = 1024
+
+
+def hash_source_file(file_path, expected_mtime, io_throttle=None):
+    """
+    Hashes a source file. Returns None if the file is gone or was modified after it was archived, as its content can't
+    be compared then. Reads are charged to io_throttle if given.
+    """
+    try:
+        with open(file_path, "rb") as f:
+            st = os.fstat(f.fileno())
+            if int(st.st_mtime) != int(expected_mtime):
+                return None
+            h = hashlib.blake2b()
+            if io_throttle:
+                io_throttle.read(st.st_size)
+            if st.st_size >= MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                    h.update(m)
+            else:
+                for data in iter(lambda: f.read(READ_SIZE), b""):
+                    h.update(data)
+            return h.hexdigest()
+    except (FileNotFoundError, PermissionError):
+        return None
+
+
+def is_sampled(name, sample, salt):
+    """
+    Decides if a member belongs to the sample (percentage). The salt changes the sample from one day to the next so the
+    whole tree gets covered over time.
+    """
+    if sample >= 100:
+        return True
+    return zlib.crc32((salt + name).encode("utf-8", "surrogateescape")) % 10000 < sample * 100
+
+
+def collect_pending(pending, inconsistencies, limit):
+    """
+    Compares the oldest pending archive hashes with their source hashes until at most limit are left.
+    """
+    while len(pending) > limit:
+        name, archive_hash, source_hash = pending.popleft()
+        source_hexdigest = source_hash.result()
+        if source_hexdigest is not None and source_hexdigest != archive_hash:
+            inconsistencies.append("Content mismatch detected: key=" + name + ";archiveHash=" + archive_hash + \
+                                   ";srcHash=" + source_hexdigest)
+
+
+def verify_archive_content(archive_path, source_dir_path, workers=4, max_file_size=None, sample=100,
+                           file_filter=None, io_throttle=None):
+    """
+    Stream-decompresses the archive once hashing the content of every sampled regular file member while a pool of
+    workers hashes the matching source files. Files larger than max_file_size bytes and members excluded by the
+    file_filter (a #filters.FileFilter) are skipped. All reads are charged to io_throttle if given. Returns a list of
+    content mismatches or None.
+    """
+    salt = datetime.date.today().isoformat()
+    pending = deque()
+    inconsistencies = []
+    verified = 0
+
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as executor:
+        with volumes.open_archive(archive_path) as f:
+            reader = throttle.ThrottledReader(f, io_throttle) if io_throttle else f
+            with compressors.open_reader(reader) as stream, tarfile.open(fileobj=stream, mode="r|") as archive_file:
+                for member in archive_file:
+                    #TarFile keeps every member read, which isn't needed for a single pass
+                    archive_file.members = []
+                    if not member.isreg():
+                        continue
+                    if max_file_size and member.size > max_file_size:
+                        continue
+                    if (file_filter and file_filter.is_excluded_path(member.name, False)) or \
+                            not is_sampled(member.name, sample, salt):
+                        continue
+                    #source is hashed by the pool while the archive member is being decompressed
+                    source_hash = executor.submit(hash_source_file, os.path.join(source_dir_path, member.name[2:]),
+                                                  member.mtime, io_throttle)
+                    h = hashlib.blake2b()
+                    data_file = archive_file.extractfile(member)
+                    for data in iter(lambda: data_file.read(READ_SIZE), b""):
+                        h.update(data)
+                    pending.append((member.name, h.hexdigest(), source_hash))
+                    verified += 1
+                    collect_pending(pending, inconsistencies, MAX_PENDING)
+        collect_pending(pending, inconsistencies, 0)
+
+    logging.info("Verified content of " + str(verified) + " files, found " + str(len(inconsistencies)) + " mismatches")
+    if len(inconsistencies) > 0:
+        return inconsistencies
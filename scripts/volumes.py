@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+
+import os
+import json
+
+from lazyimport import LazyModule
+
+hashlib = LazyModule("hashlib")
+
+#A volume set <archive> consists of volumes <archive>.v0001, <archive>.v0002, ... and the descriptor <archive>.volumes
+#which is written last and lists all volumes with their sizes and digests
+VOLUMES_SUFFIX = ".volumes"
+VOLUME_SUFFIX_FORMAT = ".v%04d"
+PARTIAL_SUFFIX = ".part"
+READ_SIZE = 1024 * 1024
+
+
+class VolumeError(Exception):
+     """
+     Abstract volume set error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class VolumeWriter:
+    """
+    Write-only file object which splits everything written into volumes of volume_size bytes next to archive_path.
+    Every volume is written to a partial file, synced and renamed once full; on_volume(volume_path, hexdigest) is then
+    called so that it can be shipped while the next one is being written. #close() completes the last volume and
+    writes the descriptor.
+    """
+    def __init__(self, archive_path, volume_size, digest_algorithm=None, on_volume=None):
+        if not volume_size or volume_size <= 0:
+            raise VolumeError("Invalid volume size: " + str(volume_size))
+        self.archive_path = archive_path
+        self.volume_size = volume_size
+        self.digest_algorithm = digest_algorithm
+        self.on_volume = on_volume
+        self.volumes = []
+        self.size = 0
+        self.file = None
+        self.hash = None
+        self.written = 0
+
+    def get_volume_path(self, number):
+        return self.archive_path + VOLUME_SUFFIX_FORMAT % number
+
+    def open_volume(self):
+        self.file = open(self.get_volume_path(len(self.volumes) + 1) + PARTIAL_SUFFIX, "wb")
+        self.hash = hashlib.new(self.digest_algorithm) if self.digest_algorithm else None
+        self.written = 0
+
+    def close_volume(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        volume_path = self.get_volume_path(len(self.volumes) + 1)
+        os.replace(volume_path + PARTIAL_SUFFIX, volume_path)
+        hexdigest = self.hash.hexdigest() if self.hash else None
+        self.volumes.append([os.path.basename(volume_path), self.written, hexdigest])
+        if self.on_volume:
+            self.on_volume(volume_path, hexdigest)
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            if self.file is None:
+                self.open_volume()
+            chunk = view[:self.volume_size - self.written]
+            self.file.write(chunk)
+            if self.hash:
+                self.hash.update(chunk)
+            self.written += len(chunk)
+            self.size += len(chunk)
+            view = view[len(chunk):]
+            if self.written == self.volume_size:
+                self.close_volume()
+        return len(data)
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        """
+        Completes the last volume and writes the descriptor. Returns the descriptor path.
+        """
+        if self.file is not None or not self.volumes:
+            if self.file is None:
+                self.open_volume()
+            self.close_volume()
+        descriptor_path = get_descriptor_path(self.archive_path)
+        with open(descriptor_path + PARTIAL_SUFFIX, "w") as f:
+            json.dump({"algorithm": self.digest_algorithm, "size": self.size, "volumes": self.volumes}, f)
+        os.replace(descriptor_path + PARTIAL_SUFFIX, descriptor_path)
+        return descriptor_path
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        #an incomplete set never gets a descriptor
+        if exc_type is None:
+            self.close()
+
+    def abort(self):
+        """
+        Removes all volumes written so far.
+        """
+        if self.file:
+            self.file.close()
+            self.file = None
+        paths = [self.get_volume_path(i + 1) for i in range(len(self.volumes) + 1)]
+        for path in paths + [p + PARTIAL_SUFFIX for p in paths]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+
+class VolumeReader:
+    """
+    Read-only file object presenting the volumes of a set as one stream.
+    """
+    def __init__(self, archive_path):
+        volumes = read_descriptor(archive_path)["volumes"]
+        dir_path = os.path.dirname(archive_path)
+        self.paths = [os.path.join(dir_path, name) for name, size, digest in volumes]
+        self.sizes = [size for name, size, digest in volumes]
+        self.index = 0
+        self.file = None
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        """
+        Moves to an absolute offset of the stream (only os.SEEK_SET is supported), volume sizes are taken from the
+        descriptor.
+        """
+        if whence != os.SEEK_SET:
+            raise VolumeError("Only absolute seeks are supported in volume sets")
+        self.close()
+        self.index = 0
+        while self.index < len(self.sizes) and offset >= self.sizes[self.index]:
+            offset -= self.sizes[self.index]
+            self.index += 1
+        if self.index < len(self.paths):
+            self.file = open(self.paths[self.index], "rb")
+            self.file.seek(offset)
+        return self.tell()
+
+    def tell(self):
+        return sum(self.sizes[:self.index]) + (self.file.tell() if self.file else 0)
+
+    def read(self, size=-1):
+        chunks = []
+        remaining = size if size is not None and size >= 0 else None
+        while self.index < len(self.paths) and (remaining is None or remaining > 0):
+            if self.file is None:
+                self.file = open(self.paths[self.index], "rb")
+            data = self.file.read(remaining if remaining is not None else -1)
+            if not data:
+                self.file.close()
+                self.file = None
+                self.index += 1
+                continue
+            chunks.append(data)
+            if remaining is not None:
+                remaining -= len(data)
+        return b"".join(chunks)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def get_descriptor_path(archive_path):
+    return archive_path + VOLUMES_SUFFIX
+
+
+def is_volume_set(archive_path):
+    return os.path.isfile(get_descriptor_path(archive_path))
+
+
+def read_descriptor(archive_path):
+    """
+    Reads the descriptor of a volume set, a dict with "algorithm", "size" and "volumes" ([name, size, digest] lists).
+    """
+    with open(get_descriptor_path(archive_path)) as f:
+        return json.load(f)
+
+
+def open_archive(archive_path):
+    """
+    Opens an archive file or a volume set for reading as one binary stream.
+    """
+    if is_volume_set(archive_path):
+        return VolumeReader(archive_path)
+    return open(archive_path, "rb")
+
+
+def get_volume_paths(archive_path):
+    dir_path = os.path.dirname(archive_path)
+    return [os.path.join(dir_path, name) for name, size, digest in read_descriptor(archive_path)["volumes"]]
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import re
+import stat
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class WalkEntry:
+    """
+    Single entry found while walking a tree. key is the path relative to the walked root in the form used for archive
+    member names ("./dir/file"), stat is the lstat result (None if it wasn't requested).
+    """
+    __slots__ = ("key", "path", "name", "stat", "is_dir", "is_link")
+
+    def __init__(self, key, path, name, stat, is_dir, is_link):
+        self.key = key
+        self.path = path
+        self.name = name
+        self.stat = stat
+        self.is_dir = is_dir
+        self.is_link = is_link
+
+
+def compile_pattern(pattern):
+    """
+    Compiles a regexp once so that it isn't looked up for every walked entry. Empty patterns compile to None.
+    """
+    if not pattern:
+        return None
+    return pattern if hasattr(pattern, "search") else re.compile(pattern)
+
+
+def scan_dir(dir_path, key_prefix, with_stat=True, sort=False, file_filter=None):
+    """
+    Lists a single directory with os.scandir. Returns a tuple (entries, subdirs) where subdirs is a list of (path, key)
+    tuples of the directories to descend into (symbolic links are never followed). Entries excluded by the file_filter
+    (a #filters.FileFilter) are left out, excluded directories aren't descended into.
+    """
+    entries = []
+    subdirs = []
+    try:
+        with os.scandir(dir_path) as it:
+            dir_entries = sorted(it, key=lambda e: e.name) if sort else list(it)
+    except OSError as ex:
+        logging.warning("Can't list directory " + dir_path + ": " + ex.__str__())
+        return entries, subdirs
+
+    for dir_entry in dir_entries:
+        try:
+            #file type comes from d_type for free, stat is cached by the DirEntry
+            is_link = dir_entry.is_symlink()
+            is_dir = dir_entry.is_dir(follow_symlinks=False)
+            st = dir_entry.stat(follow_symlinks=False) if with_stat or (file_filter and file_filter.needs_stat) else None
+        except FileNotFoundError:
+            continue
+        key = key_prefix + dir_entry.name
+        if file_filter is not None and file_filter.is_excluded(key, is_dir, st):
+            continue
+        entries.append(WalkEntry(key, dir_entry.path, dir_entry.name, st, is_dir, is_link))
+        if is_dir:
+            subdirs.append((dir_entry.path, key + "/"))
+    return entries, subdirs
+
+
+def walk(root, with_stat=True, threads=1, sort=False, file_filter=None):
+    """
+    Yields a WalkEntry for every file, directory and link below root (root itself excluded) which isn't excluded by the
+    file_filter. With threads > 1 directories are listed concurrently, which helps on high-latency network mounts, but
+    entries are yielded in no particular order. With sort (single thread only) entries of every directory are yielded
+    in name order.
+    """
+    if threads <= 1:
+        stack = [(root, os.curdir + "/")]
+        while stack:
+            entries, subdirs = scan_dir(*stack.pop(), with_stat=with_stat, sort=sort, file_filter=file_filter)
+            for entry in entries:
+                yield entry
+            stack.extend(reversed(subdirs))
+        return
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        running = set([executor.submit(scan_dir, root, os.curdir + "/", with_stat, False, file_filter)])
+        while running:
+            done, running = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                entries, subdirs = future.result()
+                for dir_path, key_prefix in subdirs:
+                    running.add(executor.submit(scan_dir, dir_path, key_prefix, with_stat, False, file_filter))
+                for entry in entries:
+                    yield entry
+
+
+def stat_keys(root, keys, file_filter=None):
+    """
+    Yields a WalkEntry for each of the keys ("./dir/file") which still exists below root and isn't excluded by the
+    file_filter, in the order of keys. Used instead of #walk() when the set of interesting entries is known, e.g. from
+    a change journal.
+    """
+    for key in keys:
+        path = os.path.join(root, key[2:]) if key.startswith(os.curdir + "/") else os.path.join(root, key)
+        try:
+            st = os.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if file_filter is not None and file_filter.is_excluded_path(key, is_dir, st):
+            continue
+        yield WalkEntry(key, path, os.path.basename(path), st, is_dir, stat.S_ISLNK(st.st_mode))
+
+
+def find_files(root, name_pattern=None, threads=1):
+    """
+    Yields absolute paths of files (and links) below root whose names match the regexp.
+    """
+    pattern = compile_pattern(name_pattern)
+    for entry in walk(root, with_stat=False, threads=threads):
+        if not entry.is_dir and (pattern is None or pattern.search(entry.name)):
+            yield entry.path
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+
+import os
+import sys
+import json
+import errno
+import struct
+import select
+import ctypes
+import hashlib
+import logging
+import threading
+
+import walker
+import manifest
+
+JOURNAL_SUFFIX = ".journal"
+PENDING_SUFFIX = ".pending"
+#Beyond that many changed paths a journal isn't worth keeping in memory, the next backup scans the source instead
+DEFAULT_MAX_KEYS = 1000000
+DEFAULT_POLL_INTERVAL = 300
+#Seconds a watcher blocks waiting for events before it checks if it has to stop
+WAIT_TIMEOUT = 1.0
+
+#inotify constants from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+             IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW | IN_EXCL_UNLINK
+#events which change the listing (and thus the modification time) of the directory they happen in
+LISTING_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+
+class WatcherError(Exception):
+     """
+     Abstract change watcher error.
+     """
+     def __init__(self, value):
+         self.value = value
+     def __str__(self):
+         return repr(self.value)
+
+
+class Journal:
+    """
+    Persistent journal of paths changed in a source since its last backup, one JSON line per change appended to a file
+    so that it survives restarts. A backup takes the journal over with #begin(), changes recorded meanwhile go to a new
+    journal, and hands it back with #commit() (changes are backed up) or #rollback() (backup failed). Whenever changes
+    may have been missed the journal is marked as overflowed and the next backup falls back to a full scan.
+    """
+    def __init__(self, path, max_keys=DEFAULT_MAX_KEYS):
+        self.path = path
+        self.pending_path = path + PENDING_SUFFIX
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def add(self, keys):
+        self.append([["c", key] for key in keys])
+
+    def mark_overflow(self, reason):
+        logging.info("Changes may have been missed, next backup scans the whole source: " + reason)
+        self.append([["o", reason]])
+
+    def append(self, records):
+        if not records:
+            return
+        with self.lock, open(self.path, "a", encoding="utf-8", errors="surrogateescape") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def begin(self):
+        """
+        Takes over the changes journaled so far for a backup. Returns the set of changed keys or None if the source has
+        to be scanned completely.
+        """
+        with self.lock:
+            if os.path.exists(self.pending_path):
+                #a previous backup didn't finish, its changes are still pending
+                self.merge_into(self.path, self.pending_path)
+            elif os.path.exists(self.path):
+                os.replace(self.path, self.pending_path)
+            else:
+                open(self.pending_path, "a").close()
+        return read_journal(self.pending_path, self.max_keys)
+
+    def commit(self):
+        with self.lock:
+            if os.path.exists(self.pending_path):
+                os.remove(self.pending_path)
+
+    def rollback(self):
+        with self.lock:
+            if os.path.exists(self.pending_path):
+                self.merge_into(self.path, self.pending_path)
+                os.replace(self.pending_path, self.path)
+
+    def merge_into(self, path, pending_path):
+        if os.path.exists(path):
+            with open(path, "rb") as src, open(pending_path, "ab") as dst:
+                dst.write(src.read())
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.remove(path)
+
+
+def read_journal(path, max_keys=DEFAULT_MAX_KEYS):
+    """
+    Reads a journal file. Returns the set of changed keys or None if the journal overflowed (or is unreadable).
+    """
+    keys = set()
+    try:
+        with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            for line in f:
+                try:
+                    kind, value = json.loads(line)
+                except ValueError:
+                    #only the last line can be torn by a crash, but changes may be lost with it
+                    logging.warning("Damaged change journal record in " + path)
+                    return None
+                if kind == "o":
+                    return None
+                keys.add(value)
+                if len(keys) > max_keys:
+                    logging.warning("Too many changes journaled in " + path + ", falling back to a full scan")
+                    return None
+    except OSError as ex:
+        logging.warning("Can't read change journal " + path + ": " + ex.__str__())
+        return None
+    return keys
+
+
+def get_journal_path(journal_dir, source, target):
+    """
+    Returns path of the change journal of a source directory backed up into the target.
+    """
+    source = os.path.abspath(source)
+    key = os.fsencode(source + "\0" + os.path.abspath(target))
+    name = os.path.basename(os.path.normpath(source)) + "-" + hashlib.sha1(key).hexdigest()[:8]
+    return os.path.join(journal_dir, name + JOURNAL_SUFFIX)
+
+
+class InotifyWatcher:
+    """
+    Watches every directory of a tree with inotify and records changed keys in the journals. New directories get watched
+    as they appear (with all their content journaled, as it may have been written before the watch was added).
+    """
+    def __init__(self, root, journals):
+        self.root = root
+        self.journals = journals
+        self.watches = dict()
+        self.moves = dict()
+        self.fd = None
+        if not sys.platform.startswith("linux"):
+            raise WatcherError("inotify is only available on Linux")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise WatcherError("inotify is not supported by the C library")
+
+    def start(self):
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherError("Can't initialize inotify: " + os.strerror(ctypes.get_errno()))
+        try:
+            self.add_tree(self.root, os.curdir)
+        except Exception:
+            self.close()
+            raise
+        logging.info("Watching " + str(len(self.watches)) + " directories of " + self.root + " with inotify")
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def add_watch(self, path, key):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return False
+            if err == errno.ENOSPC:
+                raise WatcherError("inotify watch limit reached, raise fs.inotify.max_user_watches")
+            raise WatcherError("Can't watch " + path + ": " + os.strerror(err))
+        #watching a directory again (e.g. after it was moved) returns its existing descriptor
+        self.watches[wd] = key
+        return True
+
+    def add_tree(self, path, key, collect=None):
+        """
+        Watches path and all directories below it. Keys of all entries found are added to the collect set if given.
+        """
+        if not self.add_watch(path, key):
+            return
+        for entry in walker.walk(path, with_stat=False):
+            entry_key = key + entry.key[1:]
+            if collect is not None:
+                collect.add(entry_key)
+            if entry.is_dir and not entry.is_link:
+                self.add_watch(entry.path, entry_key)
+
+    def remove_tree(self, key):
+        prefix = key + "/"
+        for wd in [wd for wd, k in self.watches.items() if k == key or k.startswith(prefix)]:
+            self.libc.inotify_rm_watch(self.fd, wd)
+            del self.watches[wd]
+
+    def get_path(self, key):
+        return os.path.join(self.root, key[2:]) if key != os.curdir else self.root
+
+    def process_events(self, timeout=WAIT_TIMEOUT):
+        """
+        Waits up to timeout seconds for events and journals the keys they touch.
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                data = os.read(self.fd, READ_SIZE)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            pos = 0
+            while pos < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, pos)
+                pos += EVENT_HEADER.size
+                name = os.fsdecode(data[pos:pos + length].rstrip(b"\0"))
+                pos += length
+                if mask & IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                self.handle_event(wd, mask, cookie, name, changed)
+
+        #directories moved out of the tree are no longer ours to watch
+        for old_key in self.moves.values():
+            self.remove_tree(old_key)
+        self.moves.clear()
+        for journal in self.journals:
+            if overflow:
+                journal.mark_overflow("inotify event queue overflowed")
+            journal.add(changed)
+
+    def handle_event(self, wd, mask, cookie, name, changed):
+        dir_key = self.watches.get(wd)
+        if dir_key is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            if dir_key == os.curdir:
+                raise WatcherError("Watched directory " + self.root + " was removed or moved")
+            return
+        key = dir_key + "/" + name if name else dir_key
+        if key != os.curdir:
+            changed.add(key)
+        if name and mask & LISTING_EVENTS and dir_key != os.curdir:
+            changed.add(dir_key)
+        if not mask & IN_ISDIR or not name:
+            return
+        if mask & IN_MOVED_FROM:
+            self.moves[cookie] = key
+        elif mask & (IN_CREATE | IN_MOVED_TO):
+            self.moves.pop(cookie, None)
+            self.add_tree(self.get_path(key), key, changed)
+
+
+class PollingWatcher:
+    """
+    Fallback watcher re-scanning the tree every interval seconds and journaling the difference to the previous scan.
+    """
+    def __init__(self, root, journals, interval=DEFAULT_POLL_INTERVAL, threads=1):
+        self.root = root
+        self.journals = journals
+        self.interval = interval
+        self.threads = threads
+        self.entries = None
+
+    def start(self):
+        self.entries = manifest.scan_dir(self.root, self.threads)
+        logging.info("Polling " + self.root + " for changes every " + str(self.interval) + " seconds")
+
+    def close(self):
+        self.entries = None
+
+    def process_events(self):
+        entries = manifest.scan_dir(self.root, self.threads)
+        changed, deleted = manifest.diff_entries(self.entries, entries)
+        self.entries = entries
+        for journal in self.journals:
+            journal.add(changed + deleted)
+
+
+def watch(root, journals, stop_event, poll_interval=DEFAULT_POLL_INTERVAL, threads=1):
+    """
+    Journals changes below root into all journals until stop_event is set, with inotify if possible and by polling
+    otherwise. Changes made before the watch started are unknown, so the journals are marked as overflowed first, and
+    so they are whenever inotify fails and watching falls back to polling.
+    """
+    mark_overflow(journals, "watching of " + root + " started")
+    watcher = None
+    try:
+        watcher = InotifyWatcher(root, journals)
+        watcher.start()
+        while not stop_event.is_set():
+            watcher.process_events(WAIT_TIMEOUT)
+        return
+    except Exception as ex:
+        logging.warning("Can't watch " + root + " with inotify, falling back to polling: " + ex.__str__())
+        mark_overflow(journals, ex.__str__())
+    finally:
+        if watcher:
+            watcher.close()
+
+    watcher = PollingWatcher(root, journals, poll_interval, threads)
+    watcher.start()
+    try:
+        while not stop_event.wait(poll_interval):
+            try:
+                watcher.process_events()
+            except Exception as ex:
+                logging.error("Failed to scan " + root + " for changes: " + ex.__str__())
+                mark_overflow(journals, ex.__str__())
+    finally:
+        watcher.close()
+
+
+def mark_overflow(journals, reason):
+    for journal in journals:
+        journal.mark_overflow(reason)
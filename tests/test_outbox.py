@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+    Copyright 2013 CRX Markets S.A.
+
+    Licensed under the Apache License, Version 2.0 (the "License");
+    you may not use this file except in compliance with the License.
+    You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+    Unless required by applicable law or agreed to in writing, software
+    distributed under the License is distributed on an "AS IS" BASIS,
+    WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+    See the License for the specific language governing permissions and
+    limitations under the License.
+"""
+__author__ = "Denys Sobchyshak"
+__email__ = "denys.sobchyshak@gmail.com"
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+import socketserver
+from email.mime.text import MIMEText
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "scripts"))
+import outbox
+
+
+class StandInSmtpHandler(socketserver.StreamRequestHandler):
+    """
+    Speaks just enough SMTP for smtplib. Messages are accepted unless the server is told to fail, then DATA is answered
+    with a temporary failure like a mail server which is out of resources.
+    """
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost stand-in")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode("ascii").strip().upper()
+            if command.startswith("EHLO"):
+                self.reply("250-localhost")
+                self.reply("250 8BITMIME")
+            elif command.startswith("DATA"):
+                if self.server.fail:
+                    self.reply("451 try again later")
+                    continue
+                self.reply("354 go ahead")
+                data = []
+                for line in iter(self.rfile.readline, b""):
+                    if line == b".\r\n":
+                        break
+                    data.append(line)
+                with self.server.lock:
+                    self.server.received.append(b"".join(data))
+                self.reply("250 queued")
+            elif command.startswith("QUIT"):
+                self.reply("221 bye")
+                return
+            else:
+                self.reply("250 OK")
+
+
+class StandInSmtpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), StandInSmtpHandler)
+        self.fail = False
+        self.received = []
+        self.lock = threading.Lock()
+
+
+class ReportSenderTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInSmtpServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.dir_path = tempfile.mkdtemp()
+        self.outbox = outbox.Outbox(self.dir_path)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.dir_path)
+
+    def make_sender(self):
+        port = self.server.server_address[1]
+        return outbox.ReportSender(self.outbox, lambda: outbox.SmtpSender("127.0.0.1", port, tls=False, timeout=5),
+                                   retries=1, backoff=0.01)
+
+    def queue_report(self, subject):
+        message = MIMEText("report body")
+        message["Subject"] = subject
+        message["From"] = "rex@localhost"
+        message["To"] = "admin@localhost"
+        return self.outbox.put(message)
+
+    def test_send(self):
+        self.queue_report("sent")
+        sender = self.make_sender()
+        sender.start()
+        self.assertTrue(sender.wait(10))
+        self.assertEqual(len(self.server.received), 1)
+        self.assertIn(b"Subject: sent", self.server.received[0])
+        self.assertEqual(len(self.outbox), 0)
+
+    def test_failed_send_stays_queued_and_is_flushed_once(self):
+        self.server.fail = True
+        self.queue_report("queued")
+        sender = self.make_sender()
+        sender.start()
+        self.assertTrue(sender.wait(10))
+        self.assertEqual(self.server.received, [])
+        self.assertEqual(len(self.outbox), 1)
+
+        #a later run delivers the queued report
+        self.server.fail = False
+        self.assertTrue(self.make_sender().flush())
+        self.assertEqual(len(self.server.received), 1)
+        self.assertIn(b"Subject: queued", self.server.received[0])
+        self.assertEqual(len(self.outbox), 0)
+        self.assertTrue(self.make_sender().flush())
+        self.assertEqual(len(self.server.received), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()